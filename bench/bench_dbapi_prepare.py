@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 测试健康检查中常用的元数据库SQL在不同连接方式下的吞吐量
+用法:
+    python bench_dbapi_prepare.py -c <cluster_id> [-t <task_id>] [-n 2000]
+    会分别测试: 每次新建连接(不使用连接池)、使用连接池、使用连接池并PREPARE语句 三种情况
+    注意: 会对指定集群做test_and_set_cluster_state和set_cluster_state，但设置的是集群当前的状态，不会改变集群状态
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import config  # noqa: E402
+import dao  # noqa: E402
+import general_task_mgr  # noqa: E402
+
+
+def run_check_loop(cluster_id, task_id, loop_cnt):
+    """
+    模拟SrHaChecker一次检查循环中对元数据库的访问
+    """
+    state = dao.get_cluster_state(cluster_id)
+    begin_time = time.time()
+    for _i in range(loop_cnt):
+        dao.test_and_set_cluster_state(cluster_id, [state], state)
+        dao.get_cluster(cluster_id)
+        dao.get_cluster_db_list(cluster_id)
+        if task_id:
+            general_task_mgr.write_log(task_id, 1, 'bench_dbapi_prepare')
+        dao.set_cluster_state(cluster_id, state)
+    return time.time() - begin_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cluster_id", type=int, required=True, help="用于测试的集群ID")
+    parser.add_argument("-t", "--task_id", type=int, default=0, help="如果指定了任务ID，会同时测试write_log")
+    parser.add_argument("-n", "--loop_cnt", type=int, default=2000, help="循环次数")
+    args = parser.parse_args()
+
+    config.load()
+    stmt_cnt = 5 if args.task_id else 4
+
+    case_list = [
+        ("no pool", {'db_pool_max_idle': 0, 'db_prepare_cache_size': 0}),
+        ("pool", {'db_pool_max_idle': 10, 'db_prepare_cache_size': 0}),
+        ("pool + prepare", {'db_pool_max_idle': 10, 'db_prepare_cache_size': 32}),
+    ]
+    for case_name, settings in case_list:
+        for key in settings:
+            config.set_key(key, settings[key])
+        # 先预热，让语句执行次数达到PREPARE的阈值
+        run_check_loop(args.cluster_id, args.task_id, 10)
+        used_secs = run_check_loop(args.cluster_id, args.task_id, args.loop_cnt)
+        loop_per_sec = args.loop_cnt / used_secs
+        print(f"{case_name:16s}: {used_secs:8.3f}s, {loop_per_sec:10.1f} loops/s, {loop_per_sec * stmt_cnt:10.1f} stmts/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 测量从数据库节点故障到切换完成(新主库提升、vip漂移)所用的时间，并按阶段统计耗时
+用法:
+    python bench_failover.py -c <cluster_id> [-f primary-host|primary-db|standby-host] [-n 5] [--max-secs 60]
+    在本机上为集群中的每台主机启动一个模拟的clup-agent(csurpc服务，实现is_running、vip_exists、check_and_add_vip、
+    run_cmd_result、run_long_term_cmd等接口)，数据库的探测和获取lsn也用模拟的结果，然后注入故障，调用SrHaChecker做检查，
+    记录failover_sr_cluster/failover_primary_db中各阶段的耗时。
+    注意:
+      1. 需要在clup的元数据库中准备一个用于测试的流复制集群，集群中数据库的host必须是127.0.0.x这样的本地回环地址，
+         每个地址上会启动一个模拟的agent，端口为--agent-port指定的端口，这个端口不能被真实的clup-agent占用
+      2. 每轮测试前会把集群和数据库在元数据库中的状态恢复为测试开始前的状态
+      3. 指定了--max-secs时，如果平均切换时间超过这个值，程序的退出码为1，可以用于回归测试
+      4. 切换前的孤岛检查真实ping时需要root权限(原始ICMP socket)，没有root权限时会被当成孤岛而不切换，
+         所以这里把ping也换成按模拟主机是否宕机返回结果，不需要用root运行
+"""
+
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import config  # noqa: E402
+import csurpc  # noqa: E402
+import dao  # noqa: E402
+import dbapi  # noqa: E402
+import ha_logic  # noqa: E402
+import health_check  # noqa: E402
+import pg_db_lib  # noqa: E402
+import pg_helpers  # noqa: E402
+import ping_lib  # noqa: E402
+import probe_db  # noqa: E402
+import rpc_utils  # noqa: E402
+
+# 需要统计耗时的阶段: (阶段名称, 模块, 函数名)
+PHASE_LIST = [
+    ('failover total', ha_logic, 'failover_sr_cluster'),
+    ('failover primary', ha_logic, 'failover_primary_db'),
+    ('failover standby', ha_logic, 'failover_standby_db'),
+    ('island check', ping_lib, 'is_any_ip_reachable'),
+    ('select from candidates', ha_logic, 'select_new_primary_from_candidates'),
+    ('select new primary', ha_logic, 'select_new_primary'),
+    ('collect lsn', probe_db, 'get_last_lsn_of_list'),
+    ('stop db', pg_db_lib, 'stop'),
+    ('start db', pg_db_lib, 'start'),
+    ('promote', pg_db_lib, 'promote'),
+    ('add vip', rpc_utils, 'check_and_add_vip'),
+    ('del vip', rpc_utils, 'check_and_del_vip'),
+]
+
+
+class FakeHost:
+    """
+    模拟的一台主机，记录主机上的数据库是否在运行、是否是主库、lsn以及主机上有哪些vip
+    """
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.down = False
+        self.rpc_delay = 0
+        # pgdata -> {'running': 是否运行, 'pid': 进程号, 'is_primary': 是否是主库, 'lsn': lsn}
+        self.pg_dict = {}
+        self.vip_set = set()
+        self.file_dict = {}
+        self.lock = threading.Lock()
+        self.pid_seq = 1000
+
+    def new_pid(self):
+        self.pid_seq += 1
+        return self.pid_seq
+
+    def get_pg_by_path(self, path):
+        for pgdata, pg in self.pg_dict.items():
+            if path == pgdata or path.startswith(pgdata + '/'):
+                return pgdata, pg
+        return None, None
+
+    def get_pg_by_pid(self, pid):
+        for pg in self.pg_dict.values():
+            if pg['running'] and pg['pid'] == pid:
+                return pg
+        return None
+
+
+class FakeAgent:
+    """
+    模拟的clup-agent，只实现了健康检查和故障切换过程中会调用到的接口，主机被设置为down时所有的调用都失败
+    """
+
+    def __init__(self, host):
+        self._host = host
+
+    def _enter(self):
+        if self._host.rpc_delay:
+            time.sleep(self._host.rpc_delay)
+        if self._host.down:
+            raise Exception(f"host({self._host.ip}) is down")
+
+    def get_agent_version(self):
+        self._enter()
+        return 0, 'fake'
+
+    def vip_exists(self, vip):
+        self._enter()
+        return 0, vip in self._host.vip_set
+
+    def check_and_add_vip(self, vip):
+        self._enter()
+        self._host.vip_set.add(vip)
+        return 0, ''
+
+    def check_and_del_vip(self, vip):
+        self._enter()
+        self._host.vip_set.discard(vip)
+        return 0, ''
+
+    def os_path_exists(self, path):
+        self._enter()
+        if path in self._host.file_dict:
+            return True
+        m = re.match(r'^/proc/(\d+)$', path)
+        if m:
+            return self._host.get_pg_by_pid(int(m.group(1))) is not None
+        pgdata, pg = self._host.get_pg_by_path(path)
+        if pg is None:
+            return False
+        if path == pgdata:
+            return True
+        name = path[len(pgdata) + 1:]
+        if name == 'postmaster.pid':
+            return pg['running']
+        if name in ('recovery.conf', 'standby.signal'):
+            return not pg['is_primary']
+        return name in ('postgresql.conf', 'postgresql.auto.conf', 'PG_VERSION')
+
+    def path_is_dir(self, path):
+        self._enter()
+        pgdata, _pg = self._host.get_pg_by_path(path)
+        return path == pgdata
+
+    def file_read(self, path):
+        self._enter()
+        m = re.match(r'^/proc/(\d+)/comm$', path)
+        if m:
+            if self._host.get_pg_by_pid(int(m.group(1))) is None:
+                return -1, f"No such file: {path}"
+            return 0, 'postgres\n'
+        pgdata, pg = self._host.get_pg_by_path(path)
+        if pg is not None and path == f"{pgdata}/postmaster.pid":
+            if not pg['running']:
+                return -1, f"No such file: {path}"
+            return 0, f"{pg['pid']}\n{pgdata}\n"
+        if path in self._host.file_dict:
+            return 0, self._host.file_dict[path]
+        return -1, f"No such file: {path}"
+
+    def read_file(self, path, *args):
+        return self.file_read(path)
+
+    def os_read_file(self, path, offset=0, size=-1):
+        self._enter()
+        return self._host.file_dict.get(path, b'')
+
+    def file_write(self, path, data):
+        self._enter()
+        self._host.file_dict[path] = data
+        return 0, ''
+
+    def write_file(self, path, data, *args):
+        return self.file_write(path, data)
+
+    def os_write_file(self, path, offset, data):
+        return self.file_write(path, data)
+
+    def append_file(self, path, data):
+        self._enter()
+        self._host.file_dict[path] = self._host.file_dict.get(path, '') + data
+        return 0, ''
+
+    def delete_file(self, path):
+        self._enter()
+        self._host.file_dict.pop(path, None)
+        return 0, ''
+
+    def os_stat(self, path):
+        self._enter()
+        return 0, {'st_uid': 1000, 'st_gid': 1000, 'st_mode': 0o40700, 'st_size': 0, 'st_mtime': time.time()}
+
+    def pwd_getpwuid(self, uid):
+        self._enter()
+        return 0, {'pw_name': 'postgres', 'pw_uid': 1000, 'pw_gid': 1000, 'pw_dir': '/home/postgres', 'pw_shell': '/bin/bash'}
+
+    def pwd_getpwnam(self, name):
+        return self.pwd_getpwuid(1000)
+
+    def os_chown(self, path, uid, gid):
+        self._enter()
+        return 0, ''
+
+    def os_chmod(self, path, mode):
+        self._enter()
+        return 0, ''
+
+    def os_kill(self, pid, sig):
+        self._enter()
+        return 0, ''
+
+    def read_config_file_items(self, path, item_list):
+        self._enter()
+        return 0, {}
+
+    def modify_config_type1(self, *args, **kwargs):
+        self._enter()
+        return 0, ''
+
+    def modify_config_type2(self, *args, **kwargs):
+        self._enter()
+        return 0, ''
+
+    def config_file_set_tag_content(self, *args, **kwargs):
+        self._enter()
+        return 0, ''
+
+    def config_file_set_tag_in_head(self, *args, **kwargs):
+        self._enter()
+        return 0, ''
+
+    def pg_cp_delay_wal_from_pri(self, *args, **kwargs):
+        self._enter()
+        return 0, ''
+
+    def run_cmd(self, cmd):
+        err_code, err_msg, _out_msg = self.run_cmd_result(cmd)
+        return err_code, err_msg
+
+    def run_cmd_result(self, cmd):
+        """
+        只模拟pg_ctl和pg_controldata命令，其他命令都直接返回成功
+        """
+        self._enter()
+        m = re.search(r'-D\s+(\S+?)[\'"\s]', cmd + ' ')
+        pg = self._host.pg_dict.get(m.group(1)) if m else None
+        if pg is None:
+            return 0, '', ''
+        with self._host.lock:
+            if 'pg_controldata' in cmd:
+                state = 'in production' if pg['is_primary'] else 'in archive recovery'
+                return 0, '', f"Database cluster state:               {state}\n"
+            if 'pg_ctl start' in cmd or 'pg_ctl restart' in cmd:
+                pg['running'] = True
+                pg['pid'] = self._host.new_pid()
+            elif 'pg_ctl stop' in cmd:
+                pg['running'] = False
+            elif 'pg_ctl promote' in cmd:
+                pg['is_primary'] = True
+        return 0, '', ''
+
+    def run_long_term_cmd(self, cmd, *args, **kwargs):
+        self.run_cmd_result(cmd)
+        return 1
+
+    def get_long_term_cmd_state(self, cmd_id):
+        self._enter()
+        return 1, 0, '', [], []
+
+    def remove_long_term_cmd(self, cmd_id):
+        self._enter()
+        return 0, ''
+
+
+class FakeCluster:
+    """
+    管理集群中所有的模拟主机及其上运行的模拟agent
+    """
+
+    def __init__(self, agent_port):
+        self.agent_port = agent_port
+        self.host_dict = {}
+        self.thread_dict = {}
+
+    def add_host(self, ip):
+        if ip not in self.host_dict:
+            self.host_dict[ip] = FakeHost(ip)
+        return self.host_dict[ip]
+
+    def start_agent(self, ip):
+        host = self.host_dict[ip]
+        host.down = False
+        t = self.thread_dict.get(ip)
+        if t is not None and t.is_alive():
+            return
+        srv = csurpc.Server(f'fake-agent-{ip}', FakeAgent(host), lambda: host.down,
+                            password=config.get('internal_rpc_pass'), thread_count=10)
+        srv.bind(f"tcp://{ip}:{self.agent_port}")
+        t = threading.Thread(target=srv.run, name=f'fake-agent-{ip}', daemon=True)
+        t.start()
+        self.thread_dict[ip] = t
+
+    def stop_agent(self, ip):
+        """
+        模拟主机宕机，agent的服务会在1秒内停止监听，之后的连接都会被拒绝
+        """
+        self.host_dict[ip].down = True
+
+    def find_pg(self, host, port):
+        fake_host = self.host_dict.get(host)
+        if fake_host is None or fake_host.down:
+            return None
+        for pg in fake_host.pg_dict.values():
+            if pg['port'] == int(port):
+                return pg
+        return None
+
+
+def install_fake_probe(fake_cluster, probe_delay):
+    """
+    把探测数据库、获取lsn和ping主机的函数换成使用模拟主机上的状态
+    """
+
+    def fake_probe_postgres(host, port, db, user, password, sql, time_out=10):
+        time.sleep(probe_delay)
+        pg = fake_cluster.find_pg(host, port)
+        if pg is None or not pg['running']:
+            return -1, f'could not connect to server {host}:{port}: Connection refused'
+        return 0, ''
+
+    def fake_get_last_lsn(host, port, user, password, time_out=10):
+        time.sleep(probe_delay)
+        pg = fake_cluster.find_pg(host, port)
+        if pg is None or not pg['running']:
+            return -1, f'could not connect to server {host}:{port}: Connection refused', ''
+        return 0, pg_db_lib.int_to_lsn(pg['lsn']), 1
+
+    def fake_psql_test(db_id, sql):
+        db = dao.get_db_info(db_id)[0]
+        pg = fake_cluster.find_pg(db['host'], db['port'])
+        if pg is None or not pg['running']:
+            return -1, 'Connection refused'
+        return 0, ''
+
+    def fake_is_any_ip_reachable(ip_list, timeout=2, count=1):
+        for ip in ip_list:
+            fake_host = fake_cluster.host_dict.get(ip)
+            if fake_host is not None and not fake_host.down:
+                return True
+        return False
+
+    probe_db.probe_postgres = fake_probe_postgres
+    probe_db.get_last_lsn = fake_get_last_lsn
+    probe_db.run_sql = lambda *args, **kwargs: (0, [])
+    probe_db.exec_sql = lambda *args, **kwargs: (0, '')
+    pg_helpers.psql_test = fake_psql_test
+    ping_lib.is_any_ip_reachable = fake_is_any_ip_reachable
+
+
+class PhaseTimer:
+    """
+    包装各阶段的函数，累计每个阶段的耗时
+    """
+
+    def __init__(self):
+        self.used_dict = {}
+        self.enter_time_dict = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.used_dict = {}
+            self.enter_time_dict = {}
+
+    def wrap(self, phase, func):
+        def wrap_func(*args, **kwargs):
+            begin_time = time.time()
+            with self.lock:
+                self.enter_time_dict.setdefault(phase, begin_time)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.used_dict[phase] = self.used_dict.get(phase, 0) + time.time() - begin_time
+        return wrap_func
+
+    def install(self):
+        for phase, module, func_name in PHASE_LIST:
+            setattr(module, func_name, self.wrap(phase, getattr(module, func_name)))
+
+
+def save_meta(cluster_id):
+    cluster_row = dbapi.query("SELECT state, cluster_data::text AS cluster_data FROM clup_cluster WHERE cluster_id=%s", (cluster_id,))[0]
+    db_rows = dbapi.query("SELECT db_id, state, is_primary, up_db_id, db_state, db_detail::text AS db_detail "
+                          " FROM clup_db WHERE cluster_id=%s", (cluster_id,))
+    return cluster_row, db_rows
+
+
+def restore_meta(cluster_id, cluster_row, db_rows):
+    dbapi.execute("UPDATE clup_cluster SET state=%s, cluster_data=%s::jsonb WHERE cluster_id=%s",
+                  (cluster_row['state'], cluster_row['cluster_data'], cluster_id))
+    for row in db_rows:
+        dbapi.execute("UPDATE clup_db SET state=%s, is_primary=%s, up_db_id=%s, db_state=%s, db_detail=%s::jsonb WHERE db_id=%s",
+                      (row['state'], row['is_primary'], row['up_db_id'], row['db_state'], row['db_detail'], row['db_id']))
+
+
+def reset_fake_cluster(fake_cluster, cluster_dict, clu_db_list):
+    for db in clu_db_list:
+        fake_host = fake_cluster.add_host(db['host'])
+        fake_host.vip_set = set()
+        fake_host.file_dict = {}
+        fake_host.pg_dict[db['pgdata']] = {
+            'running': True,
+            'pid': fake_host.new_pid(),
+            'is_primary': bool(db['is_primary']),
+            'port': int(db['port']),
+            # 备库按db_id依次落后一些
+            'lsn': 0x3000000 if db['is_primary'] else 0x3000000 - 0x1000 * (db['db_id'] % 7 + 1),
+        }
+        if db['is_primary']:
+            fake_host.vip_set.add(cluster_dict['vip'])
+    for ip in fake_cluster.host_dict:
+        fake_cluster.start_agent(ip)
+
+
+def run_round(args, fake_cluster, timer, cluster_row, db_rows):
+    cluster_id = args.cluster_id
+    restore_meta(cluster_id, cluster_row, db_rows)
+    cluster_dict = dao.get_cluster(cluster_id)
+    clu_db_list = dao.get_cluster_db_list(cluster_id)
+    reset_fake_cluster(fake_cluster, cluster_dict, clu_db_list)
+
+    # 先正常检查几次，让故障检测器和候选备库表有数据
+    checker = health_check.SrHaChecker(cluster_id)
+    for _i in range(args.warmup_cnt):
+        checker.check()
+        time.sleep(args.warmup_interval)
+
+    pri_db = [db for db in clu_db_list if db['is_primary']][0]
+    stb_db = [db for db in clu_db_list if not db['is_primary']][0]
+    if args.fault == 'primary-host':
+        bad_db = pri_db
+        fake_cluster.stop_agent(bad_db['host'])
+        # 等待模拟agent停止监听
+        time.sleep(1.5)
+    elif args.fault == 'primary-db':
+        bad_db = pri_db
+        fake_cluster.host_dict[bad_db['host']].pg_dict[bad_db['pgdata']]['running'] = False
+    else:
+        bad_db = stb_db
+        fake_cluster.stop_agent(bad_db['host'])
+        time.sleep(1.5)
+
+    timer.reset()
+    begin_time = time.time()
+    checker.check()
+    total_secs = time.time() - begin_time
+
+    failover_begin = timer.enter_time_dict.get('failover total')
+    detect_secs = failover_begin - begin_time if failover_begin else None
+    new_pri = dao.get_primary_host(cluster_id).get('host')
+    vip_host_list = [ip for ip, h in fake_cluster.host_dict.items() if cluster_dict['vip'] in h.vip_set and not h.down]
+    return {
+        'total': total_secs,
+        'detect': detect_secs,
+        'phase': dict(timer.used_dict),
+        'old_primary': pri_db['host'],
+        'new_primary': new_pri,
+        'vip_host': ','.join(vip_host_list),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cluster_id", type=int, required=True, help="用于测试的集群ID")
+    parser.add_argument("-f", "--fault", default='primary-host', choices=['primary-host', 'primary-db', 'standby-host'],
+                        help="注入的故障类型")
+    parser.add_argument("-n", "--round_cnt", type=int, default=3, help="测试的轮数")
+    parser.add_argument("--agent-port", type=int, default=14243, help="模拟agent监听的端口")
+    parser.add_argument("--rpc-delay", type=float, default=0, help="模拟agent每次调用增加的延迟(秒)")
+    parser.add_argument("--probe-delay", type=float, default=0, help="模拟探测数据库时增加的延迟(秒)")
+    parser.add_argument("--warmup-cnt", type=int, default=4, help="注入故障前正常检查的次数")
+    parser.add_argument("--warmup-interval", type=float, default=1, help="注入故障前每次正常检查之间的间隔(秒)")
+    parser.add_argument("--max-secs", type=float, default=0, help="平均切换时间超过此值时，退出码为1")
+    args = parser.parse_args()
+
+    config.load()
+    config.set_key('agent_rpc_port', args.agent_port)
+
+    clu_db_list = dao.get_cluster_db_list(args.cluster_id)
+    if not clu_db_list:
+        print(f"cluster({args.cluster_id}) not exists or has no database.")
+        sys.exit(2)
+    for db in clu_db_list:
+        if not db['host'].startswith('127.'):
+            print(f"host({db['host']}) of database(db_id={db['db_id']}) is not a loopback address, can not run fake agent on it.")
+            sys.exit(2)
+
+    fake_cluster = FakeCluster(args.agent_port)
+    for db in clu_db_list:
+        fake_cluster.add_host(db['host']).rpc_delay = args.rpc_delay
+    install_fake_probe(fake_cluster, args.probe_delay)
+    timer = PhaseTimer()
+    timer.install()
+
+    cluster_row, db_rows = save_meta(args.cluster_id)
+    result_list = []
+    try:
+        for i in range(args.round_cnt):
+            ret = run_round(args, fake_cluster, timer, cluster_row, db_rows)
+            result_list.append(ret)
+            detect = f"{ret['detect']:.3f}s" if ret['detect'] is not None else 'not detected'
+            print(f"round {i + 1}: total {ret['total']:.3f}s, detect {detect}, "
+                  f"primary {ret['old_primary']} -> {ret['new_primary']}, vip on {ret['vip_host']}")
+            for phase, _module, _func_name in PHASE_LIST:
+                if phase in ret['phase']:
+                    print(f"    {phase:24s}: {ret['phase'][phase]:8.3f}s")
+    finally:
+        restore_meta(args.cluster_id, cluster_row, db_rows)
+
+    total_list = [ret['total'] for ret in result_list]
+    avg_secs = sum(total_list) / len(total_list)
+    print(f"summary: rounds {len(total_list)}, avg {avg_secs:.3f}s, min {min(total_list):.3f}s, max {max(total_list):.3f}s")
+    if args.max_secs and avg_secs > args.max_secs:
+        print(f"FAILED: average failover time {avg_secs:.3f}s is more than {args.max_secs}s")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
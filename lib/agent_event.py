@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: clup-agent主动上报的事件，如数据库进程退出、磁盘满、vip丢失等，
+    其他模块(如健康检查)可以订阅这些事件，收到事件后立即进行检查，而不用等到下一次定时检查
+"""
+
+import logging
+import threading
+import traceback
+
+# 数据库的postmaster进程退出
+EVENT_POSTMASTER_EXIT = 'postmaster_exit'
+# 磁盘满
+EVENT_DISK_FULL = 'disk_full'
+# vip丢失
+EVENT_VIP_LOST = 'vip_lost'
+
+EVENT_TYPE_LIST = [EVENT_POSTMASTER_EXIT, EVENT_DISK_FULL, EVENT_VIP_LOST]
+
+__subscriber_list = []
+__subscriber_lock = threading.Lock()
+
+
+def subscribe(func):
+    """
+    订阅agent上报的事件
+    :param func: 回调函数，参数为(host, event_type, event_dict)，回调函数中不要做耗时的操作
+    """
+    with __subscriber_lock:
+        if func not in __subscriber_list:
+            __subscriber_list.append(func)
+
+
+def publish(host, event_type, event_dict):
+    with __subscriber_lock:
+        subscriber_list = list(__subscriber_list)
+    for func in subscriber_list:
+        try:
+            func(host, event_type, event_dict)
+        except Exception:
+            logging.error(f"handle agent event({event_type}) from host({host}) failed: {traceback.format_exc()}")
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 并发调用多台主机上的agent，界面的接口中需要访问多个agent时使用，所有的调用共用一个有上限的线程池
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import config
+
+__lock = threading.Lock()
+__executor = None
+# 创建线程池的进程，web工作进程是fork出来的，不能使用主进程中的线程池
+__executor_pid = None
+
+
+def get_executor():
+    global __executor
+    global __executor_pid
+
+    with __lock:
+        if __executor is None or __executor_pid != os.getpid():
+            worker_cnt = int(config.get('agent_fanout_worker_cnt', 32))
+            __executor = ThreadPoolExecutor(worker_cnt, thread_name_prefix="agent-fanout")
+            __executor_pid = os.getpid()
+        return __executor
+
+
+def get_deadline():
+    return float(config.get('agent_fanout_deadline', 5))
+
+
+def run_all(func, arg_list, timeout_result, deadline=None):
+    """
+    并发执行func(*args)，所有调用最多等待deadline秒，不会因为某台主机连接超时而让每台主机都等待一次超时
+    :param arg_list: 每个元素是一次调用的参数的tuple
+    :param timeout_result: 超过deadline还没有完成或执行出错的调用返回此值
+    :return: 返回结果列表，与arg_list中的顺序相同
+    """
+    if not arg_list:
+        return []
+    if deadline is None:
+        deadline = get_deadline()
+
+    executor = get_executor()
+    future_list = [executor.submit(func, *args) for args in arg_list]
+    done_set, _not_done_set = wait(future_list, timeout=deadline)
+    result_list = []
+    for args, future in zip(arg_list, future_list):
+        if future not in done_set:
+            # 还在排队的直接取消，已经在执行的等它自己超时结束
+            future.cancel()
+            logging.info(f"{func.__name__}{args} not finished in {deadline} seconds.")
+            result_list.append(timeout_result)
+            continue
+        try:
+            result_list.append(future.result())
+        except Exception as e:
+            logging.error(f"{func.__name__}{args} failed: {repr(e)}")
+            result_list.append(timeout_result)
+    return result_list
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 后台定时连接每台主机(clup_host)上的agent，在内存中记录agent是否正常、状态变化的时间和agent的版本，
+    界面上的接口直接使用这里的结果，不用再逐台连接agent；高可用的代码用它做快速的预判断
+"""
+
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import csuapp
+import dbapi
+import rpc_utils
+import web_worker
+
+# ip -> {'ip', 'is_ok', 'version', 'check_time': 最后检查的时间, 'change_time': 状态最后变化的时间, 'err_msg'}
+__state_dict = {}
+__state_lock = threading.Lock()
+__tracker_thread = None
+# web工作进程中从主进程获取的状态: (获取的时间, state_dict)
+__main_state = (0, {})
+# web工作进程中从主进程获取的状态的缓存秒数
+MAIN_STATE_CACHE_SECS = 1
+
+
+def get_check_interval():
+    return int(config.get('agent_check_interval', 5))
+
+
+def check_host(ip):
+    err_code, err_msg = rpc_utils.get_rpc_connect(ip, conn_timeout=2)
+    is_ok = err_code == 0
+    agent_version = ''
+    if is_ok:
+        rpc = err_msg
+        err_msg = ''
+        try:
+            agent_version = rpc.get_agent_version()
+        except Exception as e:
+            logging.info(f'Failed to retrieve agent version from host({ip}): {repr(e)}')
+        finally:
+            rpc.close()
+
+    now = time.time()
+    with __state_lock:
+        old_state = __state_dict.get(ip)
+        if old_state is None or old_state['is_ok'] != is_ok:
+            change_time = now
+            if old_state is not None:
+                logging.info(f"agent on host({ip}) is {'up' if is_ok else 'down'}: {err_msg}")
+        else:
+            change_time = old_state['change_time']
+            # 连接失败时保留之前获取到的版本
+            if not is_ok:
+                agent_version = old_state['version']
+        __state_dict[ip] = {
+            'ip': ip,
+            'is_ok': is_ok,
+            'version': agent_version,
+            'check_time': now,
+            'change_time': change_time,
+            'err_msg': err_msg,
+        }
+
+
+def get_state_dict():
+    """
+    获得所有主机上agent的状态，web工作进程通过RPC调用主进程中的这个函数
+    """
+    with __state_lock:
+        return {ip: dict(state) for ip, state in __state_dict.items()}
+
+
+def __get_local_state_dict():
+    global __main_state
+
+    if not web_worker.is_worker_process():
+        with __state_lock:
+            return __state_dict
+    # 后台检查只在主进程中运行
+    fetch_time, state_dict = __main_state
+    if time.time() - fetch_time < MAIN_STATE_CACHE_SECS:
+        return state_dict
+    try:
+        state_dict = web_worker.call_main('get_agent_state_dict')
+    except Exception as e:
+        logging.debug(f"Can not get agent state from clup main process: {repr(e)}")
+        state_dict = {}
+    if not isinstance(state_dict, dict):
+        # 没有拿到结果时按没有检查过处理，调用者会自己连接agent
+        state_dict = {}
+    __main_state = (time.time(), state_dict)
+    return state_dict
+
+
+def get_host_state(ip, max_interval_cnt=3):
+    """
+    :param max_interval_cnt: 检查结果超过这么多个检查周期没有更新时认为已经过期
+    :return: 返回agent的状态，没有检查过或结果已经过期时返回None，这时调用者需要自己连接agent
+    """
+    interval = get_check_interval()
+    if interval <= 0:
+        return None
+    state = __get_local_state_dict().get(ip)
+    if state is None or time.time() - state['check_time'] > interval * max_interval_cnt:
+        return None
+    return state
+
+
+def is_host_down(ip, max_interval_cnt=3):
+    """
+    快速判断主机上的agent是否连接不上，只有最近的检查结果是连接不上时才返回True，
+    高可用的代码要根据这个结果做决定时，应该把max_interval_cnt设置为1
+    """
+    state = get_host_state(ip, max_interval_cnt)
+    return state is not None and not state['is_ok']
+
+
+def check_loop():
+    worker_cnt = int(config.get('agent_check_worker_cnt', 16))
+    with ThreadPoolExecutor(worker_cnt, thread_name_prefix="agent-tracker") as executor:
+        while not csuapp.is_exit():
+            interval = get_check_interval()
+            if interval <= 0:
+                time.sleep(1)
+                continue
+            begin_time = time.time()
+            try:
+                rows = dbapi.query("SELECT ip FROM clup_host")
+                ip_list = [row['ip'] for row in rows]
+                # 已经删除的主机不再保留状态
+                with __state_lock:
+                    for ip in list(__state_dict.keys()):
+                        if ip not in ip_list:
+                            del __state_dict[ip]
+                list(executor.map(check_host, ip_list))
+            except Exception:
+                logging.debug(f"Can not check agents, try again later: {traceback.format_exc()}")
+            sleep_secs = interval - (time.time() - begin_time)
+            while sleep_secs > 0 and not csuapp.is_exit():
+                time.sleep(min(sleep_secs, 1))
+                sleep_secs -= 1
+
+
+def start():
+    global __tracker_thread
+    if __tracker_thread is not None:
+        return
+    __tracker_thread = threading.Thread(target=check_loop, name="agent-tracker-main", daemon=True)
+    __tracker_thread.start()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 界面上轮询的列表接口的短时间响应缓存，相同的并发请求只执行一次
+"""
+
+import json
+import threading
+import time
+
+import config
+import csu_http
+
+# 被缓存的接口，这些接口会连接每台主机上的agent，界面上又会定时刷新
+CACHED_API_LIST = ['get_dashboard', 'get_host_list', 'get_cluster_db_list', 'get_all_db_list']
+# 这些前缀的接口只读取数据，其他接口调用后认为clup的数据可能发生了变化，清空缓存
+READ_ONLY_PREFIX_LIST = ['get_', 'check_', 'query_', 'list_', 'basic_test_api']
+# 最多缓存的响应个数
+MAX_ENTRY_CNT = 1024
+# 等待正在执行的相同请求的最长秒数
+WAIT_TIMEOUT = 120
+
+__lock = threading.Lock()
+# (func_name, params) -> CacheEntry
+__entry_dict = {}
+# 每次清空缓存时加1，请求执行期间缓存被清空了，请求的结果就不再放到缓存中
+__generation = 0
+
+
+class CacheEntry:
+    def __init__(self):
+        self.event = threading.Event()
+        self.expire_time = 0
+        self.http_code = None
+        self.body = None
+        self.is_ok = False
+
+
+def get_ttl():
+    return float(config.get('ui_cache_ttl', 3))
+
+
+def invalidate():
+    """
+    clup修改了集群、数据库或主机的信息后调用，清空所有的缓存
+    """
+    global __generation
+
+    with __lock:
+        __generation += 1
+        # 正在执行的请求不删除，等待它的请求仍然使用它的结果
+        for key in [k for k, entry in __entry_dict.items() if entry.event.is_set()]:
+            del __entry_dict[key]
+
+
+def __make_key(func_name, req):
+    form = req.form if isinstance(req.form, dict) else {}
+    # 参数可能是字符串也可能是数字，统一转换成字符串
+    params = json.dumps({k: str(v) for k, v in form.items()}, sort_keys=True)
+    return func_name, params
+
+
+def __purge_expired(now):
+    for key in [k for k, entry in __entry_dict.items() if entry.event.is_set() and entry.expire_time <= now]:
+        del __entry_dict[key]
+
+
+def call_cached(func_name, func_obj, req):
+    ttl = get_ttl()
+    if ttl <= 0:
+        return func_obj(req)
+
+    key = __make_key(func_name, req)
+    now = time.time()
+    with __lock:
+        entry = __entry_dict.get(key)
+        if entry is not None and entry.event.is_set() and entry.expire_time <= now:
+            del __entry_dict[key]
+            entry = None
+        is_leader = entry is None
+        if is_leader:
+            entry = CacheEntry()
+            __entry_dict[key] = entry
+            start_generation = __generation
+
+    if not is_leader:
+        if entry.event.wait(WAIT_TIMEOUT) and entry.is_ok:
+            return entry.http_code, entry.body
+        # 相同的请求执行失败了，自己再执行一次
+        return func_obj(req)
+
+    try:
+        http_code, body_data = func_obj(req)
+        body = csu_http.HttpBody(body_data)
+        entry.http_code = http_code
+        entry.body = body
+        entry.is_ok = True
+    finally:
+        with __lock:
+            # 只缓存成功的结果
+            if entry.is_ok and http_code == 200 and start_generation == __generation:
+                entry.expire_time = time.time() + ttl
+                if len(__entry_dict) > MAX_ENTRY_CNT:
+                    __purge_expired(time.time())
+            elif __entry_dict.get(key) is entry:
+                del __entry_dict[key]
+            entry.event.set()
+    return http_code, body
+
+
+def __gen_cached_func(func_name, func_obj):
+    def cached_func(req):
+        return call_cached(func_name, func_obj, req)
+    return cached_func
+
+
+def __gen_invalidate_func(func_obj):
+    def invalidate_func(req):
+        try:
+            return func_obj(req)
+        finally:
+            invalidate()
+    return invalidate_func
+
+
+def wrap_handler_dict(handler_dict):
+    """
+    给界面的接口加上缓存：被缓存的接口先查缓存，会修改数据的接口执行后清空缓存
+    注意多个web工作进程时每个进程有自己的缓存，其他进程中的修改最多ui_cache_ttl秒后才能看到
+    """
+    wrapped_dict = {}
+    for func_name, func_obj in handler_dict.items():
+        if func_name in CACHED_API_LIST:
+            wrapped_dict[func_name] = __gen_cached_func(func_name, func_obj)
+        elif any(func_name.startswith(prefix) for prefix in READ_ONLY_PREFIX_LIST):
+            wrapped_dict[func_name] = func_obj
+        else:
+            wrapped_dict[func_name] = __gen_invalidate_func(func_obj)
+    return wrapped_dict
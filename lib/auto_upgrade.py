@@ -67,7 +67,8 @@ def upgrade_common(v1, v2):
 
 
 upgrade_func_list = [
-    ["5.0.0", upgrade_common]
+    ["5.0.0", upgrade_common],
+    ["5.0.1", upgrade_common]
 ]
 
 
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 定时检查的调度模块，用一个按到期时间排序的队列加上一个有限大小的线程池来执行周期性的检查，
+    避免每个检查对象都启动一个线程
+"""
+
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import csuapp
+
+
+def get_default_worker_cnt():
+    """
+    检查中大部分时间是在等待网络和探测进程，所以线程数按CPU核数的倍数来设置
+    """
+    cpu_cnt = os.cpu_count() or 1
+    return max(8, min(64, cpu_cnt * 4))
+
+
+class CheckScheduler:
+    """
+    用法:
+        def check_func(key):
+            ...
+            return 10  # 返回下一次检查的间隔秒数，返回None表示不再检查此对象
+        scheduler = CheckScheduler('ha-check', check_func, worker_cnt=16)
+        scheduler.start()
+        scheduler.add(cluster_id, interval=10)
+    """
+
+    def __init__(self, name, check_func, worker_cnt=0, jitter=0.1):
+        self.name = name
+        self.check_func = check_func
+        if worker_cnt <= 0:
+            worker_cnt = get_default_worker_cnt()
+        self.worker_cnt = worker_cnt
+        # 下一次检查的时间在 interval * (1 - jitter) 到 interval * (1 + jitter) 之间随机，防止所有的检查挤在同一时刻
+        self.jitter = jitter
+        self.executor = ThreadPoolExecutor(worker_cnt, thread_name_prefix=name)
+        self.cond = threading.Condition()
+        # 元素为(到期时间, 序号, key)的小顶堆
+        self.due_heap = []
+        self.seq = 0
+        # key -> 当前有效的序号，堆中序号不一致的元素是已作废的
+        self.key_seq_dict = {}
+        self.running_set = set()
+        # 在检查过程中被要求立即再检查一次的key
+        self.triggered_set = set()
+        self.last_warn_time = 0
+
+        # 调度延迟的统计，调度延迟是指实际开始检查的时间比计划的时间晚了多少秒
+        self.dispatch_cnt = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+        self.last_lag = 0.0
+
+    def __push(self, key, due_time):
+        self.seq += 1
+        self.key_seq_dict[key] = self.seq
+        heapq.heappush(self.due_heap, (due_time, self.seq, key))
+        self.cond.notify()
+
+    def __next_delay(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def add(self, key, interval):
+        """
+        增加一个检查对象，第一次检查的时间在[0, interval]之间随机，防止启动时所有的检查同时进行
+        :return: 如果此对象已经在调度中，返回False
+        """
+        with self.cond:
+            if key in self.key_seq_dict or key in self.running_set:
+                return False
+            self.__push(key, time.time() + random.uniform(0, interval))
+            return True
+
+    def remove(self, key):
+        with self.cond:
+            self.key_seq_dict.pop(key, None)
+
+    def trigger(self, key):
+        """
+        让一个检查对象立即执行一次检查，如果此对象正在检查中，则在本次检查结束后立即再检查一次
+        :return: 如果此对象不在调度中，返回False
+        """
+        with self.cond:
+            if key in self.running_set:
+                self.triggered_set.add(key)
+                return True
+            if key not in self.key_seq_dict:
+                return False
+            self.__push(key, time.time())
+            return True
+
+    def has_key(self, key):
+        with self.cond:
+            return key in self.key_seq_dict or key in self.running_set
+
+    def get_stats(self):
+        """
+        获得调度的统计信息
+        """
+        with self.cond:
+            return {
+                'key_cnt': len(self.key_seq_dict) + len(self.running_set),
+                'running_cnt': len(self.running_set),
+                'worker_cnt': self.worker_cnt,
+                'dispatch_cnt': self.dispatch_cnt,
+                'lag_avg': self.lag_sum / self.dispatch_cnt if self.dispatch_cnt else 0.0,
+                'lag_max': self.lag_max,
+                'last_lag': self.last_lag,
+            }
+
+    def __run_check(self, key, due_time):
+        lag = time.time() - due_time
+        with self.cond:
+            self.dispatch_cnt += 1
+            self.lag_sum += lag
+            self.last_lag = lag
+            if lag > self.lag_max:
+                self.lag_max = lag
+            curr_time = time.time()
+            if lag > 2 and curr_time - self.last_warn_time > 60:
+                self.last_warn_time = curr_time
+                logging.warning(f"{self.name}: check of {key} is {lag:.1f} seconds behind schedule, "
+                                f"{len(self.running_set)}/{self.worker_cnt} workers busy.")
+
+        interval = None
+        try:
+            interval = self.check_func(key)
+        except Exception:
+            logging.error(f"{self.name}: Unexpected error occurred during check {key}: {traceback.format_exc()}")
+            interval = 10
+        finally:
+            with self.cond:
+                self.running_set.discard(key)
+                if interval is not None and not csuapp.is_exit():
+                    if key in self.triggered_set:
+                        self.__push(key, time.time())
+                    else:
+                        self.__push(key, time.time() + self.__next_delay(interval))
+                self.triggered_set.discard(key)
+
+    def run(self):
+        logging.info(f"{self.name}: scheduler started with {self.worker_cnt} workers.")
+        while not csuapp.is_exit():
+            with self.cond:
+                if not self.due_heap:
+                    self.cond.wait(1)
+                    continue
+                due_time, seq, key = self.due_heap[0]
+                if self.key_seq_dict.get(key) != seq:
+                    # 已经作废的元素
+                    heapq.heappop(self.due_heap)
+                    continue
+                wait_secs = due_time - time.time()
+                if wait_secs > 0:
+                    self.cond.wait(min(wait_secs, 1))
+                    continue
+                heapq.heappop(self.due_heap)
+                del self.key_seq_dict[key]
+                self.running_set.add(key)
+            self.executor.submit(self.__run_check, key, due_time)
+        self.executor.shutdown(wait=False)
+        logging.info(f"{self.name}: scheduler stopped.")
+
+    def start(self):
+        t = threading.Thread(target=self.run, name=f"{self.name}-scheduler")
+        t.setDaemon(True)  # 设置线程为后台线程
+        t.start()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 多台clup共享一个clup数据库时，把集群的健康检查分摊到各台clup上
+每台clup定时在clup_server_member表中写心跳，所有心跳正常的clup组成一个一致性哈希环，环上分给自己的集群，
+还需要在clup_cluster_owner表中获得这个集群的租约后才会检查，保证同一时刻一个集群只被一台clup检查。
+有clup加入或心跳超时后，哈希环发生变化，不再属于自己的集群会主动释放租约，新的属主在下一轮获得租约
+"""
+
+import bisect
+import hashlib
+import logging
+import threading
+import time
+import traceback
+
+import config
+import csuapp
+import dao
+import cluster_lease
+import dbapi
+import helpers
+
+# cluster_id -> 本地认为租约到期的时间，比数据库中的到期时间提前，防止本机时钟和数据库时钟的偏差导致两台clup同时检查
+__owned_dict = {}
+__owned_lock = threading.Lock()
+# 已经不属于自己但还没有释放租约的集群
+__releasing_set = set()
+__server_id = None
+__shard_thread = None
+
+
+def is_enabled():
+    return int(config.get('check_shard_enabled', 0)) == 1
+
+
+def get_server_id():
+    global __server_id
+    if __server_id is None:
+        server_id = config.get('server_id')
+        if not server_id:
+            my_ip, _my_mac = helpers.get_my_ip()
+            server_id = f"{my_ip}:{config.get('server_rpc_port')}"
+        __server_id = server_id
+    return __server_id
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    一致性哈希环，每个clup在环上有vnode_cnt个虚拟节点，clup加入或退出时只有少部分集群需要换属主
+    """
+
+    def __init__(self, server_id_list, vnode_cnt):
+        point_list = []
+        for server_id in server_id_list:
+            for i in range(vnode_cnt):
+                point_list.append((hash_key(f"{server_id}#{i}"), server_id))
+        point_list.sort()
+        self.hash_list = [p[0] for p in point_list]
+        self.server_list = [p[1] for p in point_list]
+
+    def get_owner(self, key):
+        if not self.hash_list:
+            return None
+        idx = bisect.bisect(self.hash_list, hash_key(key)) % len(self.hash_list)
+        return self.server_list[idx]
+
+
+def heartbeat(server_id):
+    my_ip, _my_mac = helpers.get_my_ip()
+    sql = "INSERT INTO clup_server_member(server_id, host, rpc_port, http_port, start_time, heartbeat_time) " \
+          " VALUES (%s, %s, %s, %s, now(), now()) " \
+          " ON CONFLICT (server_id) DO UPDATE SET host = EXCLUDED.host, rpc_port = EXCLUDED.rpc_port, " \
+          " http_port = EXCLUDED.http_port, heartbeat_time = now()"
+    dbapi.execute(sql, (server_id, my_ip, config.get('server_rpc_port'), config.get('http_port')))
+
+
+def get_member_list(member_ttl=None):
+    """
+    获得心跳正常的clup
+    """
+    if member_ttl is None:
+        member_ttl = int(config.get('check_shard_member_ttl', 15))
+    sql = "SELECT server_id, host, rpc_port, http_port, start_time, heartbeat_time, " \
+          " (SELECT count(*) FROM clup_cluster_owner o WHERE o.server_id = m.server_id AND o.lease_expire > now()) AS cluster_cnt " \
+          " FROM clup_server_member m WHERE heartbeat_time > now() - %s * interval '1 second' ORDER BY server_id"
+    return dbapi.query(sql, (member_ttl, ))
+
+
+def acquire_leases(server_id, cluster_id_list, lease_ttl):
+    """
+    获得或续期集群的租约，租约属于自己或已经过期时才能获得
+    :return: 返回获得了租约的集群列表
+    """
+    if not cluster_id_list:
+        return []
+    sql = "INSERT INTO clup_cluster_owner(cluster_id, server_id, lease_expire, epoch) " \
+          " SELECT cluster_id, %s, now() + %s * interval '1 second', 1 FROM unnest(%s::int[]) AS t(cluster_id) " \
+          " ON CONFLICT (cluster_id) DO UPDATE SET server_id = EXCLUDED.server_id, lease_expire = EXCLUDED.lease_expire, " \
+          "   epoch = CASE WHEN clup_cluster_owner.server_id = EXCLUDED.server_id " \
+          "           THEN clup_cluster_owner.epoch ELSE clup_cluster_owner.epoch + 1 END " \
+          " WHERE clup_cluster_owner.server_id = EXCLUDED.server_id OR clup_cluster_owner.lease_expire < now() " \
+          " RETURNING cluster_id"
+    rows = dbapi.query(sql, (server_id, lease_ttl, list(cluster_id_list)))
+    return [row['cluster_id'] for row in rows]
+
+
+def release_leases(server_id, cluster_id_list):
+    if not cluster_id_list:
+        return
+    sql = "DELETE FROM clup_cluster_owner WHERE server_id = %s AND cluster_id = ANY(%s::int[])"
+    dbapi.execute(sql, (server_id, list(cluster_id_list)))
+
+
+def is_owner(cluster_id):
+    """
+    本机是否负责检查这个集群，没有开启分摊时总是返回True
+    """
+    if not is_enabled():
+        return True
+    with __owned_lock:
+        expire_time = __owned_dict.get(cluster_id)
+    return expire_time is not None and time.time() < expire_time
+
+
+def get_owned_cluster_list():
+    now = time.time()
+    with __owned_lock:
+        return [cluster_id for cluster_id, expire_time in __owned_dict.items() if now < expire_time]
+
+
+def hold_check_lease(cluster_id, timeout):
+    """
+    获得集群的进程内租约，正在检查中的集群等检查结束，持有租约期间不会有新的检查开始
+    :return: 成功返回令牌，超时返回None
+    """
+    end_time = time.time() + timeout
+    while True:
+        token = cluster_lease.acquire(cluster_id, 'shard-release')
+        if token is not None or time.time() >= end_time:
+            return token
+        time.sleep(0.1)
+
+
+def rebalance(server_id):
+    lease_ttl = int(config.get('check_shard_lease_ttl', 15))
+    vnode_cnt = int(config.get('check_shard_vnode_cnt', 64))
+    begin_time = time.time()
+
+    heartbeat(server_id)
+    member_list = get_member_list()
+    server_id_list = [row['server_id'] for row in member_list]
+    if server_id not in server_id_list:
+        server_id_list.append(server_id)
+    ring = HashRing(server_id_list, vnode_cnt)
+
+    cluster_id_list = dao.get_cluster_id_list_by_type((1, 11))
+    my_cluster_list = [cluster_id for cluster_id in cluster_id_list if ring.get_owner(cluster_id) == server_id]
+    with __owned_lock:
+        not_mine_list = [cluster_id for cluster_id in __owned_dict if cluster_id not in my_cluster_list]
+
+    # 先在本地停止检查再释放租约，新的属主获得租约时本机一定已经不再检查了
+    with __owned_lock:
+        for cluster_id in not_mine_list:
+            __owned_dict.pop(cluster_id, None)
+            __releasing_set.add(cluster_id)
+        # 又分回给自己的集群不用再释放
+        __releasing_set.difference_update(my_cluster_list)
+        releasing_list = list(__releasing_set)
+
+    # 持有进程内的租约后再释放数据库中的租约：正在进行的检查先结束，之后开始的检查在持有租约后判断is_owner时已经不是属主了。
+    # 等待超时的集群留到下一轮再释放，这期间不再续期，最多lease_ttl秒后其他clup也能接管
+    wait_secs = int(config.get('check_shard_interval', 3))
+    hold_dict = {}
+    for cluster_id in releasing_list:
+        token = hold_check_lease(cluster_id, max(0, wait_secs - (time.time() - begin_time)))
+        if token is not None:
+            hold_dict[cluster_id] = token
+        else:
+            logging.info(f"Check shard: cluster({cluster_id}) is being checked, release it later.")
+    try:
+        if hold_dict:
+            release_list = list(hold_dict.keys())
+            logging.info(f"Check shard: release clusters {release_list} to other clup.")
+            release_leases(server_id, release_list)
+            with __owned_lock:
+                __releasing_set.difference_update(release_list)
+    finally:
+        for cluster_id, token in hold_dict.items():
+            cluster_lease.release(cluster_id, token)
+
+    owned_list = acquire_leases(server_id, my_cluster_list, lease_ttl)
+    # 本地的到期时间从发起续期前开始算，并且留出一个心跳周期的余量
+    local_expire_time = begin_time + lease_ttl - int(config.get('check_shard_interval', 3))
+    with __owned_lock:
+        new_list = [cluster_id for cluster_id in owned_list if cluster_id not in __owned_dict]
+        for cluster_id in list(__owned_dict.keys()):
+            if cluster_id not in owned_list:
+                del __owned_dict[cluster_id]
+        for cluster_id in owned_list:
+            __owned_dict[cluster_id] = local_expire_time
+    if new_list:
+        logging.info(f"Check shard: take over clusters {new_list}.")
+
+
+def shard_loop():
+    server_id = get_server_id()
+    logging.info(f"Check shard: started, server_id is {server_id}.")
+    while not csuapp.is_exit():
+        interval = int(config.get('check_shard_interval', 3))
+        begin_time = time.time()
+        try:
+            rebalance(server_id)
+        except Exception:
+            # 连接不上clup数据库时不能续期，本地的租约到期后自动停止检查
+            logging.error(f"Check shard: can not renew cluster leases: {traceback.format_exc()}")
+        sleep_secs = interval - (time.time() - begin_time)
+        if sleep_secs > 0:
+            time.sleep(sleep_secs)
+
+    # 正常退出时释放所有租约，其他clup不用等租约过期就可以接管
+    try:
+        release_leases(server_id, get_owned_cluster_list())
+    except Exception:
+        pass
+
+
+def start():
+    global __shard_thread
+    if not is_enabled() or __shard_thread is not None:
+        return
+    __shard_thread = threading.Thread(target=shard_loop, name="check-shard", daemon=True)
+    __shard_thread.start()
@@ -28,15 +28,20 @@ import os
 import sys
 import time
 
+import agent_tracker
+import api_cache
 import auto_upgrade
+import check_shard
 import config
 import csu_web_server
 import csuapp
 import dao
 import health_check
 import logger
+import metric_store
 import probe_db
 import psycopg2
+import repl_sampler
 import service_hander
 import sessions
 import ui_req_clup_adm
@@ -46,6 +51,7 @@ import ui_req_handler_ha
 import ui_req_handler_host
 import ui_req_handler_task
 import version
+import web_worker
 
 exit_flag = 0
 
@@ -102,7 +108,7 @@ def check_and_gen_handler():
                 sys.exit(-1)
             func_name_check_dict[k] = obj.__name__
         ui_api_dict.update(hdict)
-    return ui_api_dict
+    return api_cache.wrap_handler_dict(ui_api_dict)
 
 
 def check_and_start_csumdb():
@@ -141,6 +147,11 @@ def start(foreground):
     # 在csuapp.prepare_run之前创建的线程锁、数据库连接在后续的子进程中会异常。
     csuapp.prepare_run('clup', foreground)
 
+    # 用多个进程提供web服务时，在启动任何线程之前fork出web管理进程
+    listen_addr = ("0.0.0.0", config.getint('http_port'))
+    if web_worker.is_enabled():
+        web_worker.start_master(config.get_web_root(), listen_addr, ui_api_dict)
+
     probe_db.start_service()
 
     # start csumdb
@@ -169,15 +180,37 @@ def start(foreground):
     dao.recover_pending()
     logging.info("database recover pending finished.")
 
+    # 初始化已完成，web管理进程可以启动web工作进程了
+    web_worker.notify_ready()
+
+    # 多台clup分摊检查时，启动分配集群的线程
+    check_shard.start()
+
     # 启动检查进程
     logging.info("Start ha checking thread... ")
     health_check.start_check()
 
-    csu_web_server.start(config.get_web_root(),
-                         ("0.0.0.0", config.getint('http_port')),
-                         ui_api_dict,
-                         sessions,
-                         csuapp.is_exit)
+    # 启动流复制延迟的后台采样线程
+    repl_sampler.start()
+
+    # 启动时序指标的持久化线程
+    metric_store.start()
+
+    # 启动定时检查各主机上agent是否正常的线程
+    agent_tracker.start()
+
+    if not web_worker.is_enabled():
+        csu_web_server.start(config.get_web_root(),
+                             listen_addr,
+                             ui_api_dict,
+                             sessions,
+                             csuapp.is_exit,
+                             int(config.get('http_backlog', 128)),
+                             int(config.get('http_worker_cnt', 32)),
+                             int(config.get('http_idle_timeout', 60)),
+                             gzip_min_size=int(config.get('http_gzip_min_size', 1024)),
+                             gzip_level=int(config.get('http_gzip_level', 1)),
+                             request_timeout=int(config.get('http_request_timeout', 60)))
 
 
     while not csuapp.is_exit():
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 集群的进程内租约，健康检查期间持有租约来防止对集群的并发操作，不再为此把集群状态改成CHECKING再改回来
+每次获得租约都会分配一个递增的令牌(token)，本进程中其他线程在持有期间直接修改了集群状态时，持有者的令牌被作废，
+持有者之后不能再用这个令牌写集群状态(见dao.set_cluster_state_with_token，写入时还会用数据库中当前的状态做条件，
+其他进程修改了集群状态时也不会被覆盖)。持有租约的线程还在运行时，租约不会过期，切换等操作超过cluster_lease_ttl也不会被其他检查打破。
+用多个进程提供web服务时，还会对每个集群加一个文件锁，使web工作进程中的操作与主进程中的检查互斥
+"""
+
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import config
+
+
+class ClusterLease:
+    def __init__(self, cluster_id, name, token, ttl):
+        self.cluster_id = cluster_id
+        self.name = name
+        self.token = token
+        self.owner = threading.get_ident()
+        self.owner_thread = threading.current_thread()
+        # 同一个线程可以重复获得租约
+        self.depth = 1
+        self.expire_time = time.time() + ttl
+        self.fenced = False
+
+
+# cluster_id -> ClusterLease
+__lease_dict = {}
+__lease_lock = threading.Lock()
+__token_seq = 0
+# cluster_id -> 锁文件的fd，用多个进程提供web服务时，web工作进程中的操作和主进程中的检查用文件锁互斥
+__lock_fd_dict = {}
+
+
+def __lock_file(cluster_id):
+    if int(config.get('http_worker_process_cnt', 0)) <= 0:
+        return True
+    fd = __lock_fd_dict.get(cluster_id)
+    if fd is None:
+        lock_dir = os.path.join(tempfile.gettempdir(), 'clup_lease')
+        os.makedirs(lock_dir, exist_ok=True)
+        fd = os.open(os.path.join(lock_dir, str(cluster_id)), os.O_RDWR | os.O_CREAT, 0o600)
+        __lock_fd_dict[cluster_id] = fd
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def __unlock_file(cluster_id):
+    fd = __lock_fd_dict.get(cluster_id)
+    if fd is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def acquire(cluster_id, name):
+    """
+    获得集群的租约，租约被其他线程持有并且没有过期时立即返回
+    :return: 成功返回令牌，失败返回None
+    """
+    global __token_seq
+
+    ttl = int(config.get('cluster_lease_ttl', 300))
+    with __lease_lock:
+        lease = __lease_dict.get(cluster_id)
+        if lease is not None:
+            if lease.owner == threading.get_ident():
+                lease.depth += 1
+                return lease.token
+            if time.time() < lease.expire_time:
+                return None
+            # 持有者还在运行(如切换时间较长)时自动续期，只有持有的线程已经退出时才打破租约
+            if lease.owner_thread.is_alive():
+                lease.expire_time = time.time() + ttl
+                logging.warning(f"Cluster({cluster_id}): lease held by {lease.name} is older than {ttl} seconds, "
+                                "but the holder is still running, renew it.")
+                return None
+            logging.warning(f"Cluster({cluster_id}): lease held by {lease.name} expired and the holder has exited, break it.")
+        if not __lock_file(cluster_id):
+            return None
+        __token_seq += 1
+        __lease_dict[cluster_id] = ClusterLease(cluster_id, name, __token_seq, ttl)
+        return __token_seq
+
+
+def release(cluster_id, token):
+    with __lease_lock:
+        lease = __lease_dict.get(cluster_id)
+        if lease is None or lease.token != token:
+            return
+        lease.depth -= 1
+        if lease.depth <= 0:
+            del __lease_dict[cluster_id]
+            __unlock_file(cluster_id)
+
+
+def is_valid(cluster_id, token):
+    """
+    令牌是否仍然有效，租约被其他人打破或被作废后返回False
+    """
+    with __lease_lock:
+        lease = __lease_dict.get(cluster_id)
+        return lease is not None and lease.token == token and not lease.fenced
+
+
+def fence(cluster_id):
+    """
+    集群状态被直接修改了，如果租约由其他线程持有，则作废其令牌
+    """
+    with __lease_lock:
+        lease = __lease_dict.get(cluster_id)
+        if lease is not None and lease.owner != threading.get_ident() and not lease.fenced:
+            lease.fenced = True
+            logging.info(f"Cluster({cluster_id}): state changed by other thread, lease held by {lease.name} is invalidated.")
+
+
+def get_holder_name(cluster_id):
+    with __lease_lock:
+        lease = __lease_dict.get(cluster_id)
+        return lease.name if lease is not None else None
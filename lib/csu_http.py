@@ -23,10 +23,12 @@
 """
 
 
+import gzip
 import mimetypes
 import posixpath
 import socket
 import struct
+import threading
 import time
 
 import email.utils
@@ -222,6 +224,58 @@ def reply_http(conn, http_code, body_data, hdr=None):
     conn.sendall(http_msg)
 
 
+class HttpBody:
+    """
+    http响应的内容，gzip压缩后的结果保存在对象中，同一个对象被多次发送时(如被缓存的响应)只压缩一次
+    """
+
+    def __init__(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.data = data
+        self.gz_data = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return self.data.decode(errors='replace')
+
+    def get_gzip_data(self, level):
+        with self.lock:
+            if self.gz_data is None:
+                self.gz_data = gzip.compress(self.data, level)
+            return self.gz_data
+
+
+def reply_http_body(conn, http_code, body, accept_encoding, gzip_min_size, gzip_level):
+    """
+    发送响应，客户端支持gzip并且内容不小于gzip_min_size时压缩后再发送
+    :param body: HttpBody对象或字符串
+    :param gzip_min_size: 设置为0表示不压缩
+    """
+    if not isinstance(body, HttpBody):
+        body = HttpBody(body)
+    if gzip_min_size <= 0 or len(body.data) < gzip_min_size:
+        reply_http(conn, http_code, body.data)
+        return
+    hdr = {"Vary": "Accept-Encoding"}
+    if accept_encoding and 'gzip' in accept_encoding:
+        hdr['Content-Encoding'] = 'gzip'
+        reply_http(conn, http_code, body.get_gzip_data(gzip_level), hdr)
+    else:
+        reply_http(conn, http_code, body.data, hdr)
+
+
+def send_http_header(conn, http_code, content_length, hdr):
+    """
+    只发送http头，body由调用者自己发送(如用sendfile)
+    """
+    reason_phrase = code_to_phrase(http_code)
+    hdr_msg = "HTTP/1.1 %s %s\r\nContent-Length: %d" % (http_code, reason_phrase, content_length)
+    for key in hdr:
+        hdr_msg += "\r\n%s: %s" % (key, hdr[key])
+    conn.sendall(hdr_msg.encode() + b"\r\n\r\n")
+
+
 def recv_headers(conn):
     """
     接受http header的数据
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: web服务的静态文件缓存，文件内容和gzip压缩后的内容都缓存在内存中，用ETag和Last-Modified支持304
+"""
+
+import collections
+import email.utils
+import gzip
+import os
+import threading
+import time
+
+import csu_http
+
+# 这些类型的文件没有.gz文件时，在内存中压缩一份
+COMPRESSIBLE_TYPE_PREFIX_LIST = ['text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml']
+# 小于此大小的文件不压缩
+MIN_COMPRESS_SIZE = 1024
+
+
+class StaticFile:
+    def __init__(self, real_path, st):
+        self.real_path = real_path
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.ctype = csu_http.guess_type(real_path)
+        self.etag = '"%x-%x"' % (st.st_size, st.st_mtime_ns)
+        self.last_modified = csu_http.date_time_string(st.st_mtime)
+        # 内容，超过缓存大小的文件为None，发送时用sendfile
+        self.body = None
+        # gzip压缩后的内容，或者.gz文件的路径(太大时)
+        self.gz_body = None
+        self.gz_path = None
+        self.check_time = time.time()
+
+    def cached_size(self):
+        return len(self.body or b'') + len(self.gz_body or b'')
+
+    def is_compressible(self):
+        return self.size >= MIN_COMPRESS_SIZE and any(self.ctype.startswith(t) for t in COMPRESSIBLE_TYPE_PREFIX_LIST)
+
+
+class StaticCache:
+    """
+    按文件路径缓存，最近最少使用的文件先被淘汰，缓存的文件每隔check_interval秒才重新stat一次看是否有变化
+    """
+
+    def __init__(self, max_file_size=1024 * 1024, max_total_size=64 * 1024 * 1024, check_interval=2):
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+        self.check_interval = check_interval
+        self.total_size = 0
+        self.file_dict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __load(self, real_path, st):
+        static_file = StaticFile(real_path, st)
+        gz_path = real_path + '.gz'
+        try:
+            gz_st = os.stat(gz_path)
+            # .gz文件比原文件旧时不使用
+            if gz_st.st_mtime < st.st_mtime:
+                gz_st = None
+        except OSError:
+            gz_st = None
+
+        if st.st_size <= self.max_file_size:
+            with open(real_path, 'rb') as f:
+                static_file.body = f.read()
+        if gz_st is not None:
+            if gz_st.st_size <= self.max_file_size:
+                with open(gz_path, 'rb') as f:
+                    static_file.gz_body = f.read()
+            else:
+                static_file.gz_path = gz_path
+        elif static_file.body is not None and static_file.is_compressible():
+            gz_body = gzip.compress(static_file.body, 6)
+            if len(gz_body) < len(static_file.body):
+                static_file.gz_body = gz_body
+        return static_file
+
+    def get(self, real_path):
+        """
+        :return: 返回StaticFile，文件不存在时返回None
+        """
+        now = time.time()
+        with self.lock:
+            static_file = self.file_dict.get(real_path)
+            if static_file is not None and now - static_file.check_time < self.check_interval:
+                self.file_dict.move_to_end(real_path)
+                return static_file
+
+        try:
+            st = os.stat(real_path)
+        except OSError:
+            st = None
+        if st is None or not os.path.isfile(real_path):
+            with self.lock:
+                old_file = self.file_dict.pop(real_path, None)
+                if old_file is not None:
+                    self.total_size -= old_file.cached_size()
+            return None
+
+        if static_file is not None and static_file.mtime_ns == st.st_mtime_ns and static_file.size == st.st_size:
+            static_file.check_time = now
+            return static_file
+
+        try:
+            static_file = self.__load(real_path, st)
+        except OSError:
+            return None
+        with self.lock:
+            old_file = self.file_dict.pop(real_path, None)
+            if old_file is not None:
+                self.total_size -= old_file.cached_size()
+            self.file_dict[real_path] = static_file
+            self.total_size += static_file.cached_size()
+            while self.total_size > self.max_total_size and len(self.file_dict) > 1:
+                _path, evicted = self.file_dict.popitem(last=False)
+                self.total_size -= evicted.cached_size()
+        return static_file
+
+
+def is_not_modified(static_file, req_hdr):
+    """
+    根据If-None-Match和If-Modified-Since判断客户端缓存的内容是否还有效
+    """
+    if_none_match = req_hdr.get('if-none-match')
+    if if_none_match:
+        etag_list = [etag.strip() for etag in if_none_match.split(',')]
+        # 客户端可能发送弱校验的W/前缀
+        return '*' in etag_list or static_file.etag in etag_list or f"W/{static_file.etag}" in etag_list
+    if_modified_since = req_hdr.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since_time = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(static_file.mtime) <= since_time
+    return False
+
@@ -25,13 +25,18 @@
 import json
 import logging
 import os
+import queue
+import selectors
 import socket
 import threading
+import time
 import traceback
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from http.cookies import SimpleCookie
 
 import csu_http
+import csu_static
 import csu_web_default_handler
 
 logger = logging.getLogger('csuhttpd')
@@ -44,49 +49,97 @@ for __attr in __v1_ui_handler_attr_list:
         default_handler_func_dict[__attr] = __obj
 
 
-def http_do_head(req):
+# 带hash的文件名的静态文件(如assets/AgentStatusView.8ff579c4.js)内容不会变化，让浏览器长期缓存
+IMMUTABLE_PATH_PREFIX = '/assets/'
 
-    ctype = csu_http.guess_type(req.path)
-    real_path = os.path.join(req.web_root, req.path[1:])
-    try:
-        f = open(real_path, 'rb')
-    except OSError:
-        csu_http.reply_http(req.conn, 404, "File not found")
-        return
+g_static_cache = csu_static.StaticCache()
 
-    fs = os.fstat(f.fileno())
-    f.close()
-    hdr = {"Content-Type": ctype, "Last-Modified": csu_http.date_time_string(fs.st_mtime)}
-    csu_http.reply_http(req.conn, 200, '', hdr)
+# API的响应不小于此字节数时，如果客户端支持就用gzip压缩，设置为0表示不压缩
+g_gzip_min_size = 1024
+# 压缩级别低一些，压缩率差别不大，但压缩耗时少很多
+g_gzip_level = 1
 
 
-def http_do_get(req):
+def get_static_real_path(web_root, url_path):
+    """
+    把url路径转换成web_root下的文件路径，路径跳出web_root时返回None
+    """
+    url_path = urllib.parse.unquote(url_path)
+    root = os.path.realpath(web_root)
+    real_path = os.path.realpath(os.path.join(root, url_path.lstrip('/')))
+    if real_path != root and not real_path.startswith(root + os.sep):
+        return None
+    return real_path
+
+
+def send_static_file(req, is_head):
     url_path = req.path.split('?')[0]
     if url_path == '/':
         url_path = '/index.html'
-    hdr = {}
-    accept_encoding = req.headers.get('accept-encoding')
-    ctype = csu_http.guess_type(url_path)
-    hdr["content-type"] = ctype
-    url_path = urllib.parse.unquote(url_path)
-    ori_real_path = os.path.join(req.web_root, url_path[1:])
-    real_path = ori_real_path
-    if 'gzip' in accept_encoding:
-        if ori_real_path[-3:] == '.js' or ori_real_path[-4:] == '.css':
-            gz_real_path = '%s.gz' % ori_real_path
-            if os.path.exists(gz_real_path):
-                hdr['Content-Encoding'] = 'gzip'
-                real_path = gz_real_path
+    real_path = get_static_real_path(req.web_root, url_path)
+    static_file = g_static_cache.get(real_path) if real_path else None
+    if static_file is None:
+        csu_http.reply_http(req.conn, 404, "File not found")
+        return
+
+    hdr = {
+        "content-type": static_file.ctype,
+        "Last-Modified": static_file.last_modified,
+        "ETag": static_file.etag,
+    }
+    if url_path.startswith(IMMUTABLE_PATH_PREFIX):
+        hdr["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        # 如index.html，每次都需要到服务器上验证，内容没有变化时返回304
+        hdr["Cache-Control"] = "no-cache"
+    has_gzip = static_file.gz_body is not None or static_file.gz_path is not None
+    if has_gzip:
+        hdr["Vary"] = "Accept-Encoding"
+
+    if csu_static.is_not_modified(static_file, req.headers):
+        csu_http.send_http_header(req.conn, 304, 0, hdr)
+        return
+
+    accept_encoding = req.headers.get('accept-encoding', '')
+    if has_gzip and 'gzip' in accept_encoding:
+        hdr['Content-Encoding'] = 'gzip'
+        body_data = static_file.gz_body
+        send_path = static_file.gz_path
+    else:
+        body_data = static_file.body
+        send_path = static_file.real_path
+
+    if body_data is not None:
+        if is_head:
+            csu_http.send_http_header(req.conn, 200, len(body_data), hdr)
+        else:
+            csu_http.reply_http(req.conn, 200, body_data, hdr)
+        return
+
+    # 大文件不缓存在内存中，用sendfile直接从文件发送到socket
     try:
-        f = open(real_path, 'rb')
+        f = open(send_path, 'rb')
     except OSError:
         csu_http.reply_http(req.conn, 404, "File not found")
         return
-    body_data = f.read()
-    fs = os.fstat(f.fileno())
-    f.close()
-    hdr["Last-Modified"] = csu_http.date_time_string(fs.st_mtime)
-    csu_http.reply_http(req.conn, 200, body_data, hdr)
+    with f:
+        content_length = os.fstat(f.fileno()).st_size
+        csu_http.send_http_header(req.conn, 200, content_length, hdr)
+        if not is_head:
+            req.conn.sendfile(f, 0, content_length)
+
+
+def http_do_head(req):
+    send_static_file(req, True)
+
+
+def http_do_get(req):
+    send_static_file(req, False)
+
+
+def reply_api(req, http_code, body_data):
+    csu_http.reply_http_body(req.conn, http_code, body_data, req.headers.get('accept-encoding'),
+                             g_gzip_min_size, g_gzip_level)
 
 
 def http_do_post(req):
@@ -165,17 +218,22 @@ def http_do_post(req):
             req.session_data = msg
 
             user_name = req.session_data['user_name']
-            logger.debug(f"Recv http request [{user_name}] {func_name}({repr(req_params)})")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Recv http request [{user_name}] {func_name}({repr(req_params)})")
             func_obj = http_handler[func_name]
             http_code, body_data = func_obj(req)
-            logger.debug(f"Reply request [{user_name}] {func_name}({repr(req_params)}): {http_code}, {body_data}")
-            csu_http.reply_http(req.conn, http_code, body_data)
+            # 没有打开调试日志时不要格式化返回内容，HttpBody转成字符串时需要解码整个响应
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Reply request [{user_name}] {func_name}({repr(req_params)}): {http_code}, {body_data}")
+            reply_api(req, http_code, body_data)
         else:
-            logger.debug(f"Recv http request {func_name}({repr(req_params)})")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Recv http request {func_name}({repr(req_params)})")
             func_obj = http_handler[func_name]
             http_code, body_data = func_obj(req)
-            logger.debug(f"Reply request {func_name}({repr(req_params)}): {http_code}, {body_data}")
-            csu_http.reply_http(req.conn, http_code, body_data)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Reply request {func_name}({repr(req_params)}): {http_code}, {body_data}")
+            reply_api(req, http_code, body_data)
         return
     except BrokenPipeError:
         logger.debug(f"Recv http request BrokenPipeError: {traceback.format_exc()}.")
@@ -207,92 +265,200 @@ class HttpReq:
         self.session_handler = session_handler
 
 
-class ProcessThread(threading.Thread):
-    def __init__(self, client_socket, client_addr, web_root, http_handler, session_handler, g_exit_func):
-        threading.Thread.__init__(self, name="csu-web-server-process")
+class HttpConn:
+    """
+    一个keep-alive的客户端连接，空闲时注册在selector中，收到请求后交给工作线程处理，处理完再放回selector
+    """
+
+    def __init__(self, client_socket, client_addr):
         self.socket = client_socket
         self.addr = client_addr
-        self.web_root = web_root
-        self.http_handler = http_handler
-        self.session_handler = session_handler
-        self.g_exit_func = g_exit_func
+        self.origin_source = "%s:%s" % (client_addr[0], client_addr[1])
+        self.last_active_time = time.time()
 
-    def run(self):
-        origin_source = "%s:%s" % (self.addr[0], self.addr[1])
-        pre_msg = "http(%s)" % origin_source
-        logger.debug(f"Recv http {pre_msg} request.")
-        csu_http.set_keepalive_linux(self.socket)
-        while not self.g_exit_func():
-            err_code, http_dict = csu_http.recv_headers(self.socket)
-            if err_code != 0:
-                logger.debug(f"Invalid http request(close connection): {http_dict}.")
-                self.socket.close()
-                break
+    def close(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
 
-            http_method = http_dict['method']
-            hdr = http_dict['hdr']
-
-            http_req = HttpReq(self.web_root,
-                               self.socket,
-                               origin_source,
-                               http_method,
-                               hdr,
-                               http_dict['path'],
-                               http_dict['partial_body'],
-                               self.g_exit_func,
-                               self.http_handler,
-                               self.session_handler
-                               )
-
-            if 'upgrade' in hdr and 'sec-websocket-version' in hdr:
-                csu_http.reply_http(self.socket, 400, "not support websocket: %s" % http_method)
-            elif http_method == 'HEAD':
-                http_do_head(http_req)
-            elif http_method == 'GET':
-                http_do_get(http_req)
-            elif http_method == 'POST':
-                http_do_post(http_req)
-            else:
-                csu_http.reply_http(self.socket, 400, "invalid method: %s" % http_method)
-
-        logger.debug(f"{pre_msg}: closed.")
+
+def process_request(http_conn, web_root, http_handler, session_handler, g_exit_func):
+    """
+    在工作线程中处理连接上的一个请求
+    :return: 返回True表示连接可以继续使用，返回False表示连接已关闭
+    """
+    client_socket = http_conn.socket
+    pre_msg = "http(%s)" % http_conn.origin_source
+    try:
+        err_code, http_dict = csu_http.recv_headers(client_socket)
+    except OSError as e:
+        err_code, http_dict = -1, repr(e)
+    if err_code != 0:
+        logger.debug(f"{pre_msg}: invalid http request(close connection): {http_dict}.")
+        http_conn.close()
+        return False
+
+    http_method = http_dict['method']
+    hdr = http_dict['hdr']
+
+    http_req = HttpReq(web_root,
+                       client_socket,
+                       http_conn.origin_source,
+                       http_method,
+                       hdr,
+                       http_dict['path'],
+                       http_dict['partial_body'],
+                       g_exit_func,
+                       http_handler,
+                       session_handler
+                       )
+    try:
+        if 'upgrade' in hdr and 'sec-websocket-version' in hdr:
+            csu_http.reply_http(client_socket, 400, "not support websocket: %s" % http_method)
+        elif http_method == 'HEAD':
+            http_do_head(http_req)
+        elif http_method == 'GET':
+            http_do_get(http_req)
+        elif http_method == 'POST':
+            http_do_post(http_req)
+        else:
+            csu_http.reply_http(client_socket, 400, "invalid method: %s" % http_method)
+    except OSError as e:
+        logger.debug(f"{pre_msg}: reply failed(close connection): {repr(e)}.")
+        http_conn.close()
+        return False
+    if hdr.get('connection', '').lower() == 'close':
+        http_conn.close()
+        return False
+    return True
 
 
 class WebServerMainThread(threading.Thread):
-    def __init__(self, web_root, listen_addr, http_handler, session_handler, g_exit_func):
+    """
+    在一个线程中用selector监听端口和所有空闲的keep-alive连接，连接上有请求到达时，交给固定数量的工作线程处理，
+    不再为每个连接创建一个线程
+    """
+
+    def __init__(self, web_root, listen_addr, http_handler, session_handler, g_exit_func,
+                 backlog=128, worker_cnt=32, idle_timeout=60, request_timeout=60, reuse_port=False):
         global default_handler_func_dict
         threading.Thread.__init__(self, name="csu_main_web_server_thread")
         self.web_root = web_root
         self.listen_addr = listen_addr
-        self.http_handler = http_handler
         self.session_handler = session_handler
         self.exit_func = g_exit_func
         self.http_handler = {}
         self.http_handler.update(default_handler_func_dict)
         self.http_handler.update(http_handler)
+        self.backlog = backlog
+        self.worker_cnt = worker_cnt
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.reuse_port = reuse_port
+        self.selector = selectors.DefaultSelector()
+        self.executor = None
+        # 工作线程处理完请求后，把连接放到这个队列中，再通过wakeup_w唤醒selector重新注册
+        self.return_queue = queue.SimpleQueue()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+
+    def __accept(self, server_socket):
+        try:
+            client_socket, client_addr = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        csu_http.set_keepalive_linux(client_socket)
+        # 工作线程中用阻塞的方式读写，设置超时防止一个慢的客户端一直占用工作线程
+        client_socket.settimeout(self.request_timeout)
+        http_conn = HttpConn(client_socket, client_addr)
+        logger.debug(f"Recv http({http_conn.origin_source}) request.")
+        self.selector.register(client_socket, selectors.EVENT_READ, http_conn)
+
+    def __run_request(self, http_conn):
+        try:
+            is_alive = process_request(http_conn, self.web_root, self.http_handler, self.session_handler, self.exit_func)
+        except Exception:
+            logger.warning(f"http({http_conn.origin_source}): unexpected error: {traceback.format_exc()}.")
+            http_conn.close()
+            is_alive = False
+        if not is_alive:
+            logger.debug(f"http({http_conn.origin_source}): closed.")
+            return
+        http_conn.last_active_time = time.time()
+        self.return_queue.put(http_conn)
+        try:
+            self.wakeup_w.send(b'x')
+        except OSError:
+            pass
+
+    def __register_returned(self):
+        try:
+            self.wakeup_r.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                http_conn = self.return_queue.get_nowait()
+            except queue.Empty:
+                break
+            if self.exit_func():
+                http_conn.close()
+                continue
+            self.selector.register(http_conn.socket, selectors.EVENT_READ, http_conn)
+
+    def __close_idle(self):
+        now = time.time()
+        for key in list(self.selector.get_map().values()):
+            http_conn = key.data
+            if not isinstance(http_conn, HttpConn):
+                continue
+            if now - http_conn.last_active_time > self.idle_timeout:
+                logger.debug(f"http({http_conn.origin_source}): idle timeout, closed.")
+                self.selector.unregister(http_conn.socket)
+                http_conn.close()
 
     def run(self):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # 多个web工作进程监听同一个端口，由内核把新连接分给各个进程
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         csu_http.set_keepalive_linux(server_socket)
         server_socket.bind(self.listen_addr)
-        server_socket.listen(5)
-        logging.info(f"csu web server listen at {repr(self.listen_addr)} ...")
+        server_socket.listen(self.backlog)
+        server_socket.setblocking(False)
+        self.wakeup_r.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, 'listen')
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, 'wakeup')
+        self.executor = ThreadPoolExecutor(self.worker_cnt, thread_name_prefix="csu-web-server-process")
+        logging.info(f"csu web server listen at {repr(self.listen_addr)}(backlog={self.backlog}, workers={self.worker_cnt}) ...")
+
+        last_idle_check_time = time.time()
         while not self.exit_func():
-            try:
-                client_socket, client_addr = server_socket.accept()
-            except socket.timeout:
-                continue
-            thd = ProcessThread(client_socket,
-                                client_addr,
-                                self.web_root,
-                                self.http_handler,
-                                self.session_handler,
-                                self.exit_func)
-            thd.start()
-
-
-def start(web_root, listen_addr, http_handler, session_handler, exit_func):
+            for key, _mask in self.selector.select(timeout=1):
+                if key.data == 'listen':
+                    self.__accept(server_socket)
+                elif key.data == 'wakeup':
+                    self.__register_returned()
+                else:
+                    # 请求处理期间连接不在selector中，同一个连接上的请求不会被两个工作线程同时处理
+                    self.selector.unregister(key.fileobj)
+                    self.executor.submit(self.__run_request, key.data)
+            if time.time() - last_idle_check_time >= 1:
+                self.__close_idle()
+                last_idle_check_time = time.time()
+
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, HttpConn):
+                key.data.close()
+        self.selector.close()
+        server_socket.close()
+        self.executor.shutdown(wait=False)
+
+
+def start(web_root, listen_addr, http_handler, session_handler, exit_func,
+          backlog=128, worker_cnt=32, idle_timeout=60, reuse_port=False, gzip_min_size=1024, gzip_level=1,
+          request_timeout=60):
     """
 
     :param web_root:  web服务的根目录，此目录下的是静态html文件
@@ -300,8 +466,21 @@ def start(web_root, listen_addr, http_handler, session_handler, exit_func):
     :param http_handler: 处理post请求的处理函数字典
     :param session_handler: session的处理对象，至少要实现函数check_session和session_is_valid
     :param exit_func:
+    :param backlog: 监听端口的backlog
+    :param worker_cnt: 处理请求的工作线程数
+    :param idle_timeout: keep-alive连接空闲超过此秒数后关闭
+    :param reuse_port: 是否设置SO_REUSEPORT，多个进程监听同一个端口时使用
+    :param gzip_min_size: API的响应不小于此字节数时用gzip压缩，设置为0表示不压缩
+    :param gzip_level: gzip压缩级别
+    :param request_timeout: 工作线程读写一个请求时socket的超时秒数
     :return:
     """
+    global g_gzip_min_size
+    global g_gzip_level
+
     logging.info("Starting web server...")
-    web_thread = WebServerMainThread(web_root, listen_addr, http_handler, session_handler, exit_func)
+    g_gzip_min_size = gzip_min_size
+    g_gzip_level = gzip_level
+    web_thread = WebServerMainThread(web_root, listen_addr, http_handler, session_handler, exit_func,
+                                     backlog, worker_cnt, idle_timeout, request_timeout, reuse_port=reuse_port)
     web_thread.start()
@@ -26,6 +26,8 @@ import json
 import logging
 from concurrent.futures import ThreadPoolExecutor
 
+import api_cache
+import cluster_lease
 import database_state
 import db_encrypt
 import dbapi
@@ -49,8 +51,12 @@ def get_version():
 
 
 def recover_pending():
+    # 状态4: "Checking"只是旧版本在健康检查期间设置的状态，现在检查期间用集群租约，不再设置此状态，
+    # 旧版本异常退出时遗留的这个状态直接改回1: "Online"，否则集群不会再被检查
+    dbapi.execute('UPDATE clup_cluster SET state = 1 WHERE state = 4')
+
     # 状态2: "Reparing", 3: "Failover" 都是中间状态，如果clup都重启了，这些状态都改成-1，即"Failed"失败状态
-    sql = 'UPDATE clup_cluster SET state = -1 WHERE state in (2,3,4)'
+    sql = 'UPDATE clup_cluster SET state = -1 WHERE state in (2,3)'
     dbapi.execute(sql)
 
     # 这是任务状态0表示正在运行，也是一个临时状态，当clup重启后，需要把状态都改成-1
@@ -199,6 +205,12 @@ def get_cluster_id_list():
     return cluster_id_list
 
 
+def get_cluster_id_list_by_type(cluster_type_list):
+    sql = "SELECT cluster_id FROM clup_cluster WHERE cluster_type = ANY(%s)"
+    rows = dbapi.query(sql, (list(cluster_type_list), ))
+    return [row['cluster_id'] for row in rows]
+
+
 def get_cluster_db_ip_list(cluster_id):
     rows = dbapi.query(
         "SELECT host FROM clup_db where cluster_id=%s and is_primary=0",
@@ -242,7 +254,8 @@ def add_cluster(cluster_dict):
                     "values(%s,%s,%s,%s,%s,%s,%s)",
                     (cluster_id, i['state'], i['pgdata'], i['is_primary'],
                      i['repl_app_name'], i['host'], i['repl_ip']))
-        return cluster_id
+    api_cache.invalidate()
+    return cluster_id
 
 
 def set_cluster_state(cluster_id, state):
@@ -251,9 +264,11 @@ def set_cluster_state(cluster_id, state):
     :param state:
     :return:
     """
+    cluster_lease.fence(cluster_id)
     dbapi.execute(
         "UPDATE clup_cluster SET state = %s WHERE cluster_id=%s",
         (state, cluster_id))
+    api_cache.invalidate()
 
 
 def test_and_set_cluster_state(cluster_id, test_state_list, set_state):
@@ -262,15 +277,40 @@ def test_and_set_cluster_state(cluster_id, test_state_list, set_state):
     :param state:
     :return: 返回None表示，没有找到状态的值，否则返回之前的状态
     """
-    str_in_cond = ', '.join([str(k) for k in test_state_list])
+    # 集群正在被检查时(租约被健康检查持有)，与集群处于CHECKING状态时一样，不能修改状态
+    token = cluster_lease.acquire(cluster_id, 'set-state')
+    if token is None:
+        return None
+    try:
+        str_in_cond = ', '.join([str(k) for k in test_state_list])
+
+        rows = dbapi.query(
+            f"UPDATE clup_cluster a SET state = %s FROM clup_cluster b WHERE a.cluster_id=b.cluster_id and a.cluster_id=%s AND a.state in ({str_in_cond}) RETURNING b.state",
+            (set_state, cluster_id))
+    finally:
+        cluster_lease.release(cluster_id, token)
+    if len(rows) < 1:
+        return None
+    else:
+        api_cache.invalidate()
+        return rows[0]['state']
+
 
+def set_cluster_state_with_token(cluster_id, token, test_state_list, set_state):
+    """
+    持有集群租约的线程修改集群状态，令牌已经作废，或数据库中的状态已经不在test_state_list中(被其他进程修改了)时不修改
+    :return: 返回None表示没有修改，否则返回之前的状态
+    """
+    if not cluster_lease.is_valid(cluster_id, token):
+        return None
+    str_in_cond = ', '.join([str(k) for k in test_state_list])
     rows = dbapi.query(
         f"UPDATE clup_cluster a SET state = %s FROM clup_cluster b WHERE a.cluster_id=b.cluster_id and a.cluster_id=%s AND a.state in ({str_in_cond}) RETURNING b.state",
         (set_state, cluster_id))
     if len(rows) < 1:
         return None
-    else:
-        return rows[0]['state']
+    api_cache.invalidate()
+    return rows[0]['state']
 
 
 def set_cluster_data_attr(cluster_id, attr, value):
@@ -311,6 +351,7 @@ def set_cluster_db_state(cluster_id, db_id, state):
     if len(rows) < 1:
         return False
     else:
+        api_cache.invalidate()
         return True
 
 
@@ -379,6 +420,15 @@ def get_hid(ip):
         return rows[0]['hid']
 
 
+def get_cluster_id_list_by_host(host):
+    """
+    获得在此主机上有数据库的集群
+    """
+    sql = "SELECT DISTINCT cluster_id FROM clup_db WHERE host=%s AND cluster_id IS NOT NULL"
+    rows = dbapi.query(sql, (host, ))
+    return [row['cluster_id'] for row in rows]
+
+
 def get_is_primary(ip):
     """
     查看是否是主库
@@ -739,6 +789,7 @@ def get_up_db(db_id):
 def update_up_db_id(up_db_id, db_id, is_primary):
     sql = f"UPDATE clup_db SET up_db_id = {up_db_id}, is_primary = {is_primary} WHERE db_id = %s"
     dbapi.execute(sql, (db_id,))
+    api_cache.invalidate()
 
 
 def get_current_wal_lsn(conn):
@@ -795,6 +846,7 @@ def get_cluster_name(cluster_id):
 def set_node_state(db_id, state):
     sql = "UPDATE clup_db SET state=%s WHERE db_id=%s"
     dbapi.execute(sql, (state, db_id))
+    api_cache.invalidate()
 
 
 def update_ha_state(db_id, state):
@@ -807,6 +859,7 @@ def update_ha_state(db_id, state):
         dbapi.execute(sql, (state, db_id))
     except Exception as e:
         return -1, f'Failed to update HA status: {repr(e)}'
+    api_cache.invalidate()
     return 0, ''
 
 
@@ -22,14 +22,41 @@
 @description: 操作数据库
 """
 
+import collections
+import logging
+import os
+import threading
 import traceback
 
 import config
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 import psycopg2.pool
 
 
+class CachedConnection(psycopg2.extensions.connection):
+    """
+    带prepared语句缓存的连接，缓存是每个连接独有的，因为PREPARE的语句只在当前会话中有效
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # sql -> (语句名, 参数个数)，按最近使用的顺序排列，最久未使用的在最前面
+        self.prepared_stmts = collections.OrderedDict()
+        # sql -> 执行次数，执行次数达到阈值后才做PREPARE，值为None表示此SQL不能PREPARE
+        self.sql_use_cnt = collections.OrderedDict()
+        self.stmt_seq = 0
+
+
+# 连接池: db_host -> 空闲连接的列表，连接用完后放回池中，避免每次执行SQL都重新连接数据库
+__pool_dict = {}
+__pool_lock = threading.Lock()
+__pool_pid = os.getpid()
+# fork出的子进程中继承下来的连接，不能在子进程中关闭（会把父进程的连接也断开），只能放在这里不再使用
+__orphan_conn_list = []
+
+
 def connect_db(host=None):
     if host:
         db_host = host
@@ -44,6 +71,207 @@ def connect_db(host=None):
     return conn
 
 
+def get_pool_conn(host=None):
+    """
+    从连接池中获得一个连接，如果池中没有空闲的连接，则新建一个连接
+    :return: 返回两个值，第一个值是连接，第二个值表示此连接是否是从池中复用的
+    """
+    global __pool_pid
+
+    pool_key = host if host else ''
+    __pool_lock.acquire()
+    try:
+        if __pool_pid != os.getpid():
+            # 在fork出的子进程中，池中的连接是从父进程继承过来的，不能再使用
+            for conn_list in __pool_dict.values():
+                __orphan_conn_list.extend(conn_list)
+            __pool_dict.clear()
+            __pool_pid = os.getpid()
+        conn_list = __pool_dict.get(pool_key)
+        while conn_list:
+            conn = conn_list.pop()
+            if not conn.closed:
+                return conn, True
+    finally:
+        __pool_lock.release()
+
+    return new_pool_conn(host), False
+
+
+def new_pool_conn(host=None):
+    """
+    新建一个可以放入连接池中的连接
+    """
+    if host:
+        db_host = host
+    else:
+        db_host = config.get('db_host')
+    conn = psycopg2.connect(database=config.get('db_name'), user=config.get('db_user'),
+                            password=config.get("db_pass"), host=db_host, port=config.get('db_port'),
+                            connection_factory=CachedConnection)
+    return conn
+
+
+def put_pool_conn(conn, host=None, discard=False):
+    """
+    把连接放回连接池，如果连接已坏或池中空闲的连接已经足够多了，则关闭连接
+    """
+
+    pool_key = host if host else ''
+    max_idle = int(config.get('db_pool_max_idle', 10))
+    if not discard and not conn.closed \
+            and conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        __pool_lock.acquire()
+        try:
+            if __pool_pid == os.getpid():
+                conn_list = __pool_dict.setdefault(pool_key, [])
+                if len(conn_list) < max_idle:
+                    conn_list.append(conn)
+                    return
+        finally:
+            __pool_lock.release()
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def to_prepare_sql(sql):
+    """
+    把psycopg2格式的SQL（用%s做绑定变量）转换成PREPARE需要的格式（用$1、$2做绑定变量）
+    :return: 返回转换后的SQL和绑定变量的个数，如果此SQL不能做PREPARE，返回None
+    """
+
+    stripped_sql = sql.strip().rstrip(';')
+    words = stripped_sql.split(None, 1)
+    if not words or words[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'VALUES'):
+        return None
+    # 有$的SQL可能使用了$$这样的引号，有;的可能是多条SQL，都不做PREPARE
+    if '$' in stripped_sql or ';' in stripped_sql:
+        return None
+
+    new_sql = []
+    param_cnt = 0
+    i = 0
+    sql_len = len(stripped_sql)
+    while i < sql_len:
+        c = stripped_sql[i]
+        if c != '%':
+            new_sql.append(c)
+            i += 1
+            continue
+        next_c = stripped_sql[i + 1] if i + 1 < sql_len else ''
+        if next_c == 's':
+            param_cnt += 1
+            new_sql.append(f'${param_cnt}')
+        elif next_c == '%':
+            new_sql.append('%')
+        else:
+            # %(name)s 这样的命名绑定变量不支持
+            return None
+        i += 2
+    return ''.join(new_sql), param_cnt
+
+
+def __deallocate_stmt(cur, stmt_name):
+    try:
+        cur.execute(f"DEALLOCATE {stmt_name}")
+    except Exception:
+        pass
+
+
+def get_prepared_stmt(conn, cur, sql, args):
+    """
+    如果sql执行的次数达到阈值，则在当前连接上PREPARE此SQL
+    :return: 返回(语句名, 参数个数)，如果此SQL还没有(或不能)PREPARE，返回None
+    """
+
+    cache_size = int(config.get('db_prepare_cache_size', 32))
+    if cache_size <= 0 or not isinstance(conn, CachedConnection):
+        return None
+    if not isinstance(args, (tuple, list)):
+        return None
+
+    stmt = conn.prepared_stmts.get(sql)
+    if stmt:
+        conn.prepared_stmts.move_to_end(sql)
+        return stmt
+
+    threshold = int(config.get('db_prepare_threshold', 3))
+    if sql in conn.sql_use_cnt:
+        use_cnt = conn.sql_use_cnt.pop(sql)
+        if use_cnt is None:
+            conn.sql_use_cnt[sql] = None
+            return None
+        use_cnt += 1
+    else:
+        use_cnt = 1
+    conn.sql_use_cnt[sql] = use_cnt
+    # 拼接了常量的SQL每次都不一样，所以计数的SQL也要限制数量
+    while len(conn.sql_use_cnt) > cache_size * 8:
+        conn.sql_use_cnt.popitem(last=False)
+    if use_cnt < threshold:
+        return None
+
+    # 只在没有事务时才做PREPARE，这样PREPARE失败时回滚不会影响到调用者已执行的SQL
+    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return None
+
+    ret = to_prepare_sql(sql)
+    if ret is None or ret[1] != len(args):
+        conn.sql_use_cnt[sql] = None
+        return None
+    prepare_sql, param_cnt = ret
+
+    while len(conn.prepared_stmts) >= cache_size:
+        _old_sql, (old_stmt_name, _old_param_cnt) = conn.prepared_stmts.popitem(last=False)
+        __deallocate_stmt(cur, old_stmt_name)
+
+    conn.stmt_seq += 1
+    stmt_name = f"clup_stmt_{conn.stmt_seq}"
+    try:
+        cur.execute(f"PREPARE {stmt_name} AS {prepare_sql}")
+    except psycopg2.Error as e:
+        conn.rollback()
+        conn.sql_use_cnt[sql] = None
+        logging.debug(f"Can not prepare sql({sql}): {str(e)}")
+        return None
+    stmt = (stmt_name, param_cnt)
+    conn.prepared_stmts[sql] = stmt
+    return stmt
+
+
+def cursor_execute(conn, cur, sql, args=()):
+    """
+    执行SQL，如果此SQL已经PREPARE了，则使用EXECUTE执行
+    """
+
+    in_trans = conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    stmt = get_prepared_stmt(conn, cur, sql, args)
+    if not stmt:
+        cur.execute(sql, args)
+        return
+
+    stmt_name, param_cnt = stmt
+    if param_cnt:
+        execute_sql = f"EXECUTE {stmt_name}({', '.join(['%s'] * param_cnt)})"
+    else:
+        execute_sql = f"EXECUTE {stmt_name}"
+    try:
+        cur.execute(execute_sql, args)
+    except psycopg2.Error as e:
+        # 表结构发生了变化时，会报错: cached plan must not change result type，此时需要重新PREPARE
+        if e.pgcode != '0A000':
+            raise
+        conn.rollback()
+        conn.prepared_stmts.pop(sql, None)
+        __deallocate_stmt(cur, stmt_name)
+        conn.rollback()
+        if in_trans:
+            raise
+        cur.execute(sql, args)
+
+
 
 # 当同时需要执行有多个SQL时，可以放到with DBProcess() as dbp这个with块中，这样只连接数据库一次
 class DBProcess:
@@ -61,8 +289,11 @@ class DBProcess:
 
     def __init__(self, db_host=None):
         self.err_msg = ''
-        self.conn = connect_db(host=db_host)
+        self.db_host = db_host
+        self.conn, self.is_reused = get_pool_conn(host=db_host)
         self.cur = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        self.is_executed = False
+        self.is_broken = False
 
     # DBProcess 支持 with 语句
     def __enter__(self):
@@ -72,20 +303,41 @@ class DBProcess:
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type:  # 有异常回滚
             self.err_msg = traceback.format_exception(exc_type, exc_val, exc_tb)
-            self.conn.rollback()
+            try:
+                self.conn.rollback()
+            except psycopg2.Error:
+                self.is_broken = True
             self.close()
             return False
         # 无异常 则 commit 提交
         self.conn.commit()
         self.close()
 
+    def __run(self, sql, args):
+        try:
+            cursor_execute(self.conn, self.cur, sql, args)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # 池中的连接可能因为数据库重启等原因已经断开了，如果是本次的第一条SQL，则换一个新连接重试一次
+            if not self.is_reused or self.is_executed:
+                self.is_broken = True
+                raise
+            put_pool_conn(self.conn, self.db_host, discard=True)
+            self.conn, self.is_reused = new_pool_conn(host=self.db_host), False
+            self.cur = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            try:
+                self.cur.execute(sql, args)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.is_broken = True
+                raise
+        self.is_executed = True
+
     # 如果execute 失败 raise InternalError
     def query(self, sql, args=()):
-        self.cur.execute(sql, args)
+        self.__run(sql, args)
         return self.cur.fetchall()
 
     def execute(self, sql, args=()):
-        self.cur.execute(sql, args)
+        self.__run(sql, args)
 
     def rollback(self):
         self.conn.rollback()
@@ -95,10 +347,13 @@ class DBProcess:
 
     def close(self):
         if self.cur:
-            self.cur.close()
+            try:
+                self.cur.close()
+            except Exception:
+                self.is_broken = True
             self.cur = None
         if self.conn:
-            self.conn.close()
+            put_pool_conn(self.conn, self.db_host, discard=self.is_broken)
             self.conn = None
 
 
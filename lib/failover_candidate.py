@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 故障切换候选备库表，在每个检查周期中刷新各集群中备库的最后LSN、复制延迟、机房和主机是否能连接等信息，
+    主库故障时可以直接从这个表中选出新主库，只需要再确认一下排在前面的备库的LSN，不需要在切换时再去逐个收集所有备库的信息。
+    LSN使用后台采样线程(repl_sampler)的结果，没有采样结果时才按ha_candidate_refresh_interval的间隔自己连接数据库获取
+"""
+
+import logging
+import threading
+import time
+
+import config
+import db_encrypt
+import node_state
+import pg_db_lib
+import probe_db
+import repl_sampler
+
+# cluster_id -> {'update_time': 获取lsn的时间, 'live_time': 最后一次自己连接数据库获取lsn的时间,
+#                'primary_lsn': 主库的lsn, 'candidate_list': [候选备库]}
+__candidate_dict = {}
+__candidate_lock = threading.Lock()
+
+
+def get_refresh_interval():
+    return int(config.get('ha_candidate_refresh_interval', 60))
+
+
+def get_sampled_lsn(cluster_id):
+    """
+    从后台采样线程的结果中获得各数据库的lsn
+    :return: 返回(sample_time, lsn_dict)，没有采样结果时返回(None, None)
+    """
+    item = repl_sampler.get_sample_item(cluster_id, 'last_lsn')
+    if item is None:
+        return None, None
+    sample_time, data = item
+    lsn_dict = {}
+    for db_id, _host, _is_primary, time_line, str_lsn in data:
+        # 获取失败或不是正常状态的数据库，lsn为'error'或'unknown'
+        if isinstance(str_lsn, str) and '/' in str_lsn:
+            lsn_dict[db_id] = (pg_db_lib.lsn_to_int(str_lsn), time_line)
+    return sample_time, lsn_dict
+
+
+def collect_lsn(cluster_dict, clu_db_list, lsn_db_list):
+    cluster_id = cluster_dict['cluster_id']
+    db_port = cluster_dict['port']
+    time_out = int(cluster_dict.get('probe_timeout', 10))
+    repl_user = clu_db_list[0]['repl_user']
+    repl_pass = db_encrypt.from_db_text(clu_db_list[0]['repl_pass'])
+    lsn_req_list = [(db['host'], db_port, repl_user, repl_pass) for db in lsn_db_list]
+    lsn_dict = {}
+    for idx, err_code, str_lsn, time_line in probe_db.get_last_lsn_of_list(lsn_req_list, time_out):
+        if err_code != 0:
+            logging.debug(f"Cluster({cluster_id}): get lsn of db({lsn_db_list[idx]['host']}:{db_port}) failed: {str_lsn}")
+            continue
+        lsn_dict[lsn_db_list[idx]['db_id']] = (pg_db_lib.lsn_to_int(str_lsn), time_line)
+    return lsn_dict
+
+
+def refresh(cluster_dict, clu_db_list, snapshot):
+    """
+    刷新一个集群的候选备库表，lsn优先使用后台采样的结果，检查周期中不再每次都连接各个数据库
+    :param snapshot: health_check中本周期收集的主机状态快照，用于判断备库所在的主机是否能连接
+    """
+
+    cluster_id = cluster_dict['cluster_id']
+    pri_db = None
+    stb_list = []
+    for db in clu_db_list:
+        if db['state'] != node_state.NORMAL:
+            continue
+        if db['is_primary']:
+            pri_db = db
+        else:
+            stb_list.append(db)
+
+    now = time.time()
+    with __candidate_lock:
+        table = __candidate_dict.get(cluster_id)
+    live_time = table['live_time'] if table else 0
+    update_time, lsn_dict = get_sampled_lsn(cluster_id)
+    if lsn_dict is None:
+        refresh_interval = get_refresh_interval()
+        if refresh_interval <= 0 or now - live_time < refresh_interval:
+            # 没有采样结果，也没到自己获取lsn的时间，只更新主机是否能连接，lsn保持不变，候选表过时后切换时会重新获取所有备库的lsn
+            if table:
+                with __candidate_lock:
+                    for c in table['candidate_list']:
+                        c['host_is_ok'] = snapshot.host_is_ok(c['host'])
+            return
+        lsn_db_list = stb_list if pri_db is None else stb_list + [pri_db]
+        lsn_dict = collect_lsn(cluster_dict, clu_db_list, lsn_db_list)
+        update_time = now
+        live_time = now
+
+    primary_lsn = None
+    if pri_db is not None and pri_db['db_id'] in lsn_dict:
+        primary_lsn = lsn_dict[pri_db['db_id']][0]
+
+    candidate_list = []
+    for db in stb_list:
+        lsn, time_line = lsn_dict.get(db['db_id'], (None, None))
+        replay_lag = None
+        if lsn is not None and primary_lsn is not None:
+            replay_lag = max(0, primary_lsn - lsn)
+        candidate_list.append({
+            'db_id': db['db_id'],
+            'host': db['host'],
+            'pgdata': db['pgdata'],
+            'scores': db.get('scores') if db.get('scores') else 0,
+            'room_id': str(db.get('room_id', '0')),
+            'host_is_ok': snapshot.host_is_ok(db['host']),
+            'lsn': lsn,
+            'time_line': time_line,
+            'replay_lag': replay_lag,
+        })
+
+    with __candidate_lock:
+        __candidate_dict[cluster_id] = {
+            'update_time': update_time,
+            'live_time': live_time,
+            'primary_lsn': primary_lsn,
+            'candidate_list': candidate_list,
+        }
+
+
+def remove_cluster(cluster_id):
+    with __candidate_lock:
+        __candidate_dict.pop(cluster_id, None)
+
+
+def get_candidate_table(cluster_id):
+    with __candidate_lock:
+        return __candidate_dict.get(cluster_id)
+
+
+def get_ranked_candidates(cluster_id, db_id_list, max_age):
+    """
+    按切换时选择新主库的规则排好序的候选备库：scores值越小越优先，scores相同时lsn越大越优先
+    :param db_id_list: 只在这些备库中选择
+    :param max_age: 候选表超过这么多秒没有刷新，认为已经过时，返回None
+    :return: 候选备库的列表，只包括主机能连接并且获得了lsn的备库，候选表不存在或过时时返回None
+    """
+    with __candidate_lock:
+        table = __candidate_dict.get(cluster_id)
+        if table is None or time.time() - table['update_time'] > max_age:
+            return None
+        candidate_list = [dict(c) for c in table['candidate_list']]
+
+    candidate_list = [c for c in candidate_list if c['db_id'] in db_id_list and c['host_is_ok'] and c['lsn'] is not None]
+    candidate_list.sort(key=lambda c: (c['scores'], -c['lsn']))
+    return candidate_list
+
+
+def get_max_age(probe_interval):
+    """
+    候选表中的lsn可能来自后台采样，采样结果最多三个采样周期没有更新
+    """
+    return 3 * max(probe_interval, repl_sampler.get_sample_interval())
+
+
+def is_enabled():
+    return int(config.get('ha_use_candidate_table', 1)) != 0
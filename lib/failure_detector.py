@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 数据库节点的故障检测模块，按phi accrual的方法，根据探测成功的时间间隔的历史分布计算节点的怀疑程度(phi)，
+    phi越大说明节点越可能已经故障，同时根据怀疑程度调整探测的频率：正常时按配置的间隔探测，有怀疑时加密探测
+"""
+
+import collections
+import math
+import threading
+import time
+
+import config
+
+# 保留的历史记录的个数
+HISTORY_SIZE = 100
+
+
+class PhiAccrualDetector:
+    """
+    一个数据库节点的故障检测器，每次探测后调用record_success或record_failure记录探测结果
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE):
+        # 两次探测成功之间的时间间隔
+        self.interval_list = collections.deque(maxlen=history_size)
+        # 探测成功时的响应时间
+        self.latency_list = collections.deque(maxlen=history_size)
+        self.last_success_time = 0
+        self.last_latency = 0
+        self.fail_cnt = 0
+        # 是否处于加密探测中，加密探测时的间隔不能代表正常的探测间隔
+        self.fast_probe = False
+        self.lock = threading.Lock()
+
+    def record_success(self, latency, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if self.last_success_time:
+                interval = now - self.last_success_time
+                # 中间停止过检查(如集群被设置为维护状态)时的间隔、加密探测时的间隔不能代表正常的探测间隔，不记录
+                if not self.fast_probe and (not self.interval_list or interval < 10 * self.__mean(self.interval_list)):
+                    self.interval_list.append(interval)
+            self.last_success_time = now
+            self.last_latency = latency
+            self.latency_list.append(latency)
+            self.fail_cnt = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.fail_cnt += 1
+
+    def reset(self):
+        with self.lock:
+            self.interval_list.clear()
+            self.latency_list.clear()
+            self.last_success_time = 0
+            self.last_latency = 0
+            self.fail_cnt = 0
+            self.fast_probe = False
+
+    @staticmethod
+    def __mean(value_list):
+        return sum(value_list) / len(value_list)
+
+    @staticmethod
+    def __std(value_list, mean):
+        return math.sqrt(sum((v - mean) ** 2 for v in value_list) / len(value_list))
+
+    def phi(self, now=None):
+        """
+        计算当前的怀疑程度，phi=1表示误判的概率约为10%，phi=2约为1%，phi=3约为0.1%，依此类推
+        :return: 没有足够的历史数据时返回None
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not self.last_success_time or len(self.interval_list) < 3:
+                return None
+            mean = self.__mean(self.interval_list)
+            # 探测间隔通常很稳定，标准差太小时会导致偶尔的延迟就使phi变得很大，所以给标准差设置一个下限
+            std = max(self.__std(self.interval_list, mean), mean * 0.1, 0.5)
+            elapsed = now - self.last_success_time
+
+        # 用logistic函数近似正态分布的累积分布函数
+        y = (elapsed - mean) / std
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if elapsed > mean:
+            p_later = e / (1.0 + e)
+        else:
+            p_later = 1.0 - 1.0 / (1.0 + e)
+        if p_later <= 1e-300:
+            return 300.0
+        return -math.log10(p_later)
+
+    def is_suspect(self):
+        """
+        最近有探测失败，或响应时间明显变长时，认为节点可疑
+        """
+        with self.lock:
+            if self.fail_cnt > 0:
+                return True
+            if len(self.latency_list) < 10:
+                return False
+            mean = self.__mean(self.latency_list)
+            std = self.__std(self.latency_list, mean)
+            return self.last_latency > mean + 3 * std + 0.1
+
+
+__detector_dict = {}
+__detector_lock = threading.Lock()
+
+
+def get_detector(db_id):
+    with __detector_lock:
+        detector = __detector_dict.get(db_id)
+        if detector is None:
+            detector = PhiAccrualDetector()
+            __detector_dict[db_id] = detector
+        return detector
+
+
+def remove_detector(db_id):
+    with __detector_lock:
+        __detector_dict.pop(db_id, None)
+
+
+def reset_detector(db_id):
+    """
+    数据库重启或切换后，之前的探测历史不再有意义，需要重新开始记录
+    """
+    with __detector_lock:
+        detector = __detector_dict.get(db_id)
+    if detector is not None:
+        detector.reset()
+
+
+def get_phi(db_id):
+    with __detector_lock:
+        detector = __detector_dict.get(db_id)
+    if detector is None:
+        return None
+    return detector.phi()
+
+
+def get_phi_threshold():
+    return float(config.get('ha_phi_threshold', 8))
+
+
+def get_max_fail_cnt(min_fail_cnt):
+    """
+    怀疑程度(phi)一直没有超过阈值时，最多连续探测失败的次数
+    """
+    return 2 * int(min_fail_cnt)
+
+
+def is_failed(db_id, fail_cnt, min_fail_cnt):
+    """
+    判断一个节点是否已经故障，phi不会让判断提前，只会推迟：
+    连续失败min_fail_cnt次后，如果phi还没有超过阈值(历史上的探测间隔本来就不稳定)，继续探测，最多到get_max_fail_cnt次
+    :param fail_cnt: 本次检查中连续探测失败的次数
+    :param min_fail_cnt: 至少连续失败这么多次才认为故障，即配置的probe_retry_cnt
+    """
+    if fail_cnt < min_fail_cnt:
+        return False
+    if fail_cnt >= get_max_fail_cnt(min_fail_cnt):
+        return True
+    phi = get_phi(db_id)
+    if phi is None:
+        return True
+    return phi >= get_phi_threshold()
+
+
+def get_next_interval(db_id_list, probe_interval):
+    """
+    根据集群中各节点的怀疑程度计算下一次检查的间隔，有可疑的节点时按1/4的间隔加密探测
+    """
+    with __detector_lock:
+        detector_list = [__detector_dict[db_id] for db_id in db_id_list if db_id in __detector_dict]
+    fast_probe = any(detector.is_suspect() for detector in detector_list)
+    # 加密探测期间测得的探测间隔不记录到历史中，否则会拉低平均间隔，使phi偏大
+    for detector in detector_list:
+        with detector.lock:
+            detector.fast_probe = fast_probe
+    if fast_probe:
+        return max(1, probe_interval // 4)
+    return probe_interval
@@ -28,10 +28,13 @@ import logging
 import time
 import traceback
 
+import agent_tracker
 import cluster_state
 import dao
 import database_state
 import db_encrypt
+import failover_candidate
+import failure_detector
 import general_task_mgr
 import lb_mgr
 import node_state
@@ -80,14 +83,23 @@ def failover_sr_cluster(cluster_id, pg, db_port, err_msg_list):
     for err_msg in err_msg_list:
         general_task_mgr.log_info(task_id, err_msg)
     general_task_mgr.log_info(task_id, message)
+    phi = failure_detector.get_phi(db_id)
+    if phi is not None:
+        general_task_mgr.log_info(task_id, f"Cluster({cluster_id}): database({pg['host']}:{db_port}) suspicion level phi={phi:.1f}, "
+                                  f"threshold={failure_detector.get_phi_threshold()}")
 
     host_is_ok = False
-    err_code, err_msg = rpc_utils.get_rpc_connect(pg['host'])
-    if err_code == 0:
-        host_is_ok = True
-        rpc = err_msg
-        rpc.close()
-        rpc = None
+    # 只相信一个检查周期内的结果，否则仍然连接agent确认
+    if agent_tracker.is_host_down(pg['host'], max_interval_cnt=1):
+        # 后台检查agent的结果是主机连接不上，不用再等待一次连接超时
+        task_log_info(task_id, f"Cluster({cluster_id}): agent on host({pg['host']}) is down.")
+    else:
+        err_code, err_msg = rpc_utils.get_rpc_connect(pg['host'])
+        if err_code == 0:
+            host_is_ok = True
+            rpc = err_msg
+            rpc.close()
+            rpc = None
 
     cnt = 0
     retry_cnt = 3
@@ -123,7 +135,8 @@ def failover_sr_cluster(cluster_id, pg, db_port, err_msg_list):
             err_msg = f"Cluster({cluster_id}): can not start database({pg['host']}:{db_port}), failover ..."
             task_log_info(task_id, err_msg)
         else:
-            # 重启数据库成功
+            # 重启数据库成功，之前的探测历史不再有意义
+            failure_detector.reset_detector(db_id)
             err_msg = f"Cluster({cluster_id}): successful start up database({pg['host']}:{db_port})"
             general_task_mgr.complete_task(task_id, 1, err_msg)
             return 0, err_msg
@@ -131,15 +144,8 @@ def failover_sr_cluster(cluster_id, pg, db_port, err_msg_list):
         task_log_info(task_id, f"Cluster({cluster_id}): Host({pg['host']}) is not ok, failover database({pg['host']}:{db_port})...")
 
     ping_ip_list = dao.get_cluster_db_ip_list(cluster_id)
-    island = True
-    for ip in ping_ip_list:
-        res = ping_lib.ping_ip(ip, 2, 3)
-        if res == -1:
-            # dao.set_cluster_db_state(cluster_id, bad_db_dict['db_id'], node_state.UNKNOWN)
-            continue
-        else:
-            island = False
-            break
+    # 同时ping所有的IP，任何一个能ping通就说明自己不是孤岛
+    island = not ping_lib.is_any_ip_reachable(ping_ip_list, 2, 3)
 
     if island:
         err_msg = "Clup became Isolated network, so can not failover."
@@ -166,6 +172,7 @@ def failover_sr_cluster(cluster_id, pg, db_port, err_msg_list):
     if err_code < 0:
         general_task_mgr.complete_task(task_id, -1, err_msg)
     else:
+        failure_detector.reset_detector(db_id)
         general_task_mgr.complete_task(task_id, 1, err_msg)
     return err_code, err_msg
 
@@ -313,6 +320,91 @@ def failover_standby_db(task_id, cluster_id, db_id):
     return 0, msg
 
 
+def select_new_primary(task_id, pre_msg, all_good_stb_db, db_port, repl_user, repl_pass):
+    """
+    并发获得所有备库的lsn，选择新主库
+    :param all_good_stb_db: 已经按scores排好序的备库
+    :return: (new_pri_pg, new_pri_lsn, max_lsn_pg, max_lsn)
+    """
+    new_pri_lsn = 0
+    new_pri_pg = None
+    new_pri_rank = None
+    max_lsn = 0
+    max_lsn_pg = None
+    # 并发获得所有备库的lsn，谁先返回就先处理谁
+    lsn_req_list = [(p['host'], db_port, repl_user, repl_pass) for p in all_good_stb_db]
+    for idx, err_code, str_lsn, _ in probe_db.get_last_lsn_of_list(lsn_req_list):
+        p = all_good_stb_db[idx]
+        if err_code != 0:
+            task_log_info(task_id, f"{pre_msg}: db({ p['host']}:{db_port}) probe failed! {str_lsn}")
+            continue
+
+        lsn = pg_db_lib.lsn_to_int(str_lsn)
+        if lsn > max_lsn:
+            max_lsn = lsn
+            max_lsn_pg = p
+        rank = (p['scores'], -lsn, idx)
+        if new_pri_rank is None or rank < new_pri_rank:
+            new_pri_rank = rank
+            new_pri_lsn = lsn
+            new_pri_pg = p
+    return new_pri_pg, new_pri_lsn, max_lsn_pg, max_lsn
+
+
+def select_new_primary_from_candidates(task_id, pre_msg, cluster_id, all_good_stb_db, db_port, repl_user, repl_pass, max_age):
+    """
+    按健康检查中维护的候选备库表的scores选择新主库，所有备库的lsn都需要实时获取，
+    候选表中的lsn可能已经过时，不能用它们判断哪个备库的数据最新
+    :return: (new_pri_pg, new_pri_lsn, max_lsn_pg, max_lsn)，候选表不可用或有备库的lsn获取失败时返回None
+    """
+    stb_dict = {p['db_id']: p for p in all_good_stb_db}
+    candidate_list = failover_candidate.get_ranked_candidates(cluster_id, stb_dict.keys(), max_age)
+    if not candidate_list:
+        return None
+
+    # 并发获取所有备库的实时lsn，生成器要全部取完，不能中途返回
+    lsn_req_list = [(p['host'], db_port, repl_user, repl_pass) for p in all_good_stb_db]
+    lsn_ret_list = list(probe_db.get_last_lsn_of_list(lsn_req_list))
+    live_lsn_dict = {}
+    for idx, err_code, str_lsn, _ in lsn_ret_list:
+        p = all_good_stb_db[idx]
+        if err_code != 0:
+            task_log_info(task_id, f"{pre_msg}: get lsn of db({p['host']}:{db_port}) failed, {str_lsn}, "
+                          "select new primary without candidate table ...")
+            return None
+        live_lsn_dict[p['db_id']] = pg_db_lib.lsn_to_int(str_lsn)
+    if len(live_lsn_dict) != len(all_good_stb_db):
+        return None
+    for c in candidate_list:
+        if live_lsn_dict[c['db_id']] < c['lsn']:
+            host = stb_dict[c['db_id']]['host']
+            task_log_info(task_id, f"{pre_msg}: lsn of candidate db({host}:{db_port}) is less than last known, "
+                          "select new primary without candidate table ...")
+            return None
+
+    # scores最优的候选备库中选择实时lsn最大的，lsn也相同时按候选表中的顺序
+    top_scores = candidate_list[0]['scores']
+    top_list = [c for c in candidate_list if c['scores'] == top_scores]
+    new_pri_c = top_list[0]
+    for c in top_list[1:]:
+        if live_lsn_dict[c['db_id']] > live_lsn_dict[new_pri_c['db_id']]:
+            new_pri_c = c
+    new_pri_pg = stb_dict[new_pri_c['db_id']]
+    new_pri_lsn = live_lsn_dict[new_pri_c['db_id']]
+    task_log_info(task_id, f"{pre_msg}: select candidate db({new_pri_pg['host']}:{db_port}) from candidate table, "
+                  f"lsn={pg_db_lib.int_to_lsn(new_pri_lsn)}")
+
+    # 其它备库的lsn如果比新主库的还大，需要先从这个备库同步wal
+    max_lsn = new_pri_lsn
+    max_lsn_pg = new_pri_pg
+    for p in all_good_stb_db:
+        lsn = live_lsn_dict[p['db_id']]
+        if lsn > max_lsn:
+            max_lsn = lsn
+            max_lsn_pg = p
+    return new_pri_pg, new_pri_lsn, max_lsn_pg, max_lsn
+
+
 def failover_primary_db(task_id, cluster_id, db_id):
     db = dao.get_db_info(db_id)
     clu_db_list = dao.get_cluster_db_list(cluster_id)
@@ -388,36 +480,16 @@ def failover_primary_db(task_id, cluster_id, db_id):
     repl_user = clu_db_list[0]['repl_user']
     repl_pass = db_encrypt.from_db_text(clu_db_list[0]['repl_pass'])
 
-    new_pri_lsn = 0
-    new_pri_pg = None
-    new_pri_scores = 0
     new_read_vip_host = ''
-    max_lsn = 0
-    max_lsn_pg = None
-    # 先根据scores排序，scores值越大，优先级越低
+    # 先根据scores排序，scores值越大，优先级越低，scores相同时选择lsn最大的
     all_good_stb_db.sort(key=lambda x: x['scores'], reverse=False)
-    for p in all_good_stb_db:
-        err_code, str_lsn, _ = probe_db.get_last_lsn(p['host'], db_port, repl_user, repl_pass)
-        if err_code != 0:
-            task_log_info(task_id, f"{pre_msg}: db({ p['host']}:{db_port}) probe failed! {str_lsn}")
-            continue
-
-        lsn = pg_db_lib.lsn_to_int(str_lsn)
-        if lsn > max_lsn:
-            max_lsn = lsn
-            max_lsn_pg = p
-        # 第一次时，先把new_pri_pg设置为第一个备库
-        if not new_pri_pg:
-            new_pri_scores = p['scores']
-            new_pri_lsn = lsn
-            new_pri_pg = p
-            continue
-
-        if p['scores'] == new_pri_scores:
-            if lsn > new_pri_lsn:
-                new_pri_lsn = lsn
-                new_pri_pg = p
-                continue
+    ret = None
+    if failover_candidate.is_enabled():
+        max_age = failover_candidate.get_max_age(int(cluster_dict.get('probe_interval', 10)))
+        ret = select_new_primary_from_candidates(task_id, pre_msg, cluster_id, all_good_stb_db, db_port, repl_user, repl_pass, max_age)
+    if ret is None:
+        ret = select_new_primary(task_id, pre_msg, all_good_stb_db, db_port, repl_user, repl_pass)
+    new_pri_pg, new_pri_lsn, max_lsn_pg, max_lsn = ret
 
     if not new_pri_pg:
         bad_db_dict['state'] = node_state.FAULT
@@ -430,7 +502,7 @@ def failover_primary_db(task_id, cluster_id, db_id):
 
     # 如果新主库的lsn落后max_lsn_pg，则需要把新主库先与最大max_lsn_pg同步
     # 先把新主库关掉，然后把旧主库上比较新的xlog文件都拷贝过来：
-    if max_lsn > lsn:
+    if max_lsn > new_pri_lsn:
         task_log_info(task_id, f"{pre_msg}: stop new pirmary database then sync wal from max lsn standby({max_lsn_pg['host']}) ... ")
         # 停掉新主库
         err_code, err_msg = pg_db_lib.stop(new_pri_pg['host'], new_pri_pg['pgdata'])
@@ -46,6 +46,7 @@ import ping_lib
 import polar_helpers
 import polar_lib
 import probe_db
+import repl_sampler
 import rpc_utils
 import task_type_def
 
@@ -65,7 +66,10 @@ def log_error(task_id, msg):
     general_task_mgr.log_error(task_id, msg)
 
 
-def get_last_lsn(cluster_id):
+def collect_last_lsn(cluster_id):
+    """
+    连接各个数据库获得最后的LSN，由后台采样线程定期调用，结果见get_last_lsn
+    """
     clu_db_list = dao.get_cluster_db_list(cluster_id)
     ret_data = []
     cluster_dict = dao.get_cluster(cluster_id)
@@ -87,9 +91,10 @@ def get_last_lsn(cluster_id):
     return 0, ret_data
 
 
-def get_repl_delay(cluster_id):
+def collect_repl_delay(cluster_id):
     """
-    获得各个备库的延迟
+    连接数据库获得各个备库的延迟，由后台采样线程定期调用，结果见get_repl_delay
+    只连接一次主库，主库的当前wal位置和主库上的流复制状态在同一个连接中获取，级联的上级库才另外建立连接
     :return:
     """
     clu_db_list = dao.get_cluster_db_list(cluster_id)
@@ -117,13 +122,12 @@ def get_repl_delay(cluster_id):
         db_user = clu_db_list[0]['db_user']
         db_pass = db_encrypt.from_db_text(clu_db_list[0]['db_pass'])
 
+        # 有下级库的数据库才需要查询pg_stat_replication，直接从集群的数据库列表中得到，不再逐个查询clup_db表
+        up_db_id_set = {db['up_db_id'] for db in clu_db_list if db.get('up_db_id')}
+        up_db_list = [db for db in clu_db_list if db['db_id'] in up_db_id_set]
+        pri_conn = None
         try:
-            # delay_data = pg_utils.get_repl_delay(pri_db['host'], db_port, db_user, db_pass, cur_wal)
-            for db in clu_db_list:
-                sql = f"SELECT count(*) FROM clup_db WHERE up_db_id = {db['db_id']} "
-                rows = dbapi.query(sql)
-                if rows[0]['count'] == 0:
-                    continue
+            if up_db_list:
                 db_dict = {
                     'db_name': 'template1',
                     'host': pri_db['host'],
@@ -132,29 +136,30 @@ def get_repl_delay(cluster_id):
                     'db_pass': db_pass,
                     'real_pass': True
                 }
-                try:
-                    conn = dao.get_db_conn(db_dict)
-
-                    # 从主库获取current_wal
-                    cur_wal_rows = dao.get_current_wal_lsn(conn)
-                except Exception as e:
-                    logging.error(f'get current wal lsn ERROR: {repr(e)}')
-                    cur_wal_rows = []
+                pri_conn = dao.get_db_conn(db_dict)
+                if isinstance(pri_conn, str):
+                    raise Exception(f"connect to primary({pri_db['host']}) failed: {pri_conn}")
+                # 从主库获取current_wal
+                cur_wal = pg_utils.get_current_wal_lsn(pri_conn)
+            for db in up_db_list:
+                if db['db_id'] == pri_db['db_id']:
+                    cur_delay_data = pg_utils.query_repl_delay(pri_conn, cur_wal)
                 else:
-                    conn.close()
-                if cur_wal_rows:
-                    cur_wal = cur_wal_rows[0]['cur_wal']
                     cur_delay_data = pg_utils.get_repl_delay(db['host'], db_port, db_user, db_pass, cur_wal)
-                    delay_data.extend(cur_delay_data)
+                delay_data.extend(cur_delay_data)
         except Exception:
             logging.error(f"Can not get replication delay: {traceback.format_exc()}")
             delay_data = []
+        finally:
+            if pri_conn is not None and not isinstance(pri_conn, str):
+                pri_conn.close()
 
     db_port = cluster_dict['port']
     current_lsn = 'unknown'
     ret_data = []
     for db_dict in clu_db_list:
         delay_row = {
+            'db_id': db_dict['db_id'],
             'host': db_dict['host'],
             'port': db_port,
             'state': db_dict['state'],
@@ -196,6 +201,32 @@ def get_repl_delay(cluster_id):
     return 0, ret_data
 
 
+def get_last_lsn(cluster_id):
+    """
+    获得各个数据库最后的LSN，优先使用后台采样线程的最新结果
+    """
+    data = repl_sampler.get_sample(cluster_id, 'last_lsn')
+    if data is not None:
+        return 0, data
+    err_code, data = collect_last_lsn(cluster_id)
+    if err_code == 0:
+        repl_sampler.save_sample(cluster_id, 'last_lsn', data)
+    return err_code, data
+
+
+def get_repl_delay(cluster_id):
+    """
+    获得各个备库的延迟，优先使用后台采样线程的最新结果
+    """
+    data = repl_sampler.get_sample(cluster_id, 'repl_delay')
+    if data is not None:
+        return 0, data
+    err_code, data = collect_repl_delay(cluster_id)
+    if err_code == 0:
+        repl_sampler.save_sample(cluster_id, 'repl_delay', data)
+    return err_code, data
+
+
 def can_be_failback(cluster_id: str, db_id: int):
     """
     探测能否当前情况下修复这个节点
@@ -215,7 +246,7 @@ def can_be_failback(cluster_id: str, db_id: int):
         return 1, f"can_be_failback when cluster({cluster_id}) has been deleted"
 
     state = cluster_dict['state']
-    if state == cluster_state.REPAIRING or state == cluster_state.FAILOVER or state == cluster_state.CHECKING:
+    if state == cluster_state.REPAIRING or state == cluster_state.FAILOVER:
         str_state = cluster_state.to_str(state)
         err_msg = f"Cluster is being operated on(state={str_state}). Please try repairing the node later!"
         logging.info(f"{pre_msg}:{err_msg}")
@@ -1434,15 +1465,9 @@ def online_sr_cluster(cluster_dict):
     probe_island_ip_list = probe_island_ip_list[:3]
     island = True
     try:
-        for ip in probe_island_ip_list:
-            ip = ip.strip()
-            res = ping_lib.ping_ip(ip, 2, 3)
-            if res == -1:
-                # dao.set_cluster_db_state(cluster_id, bad_db_dict['db_id'], node_state.UNKNOWN)
-                continue
-            else:
-                island = False
-                break
+        # 同时ping所有的IP，任何一个能ping通就说明自己不是孤岛
+        probe_island_ip_list = [ip.strip() for ip in probe_island_ip_list]
+        island = not ping_lib.is_any_ip_reachable(probe_island_ip_list, 2, 3)
     except Exception as e:
         err_result.append([f"The configuration item 'probe_island_ip={str_ip_list}' in clup.conf is incorrect, which is causing the ping to fail: {repr(e)}",
         "The configuration item 'probe_island_ip' cannot be a broadcast address or an address of a certain network. It needs to be a valid IP address of a normal host!"])
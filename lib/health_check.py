@@ -22,24 +22,30 @@
 @description: 健康检查模块
 """
 
-import json
 import logging
 import threading
 import time
 import traceback
-import urllib.error
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
 
+import agent_event
+import agent_tracker
+import check_scheduler
+import check_shard
+import cluster_lease
 import cluster_state
 import config
 import csuapp
 import dao
 import database_state
 import db_encrypt
+import failover_candidate
+import failure_detector
 import ha_logic
 import ha_mgr
 import helpers
 import lb_mgr
+import metric_store
 import node_state
 import pg_db_lib
 import pg_helpers
@@ -50,8 +56,130 @@ ASYNC_CLUSTER_LIST = []
 SYNC_CLUSTER_LIST = []
 FAILBACK_DB_LIST = []
 
+# 所有集群共用的探测数据库的线程池
+__probe_executor = None
+# db_id -> 正在进行的探测的future，超过截止时间没有结束的探测在下一个周期继续等待
+__probe_future_dict = {}
+__probe_lock = threading.Lock()
+# 所有集群共用的收集主机状态快照的线程池
+__snapshot_executor = None
+__snapshot_lock = threading.Lock()
 
-def sr_switch_read_vip(read_vip_host, read_vip, cluster_id):
+
+class ClusterHostSnapshot:
+    """
+    一次检查周期中集群各主机状态的快照，每台主机只建立一次RPC连接，
+    收集主机是否能连接、vip和读vip是否在此主机上、数据库是否在运行，后面检查vip等的逻辑都基于这个快照做判断
+    """
+
+    def __init__(self, cluster_id, db_list, vip, read_vip):
+        self.cluster_id = cluster_id
+        self.db_list = db_list
+        self.vip = vip
+        self.read_vip = read_vip
+        # host -> {'is_ok': 主机是否能连接, 'vip_dict': {vip: 是否存在，None表示未知}}
+        self.host_dict = {}
+        # db_id -> 数据库是否在运行
+        self.db_running_dict = {}
+
+    def collect_host(self, host, host_db_list):
+        host_info = {'is_ok': False, 'vip_dict': {}}
+        # 后台检查agent的结果是连接不上时，不用再等待一次连接超时
+        if agent_tracker.is_host_down(host, max_interval_cnt=1):
+            return host, host_info, {}
+        err_code, err_msg = rpc_utils.get_rpc_connect(host)
+        if err_code != 0:
+            return host, host_info, {}
+        rpc = err_msg
+        db_running_dict = {}
+        try:
+            host_info['is_ok'] = True
+            for vip in [self.vip, self.read_vip]:
+                if not vip:
+                    continue
+                err_code, ret = rpc.vip_exists(vip)
+                host_info['vip_dict'][vip] = bool(ret) if err_code == 0 else None
+            for db in host_db_list:
+                # 如果是running状态就不再检查，减少查询次数
+                if db['db_state'] == database_state.RUNNING:
+                    db_running_dict[db['db_id']] = True
+                    continue
+                err_code, is_run = pg_db_lib.is_running(rpc, db['pgdata'])
+                db_running_dict[db['db_id']] = (err_code == 0 and is_run)
+        finally:
+            rpc.close()
+        return host, host_info, db_running_dict
+
+    def collect(self):
+        """
+        并发连接集群中的每台主机，收集主机的状态
+        """
+        host_db_dict = {}
+        for db in self.db_list:
+            host_db_dict.setdefault(db['host'], []).append(db)
+        if not host_db_dict:
+            return
+
+        executor = get_snapshot_executor()
+        future_list = [executor.submit(self.collect_host, host, host_db_list) for host, host_db_list in host_db_dict.items()]
+        for future in future_list:
+            try:
+                host, host_info, db_running_dict = future.result()
+            except Exception:
+                logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during collect host state: {traceback.format_exc()}")
+                continue
+            self.host_dict[host] = host_info
+            self.db_running_dict.update(db_running_dict)
+
+    def host_is_ok(self, host):
+        host_info = self.host_dict.get(host)
+        if host_info is None:
+            return False
+        return host_info['is_ok']
+
+    def vip_exists(self, host, vip):
+        """
+        :return: True表示vip在此主机上，False表示不在，None表示不知道(主机连接失败或检查失败)
+        """
+        host_info = self.host_dict.get(host)
+        if host_info is None:
+            return None
+        return host_info['vip_dict'].get(vip)
+
+    def set_vip_exists(self, host, vip, exists):
+        host_info = self.host_dict.get(host)
+        if host_info is None:
+            return
+        host_info['vip_dict'][vip] = exists
+
+    def get_running_db_cnt(self):
+        return len([db_id for db_id, is_run in self.db_running_dict.items() if is_run])
+
+
+def get_snapshot_executor():
+    """
+    所有集群收集主机状态快照共用一个有上限的线程池，不再每个集群每个检查周期都创建线程池
+    """
+    global __snapshot_executor
+    with __snapshot_lock:
+        if __snapshot_executor is None:
+            worker_cnt = int(config.get('ha_snapshot_thread_cnt', 32))
+            __snapshot_executor = ThreadPoolExecutor(worker_cnt, thread_name_prefix="snapshot-host")
+        return __snapshot_executor
+
+
+def get_cluster_host_snapshot(cluster_id):
+    """
+    获得集群中各主机状态的快照
+    """
+    db_list = dao.get_cluster_db(cluster_id)
+    vip_detail = dao.get_cluster_vip(cluster_id)
+    snapshot = ClusterHostSnapshot(cluster_id, db_list, vip_detail['vip'], vip_detail['read_vip'])
+    snapshot.collect()
+    return snapshot
+
+
+def sr_switch_read_vip(read_vip_host, read_vip, cluster_id, snapshot):
     rows = dao.get_cluster_db_host_list(cluster_id)
     host_list = [row['host'] for row in rows if row['is_primary'] == 0]
     primary_host_list = [row['host'] for row in rows if row['is_primary'] == 1]
@@ -61,6 +189,8 @@ def sr_switch_read_vip(read_vip_host, read_vip, cluster_id):
     if read_vip_host in host_list:
         host_list.remove(read_vip_host)
     for host in host_list:
+        if not snapshot.host_is_ok(host):
+            continue
         err_code, err_msg = rpc_utils.get_rpc_connect(host)
         if err_code != 0:
             continue
@@ -70,6 +200,8 @@ def sr_switch_read_vip(read_vip_host, read_vip, cluster_id):
             err_code, err_msg = rpc.check_and_add_vip(read_vip)
             if err_code < 0:
                 logging.error(f"Cluster({cluster_id}): Can not check and add read vip({read_vip}) in host({read_vip_host}): {err_msg}")
+            else:
+                snapshot.set_vip_exists(host, read_vip, True)
         finally:
             rpc.close()
 
@@ -81,7 +213,7 @@ def sr_switch_read_vip(read_vip_host, read_vip, cluster_id):
     return -1
 
 
-def sr_check_del_read_vip(cluster_id):
+def sr_check_del_read_vip(cluster_id, snapshot):
     vip = dao.get_cluster_vip(cluster_id)
     if not vip['read_vip']:
         return
@@ -91,23 +223,17 @@ def sr_check_del_read_vip(cluster_id):
         host_list.remove(vip['read_vip_host'])
     read_vip = vip['read_vip']
     for host in host_list:
-        err_code, err_msg = rpc_utils.get_rpc_connect(host)
-        if err_code != 0:
+        if not snapshot.vip_exists(host, read_vip):
+            # 如果连接失败或不存在，直接跳过
             continue
-        rpc = err_msg
-        try:
-            err_code, ret = rpc.vip_exists(read_vip)
-            if err_code != 0 or not ret:
-                # 如果连接失败，直接跳过
-                continue
-            # 如果存在，则删除
-            logging.info(f'remove read vip({read_vip}) from host ({host})')
-            rpc_utils.check_and_del_vip(host, read_vip)
-        finally:
-            rpc.close()
+        # 如果存在，则删除
+        logging.info(f'remove read vip({read_vip}) from host ({host})')
+        err_code, _err_msg = rpc_utils.check_and_del_vip(host, read_vip)
+        if err_code == 0:
+            snapshot.set_vip_exists(host, read_vip, False)
 
 
-def sr_check_del_write_vip(cluster_id):
+def sr_check_del_write_vip(cluster_id, snapshot):
     primary_host = dao.get_primary_host(cluster_id)
     host_list = dao.get_cluster_db_host_list(cluster_id)
     vip_detail = dao.get_cluster_vip(cluster_id)
@@ -117,41 +243,22 @@ def sr_check_del_write_vip(cluster_id):
         host = db['host']
         if host == primary_host.get('host') or room['room_id'] != db['room_id']:
             continue
-        err_code, err_msg = rpc_utils.get_rpc_connect(host)
-        if err_code != 0:
+        if not snapshot.vip_exists(host, vip):
+            # 如果连接失败或不存在，直接跳过
             continue
-        rpc = err_msg
-        try:
-            err_code, ret = rpc.vip_exists(vip)
-            if err_code != 0 or not ret:
-                # 如果连接失败，直接跳过
-                continue
-            # 如果存在，则删除
-            logging.info(f'remove write vip({vip}) from host ({host})')
-            rpc.check_and_del_vip(vip)
-        finally:
-            rpc.close()
+        # 如果存在，则删除
+        logging.info(f'remove write vip({vip}) from host ({host})')
+        err_code, _err_msg = rpc_utils.check_and_del_vip(host, vip)
+        if err_code == 0:
+            snapshot.set_vip_exists(host, vip, False)
 
 
-def get_count_db(cluster_id):
-    # 统计集群中剩余多少个正常的数据库
-    count = 0
-    rows = dao.get_cluster_db(cluster_id)
-    for row in rows:
-        if row['db_state'] == database_state.RUNNING:
-            # 如果是running状态就跳过，减少查询次数
-            count += 1
-            continue
-        err_code, is_run = pg_db_lib.is_running(row['host'], row['pgdata'])
-        if err_code == 0 and is_run:
-            count += 1
-    return count
-
-
-def sr_check_count_db(cluster_id):
+def sr_check_count_db(cluster_id, snapshot):
     # 如果不在异步集群列表中，检测集群中只剩一个正常数据库，将集群改为异步模式，集群id添加到异步列表中，避免下一次再检测
     if cluster_id not in ASYNC_CLUSTER_LIST:
-        count = get_count_db(cluster_id)
+        count = snapshot.get_running_db_cnt()
+        if count != 1:
+            return
         primary_info = dao.get_primary_info(cluster_id)
         if not primary_info:
             logging.error(f'No primary database found in the cluster({cluster_id}).')
@@ -161,50 +268,52 @@ def sr_check_count_db(cluster_id):
             return
         rpc = err_msg
         try:
-            if count == 1:
-                logging.info(f'Statistics normal database (count={count})')
-                # 如果只剩一个主库正常，改为异步模式，并且添加到列表中
-                logging.info(f"Because only one survived, to avoid hang, (db_id: {primary_info['db_id']}) change sync to async")
-                err_code, ret = pg_db_lib.change_sync_to_async(rpc, primary_info['pgdata'])
-                if err_code:
-                    logging.error(f"(db_id: {primary_info['db_id']}) change sync to async ERROR: {ret}")
-                err_code, err_msg = pg_db_lib.reload(primary_info['host'], primary_info['pgdata'])
-                if err_code != 0:
-                    logging.error(f"(db_id: {primary_info['db_id']}) change sync to async reload ERROR: {err_msg}")
-                ASYNC_CLUSTER_LIST.append(cluster_id)
-                if cluster_id in SYNC_CLUSTER_LIST:
-                    SYNC_CLUSTER_LIST.remove(cluster_id)
+            logging.info(f'Statistics normal database (count={count})')
+            # 如果只剩一个主库正常，改为异步模式，并且添加到列表中
+            logging.info(f"Because only one survived, to avoid hang, (db_id: {primary_info['db_id']}) change sync to async")
+            err_code, ret = pg_db_lib.change_sync_to_async(rpc, primary_info['pgdata'])
+            if err_code:
+                logging.error(f"(db_id: {primary_info['db_id']}) change sync to async ERROR: {ret}")
+            err_code, err_msg = pg_db_lib.reload(primary_info['host'], primary_info['pgdata'])
+            if err_code != 0:
+                logging.error(f"(db_id: {primary_info['db_id']}) change sync to async reload ERROR: {err_msg}")
+            ASYNC_CLUSTER_LIST.append(cluster_id)
+            if cluster_id in SYNC_CLUSTER_LIST:
+                SYNC_CLUSTER_LIST.remove(cluster_id)
         finally:
             rpc.close()
 
 
-def sr_check_async_to_sync(cluster_id):
+def sr_check_async_to_sync(cluster_id, snapshot):
     # 如果不在异步集群列表中，检测集群中只剩一个正常数据库，将集群改为异步模式，集群id添加到异步列表中，避免下一次再检测
     if cluster_id not in SYNC_CLUSTER_LIST:
+        count = snapshot.get_running_db_cnt()
+        if count <= 1:
+            return
         primary_info = dao.get_primary_info(cluster_id)
-        count = get_count_db(cluster_id)
+        if not primary_info:
+            logging.error(f'No primary database found in the cluster({cluster_id}).')
+            return
         err_code, err_msg = rpc_utils.get_rpc_connect(primary_info['host'])
         if err_code != 0:
             return
         rpc = err_msg
         try:
-            if count > 1:
-                logging.info(f"If sr is sync, (db_id: {primary_info['db_id']}) restore from async to sync")
-                err_code, ret = pg_db_lib.change_async_to_sync(rpc, primary_info['pgdata'])
-                rpc.close()
-                if err_code:
-                    logging.error(f"(db_id: {primary_info['db_id']}) restore from async to sync ERROR: {ret}")
-                err_code, err_msg = pg_db_lib.reload(primary_info['host'], primary_info['pgdata'])
-                if err_code != 0:
-                    logging.error(f"(db_id: {primary_info['db_id']}) restore from async to sync reload ERROR: {err_msg}")
-                SYNC_CLUSTER_LIST.append(cluster_id)
-                if cluster_id in ASYNC_CLUSTER_LIST:
-                    ASYNC_CLUSTER_LIST.remove(cluster_id)
+            logging.info(f"If sr is sync, (db_id: {primary_info['db_id']}) restore from async to sync")
+            err_code, ret = pg_db_lib.change_async_to_sync(rpc, primary_info['pgdata'])
+            if err_code:
+                logging.error(f"(db_id: {primary_info['db_id']}) restore from async to sync ERROR: {ret}")
+            err_code, err_msg = pg_db_lib.reload(primary_info['host'], primary_info['pgdata'])
+            if err_code != 0:
+                logging.error(f"(db_id: {primary_info['db_id']}) restore from async to sync reload ERROR: {err_msg}")
+            SYNC_CLUSTER_LIST.append(cluster_id)
+            if cluster_id in ASYNC_CLUSTER_LIST:
+                ASYNC_CLUSTER_LIST.remove(cluster_id)
         finally:
             rpc.close()
 
 
-def sr_ha_check_vip(cluster_dict, clu_db_list):
+def sr_ha_check_vip(cluster_dict, clu_db_list, snapshot):
     cluster_id = cluster_dict['cluster_id']
     vip = cluster_dict['vip'].strip()
     read_vip = cluster_dict['read_vip'].strip()
@@ -214,42 +323,52 @@ def sr_ha_check_vip(cluster_dict, clu_db_list):
     for db_dict in clu_db_list:
         host = db_dict['host']
         if db_dict['is_primary'] and db_dict['state'] == node_state.NORMAL:
+            if not snapshot.host_is_ok(host):
+                logging.error(f"Cluster({cluster_id}): Can not check and add vip({vip}) in host({host}): maybe host is down.")
+                continue
+            if snapshot.vip_exists(host, vip):
+                continue
+            logging.info(f"Cluster({cluster_id}): VIP({vip}) needs to be added on host({host})")
             err_code, err_msg = rpc_utils.get_rpc_connect(host)
             if err_code != 0:
                 logging.error(f"Cluster({cluster_id}): Can not check and add vip({vip}) in host({host}): maybe host is down.")
                 continue
             rpc = err_msg
             try:
-                err_code, ret = rpc.vip_exists(vip)
-                if err_code == 0 and ret:
-                    continue
-                logging.info(f"Cluster({cluster_id}): VIP({vip}) needs to be added on host({host})")
                 err_code, err_msg = rpc.check_and_add_vip(vip)
                 if err_code < 0:
                     logging.error(f"Cluster({cluster_id}): Can not check and add vip({vip}) in host({host}): {err_msg}")
                     continue
+                snapshot.set_vip_exists(host, vip, True)
             finally:
                 rpc.close()
 
     if read_vip:  # 如果设置了读vip，则进行检查
-        err_code, err_msg = rpc_utils.get_rpc_connect(read_vip_host)
-        if err_code != 0:
+        if not snapshot.host_is_ok(read_vip_host):
             logging.error(f"Cluster({cluster_id}): Can not check and add read vip({read_vip}) in host({read_vip_host}): maybe host is down.")
             logging.info(f"Cluster({cluster_id}): read vip({read_vip}) needs to be switched to other host({read_vip_host})")
-            err = sr_switch_read_vip(read_vip_host, read_vip, cluster_id)
+            err = sr_switch_read_vip(read_vip_host, read_vip, cluster_id, snapshot)
             if err != 0:
                 logging.error(f"Cluster({cluster_id}): All the databases are broken.")
+            return
+
+        ret = snapshot.vip_exists(read_vip_host, read_vip)
+        if ret is None or ret:
+            # 如果检查失败或者存在read vip，直接返回
+            return
+
+        logging.info(f"Cluster({cluster_id}): read vip({read_vip}) needs to be added on host({read_vip_host})")
+        err_code, err_msg = rpc_utils.get_rpc_connect(read_vip_host)
+        if err_code != 0:
+            logging.error(f"Cluster({cluster_id}): Can not check and add read vip({read_vip}) in host({read_vip_host}): maybe host is down.")
+            return
         rpc = err_msg
         try:
-            err_code, ret = rpc.vip_exists(read_vip)
-            if err_code != 0 or ret:
-                # 如果连接失败或者存在read vip，直接返回
-                return
-
-            logging.info(f"Cluster({cluster_id}): read vip({read_vip}) needs to be added on host({read_vip_host})")
             err_code, err_msg = rpc.check_and_add_vip(read_vip)
             if err_code < 0:
                 logging.error(f"Cluster({cluster_id}): Can not check and add read vip({read_vip}) in host({read_vip_host}): {err_msg}")
+            else:
+                snapshot.set_vip_exists(read_vip_host, read_vip, True)
         finally:
             rpc.close()
 
@@ -260,7 +379,7 @@ def sr_ha_check_cstlb(cluster_dict, clu_db_list):
     str_cstlb_list = cluster_dict['cstlb_list']
     if not str_cstlb_list:
         return
-    cstlb_list = str_cstlb_list.split(',')
+    cstlb_list = [lb_addr.strip() for lb_addr in str_cstlb_list.split(',') if lb_addr.strip()]
     if len(cstlb_list) <= 0:
         return
 
@@ -269,273 +388,411 @@ def sr_ha_check_cstlb(cluster_dict, clu_db_list):
         if db['is_primary'] != 1 and db['state'] == node_state.NORMAL:
             ip_port = db['host'] + ':' + str(db_port)
             res_clupstb.append(ip_port)
-    token = config.get("cstlb_token")
-    for lb_addr in cstlb_list:
-        try:
-            response = urllib.request.urlopen('http://' + lb_addr + '/backend/list?token=' + token)
-        except ConnectionRefusedError as e:
-            logging.error(f"Cluster({cluster_id}): Unable to connect to the load balancer: {lb_addr}: \n {str(e)}")
-            continue
-        except urllib.error.URLError as e:
-            logging.error(f"Cluster({cluster_id}): Unable to connect to the load balancer: {lb_addr}: \n {str(e)}")
-            continue
-        except Exception:
-            logging.error(f"Cluster({cluster_id}): Unexpected error occurred during check csltb: {traceback.format_exc()}")
-            continue
+    # 只有后端有变化或到了定期同步的时间才会访问负载均衡器
+    lb_mgr.sync_backends(cluster_id, cstlb_list, res_clupstb)
 
-        res_cstlbstb = json.loads(response.read()).keys()
-        diff = list(set(res_cstlbstb) ^ set(res_clupstb))
-        if len(diff) == 0:
-            continue
 
-        cstlb_del = [x for x in diff if x not in res_clupstb]
-        cstlb_add = [x for x in diff if x not in res_cstlbstb]
-
-        logging.info(f'need delete {cstlb_del} from {lb_addr}')
-        for backend_addr in cstlb_del:
-            status, data = lb_mgr.delete_backend(lb_addr, backend_addr)
-            if status != 0:
-                logging.error(data)
-
-        logging.info(f'need add {cstlb_add} to {lb_addr}')
-        for backend_addr in cstlb_add:
-            status, data = lb_mgr.add_backend(lb_addr, backend_addr)
-            if status != 0:
-                logging.error(data)
-
-
-def probe_postgres_db(cluster_id, host, db_port, db_name, db_user, db_pass, sql, timeout, retry_interval, retry_cnt):
+def probe_postgres_db(cluster_id, db_id, host, db_port, db_name, db_user, db_pass, sql, timeout, retry_interval, retry_cnt):
+    """
+    探测数据库，每次探测的结果都记录到故障检测器中，由故障检测器判断数据库是否已经故障:
+    连续失败次数至少要达到retry_cnt，这时如果怀疑程度(phi)还没有超过阈值，继续探测，最多到2*retry_cnt次
+    """
     msg = ''
     i = 0
     err_msg_list = []
     cluster = dao.get_cluster_name(cluster_id)
     cluster = cluster.get('cluster_name', cluster_id)
-    while i < retry_cnt:
+    retry_cnt = int(retry_cnt)
+    detector = failure_detector.get_detector(db_id)
+    while True:
+        begin_time = time.time()
         err_code, err_msg = probe_db.probe_postgres(host, db_port,
                     db_name, db_user, db_pass, sql, timeout)
-        if err_code != 0:
-            current_time_str = helpers.get_current_time_str()
-            msg = f"{current_time_str} ProbeDB[cluster_id={cluster_id}, db={host}:{db_port}]: {i + 1} time error: {err_msg}"
-            err_msg_list.append(msg)
-            logging.info(msg)
-
-        else:
+        if err_code == 0:
+            latency = time.time() - begin_time
+            detector.record_success(latency)
+            metric_store.record(metric_store.METRIC_PROBE_LATENCY, db_id, latency)
+            return 0, err_msg_list
+
+        detector.record_failure()
+        current_time_str = helpers.get_current_time_str()
+        msg = f"{current_time_str} ProbeDB[cluster_id={cluster_id}, db={host}:{db_port}]: {i + 1} time error: {err_msg}"
+        err_msg_list.append(msg)
+        logging.info(msg)
+        i += 1
+        if failure_detector.is_failed(db_id, i, retry_cnt):
             break
         time.sleep(retry_interval)
-        i += 1
-    if i < retry_cnt:
-        return 0, err_msg_list
 
+    phi = failure_detector.get_phi(db_id)
+    if phi is not None:
+        msg = f"{helpers.get_current_time_str()} ProbeDB[cluster_id={cluster_id}, db={host}:{db_port}]: " \
+              f"failed {i} times, phi={phi:.1f}"
+        err_msg_list.append(msg)
+        logging.info(msg)
     return -1, err_msg_list
 
 
-# 流复制的HA检查类
-class SrHaChecker(threading.Thread):
-    def __init__(self, cluster_id):
-        threading.Thread.__init__(self, name=f"health-checker-{cluster_id}")
-        self.cluster_id = cluster_id
-
-    def run(self):
-        while not csuapp.is_exit():
-            probe_interval = int(config.get('sr_ha_check_interval', 10))
-            try:
-                # 先把集群设置为checking状态，防止在检查过程中对集群有其他并发操作
-                ret = dao.test_and_set_cluster_state(self.cluster_id, [cluster_state.NORMAL], cluster_state.CHECKING)
-                if ret is None:
-                    logging.debug(f"cluster({self.cluster_id}) state is not online, next time to check...")
-                    time.sleep(probe_interval)
-                    continue
-            except Exception:
-                err_msg = traceback.format_exc()
-                logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during set cluster state to  CHECKING: {err_msg}")
-                time.sleep(probe_interval)
-                continue
-
-            # check the database state which in the cluster
-            clu_state = cluster_state.NORMAL
-            try:
-                cluster_dict = dao.get_cluster(self.cluster_id)
-                if cluster_dict is None:
-                    logging.info(f"exit health check thread when cluster({self.cluster_id}) has been deleted.")
-                    break
+def get_probe_executor():
+    """
+    所有集群的探测共用一个有上限的线程池，不再每个检查周期都创建线程池
+    """
+    global __probe_executor
+    with __probe_lock:
+        if __probe_executor is None:
+            worker_cnt = int(config.get('ha_probe_thread_cnt', 64))
+            __probe_executor = ThreadPoolExecutor(worker_cnt, thread_name_prefix="probe-db")
+        return __probe_executor
 
-                state = cluster_dict['state']
-                if state != cluster_state.CHECKING:  # 不是CHECKING状态，则不进行检测
-                    logging.debug(f"cluster({self.cluster_id}) state is {state}, not normal, next time to check...")
-                    continue
 
-                clu_db_list = dao.get_cluster_db_list(self.cluster_id)
-                if len(clu_db_list) == 0:
-                    logging.debug(f"exit health check thread when cluster({self.cluster_id}) has been deleted")
-                    break
+def probe_cluster_db_list(cluster_dict, clu_db_list):
+    """
+    并发探测集群中所有状态正常的数据库，每个数据库最多按probe_retry_cnt和probe_retry_interval重试，故障检测器判断已经故障时提前结束，
+    所有探测都在一个总的截止时间内结束。超过截止时间还没有结束的探测结果未知，不算作失败，也不返回，
+    这个探测继续在后台进行，下一个检查周期不再重新发起，而是继续等待它的结果
+    :return: 返回列表，元素为(pg, ret_code, err_msg_list)，顺序与clu_db_list中的顺序相同
+    """
 
-                # 检查数据库是否正常
-                try:
-                    db_port = cluster_dict['port']
-                    cluster_id = cluster_dict['cluster_id']
-                    probe_timeout = cluster_dict['probe_timeout']
-                    probe_pri_sql = cluster_dict['probe_pri_sql']
-                    probe_stb_sql = cluster_dict['probe_stb_sql']
-                    probe_interval = cluster_dict['probe_interval']
-
-                    for pg in clu_db_list:
-                        host = pg['host']
-                        is_primary = pg['is_primary']
-
-                        # aready is failed, not check
-                        if pg['state'] != node_state.NORMAL:
-                            continue
+    cluster_id = cluster_dict['cluster_id']
+    db_port = cluster_dict['port']
+    probe_timeout = cluster_dict['probe_timeout']
+    probe_pri_sql = cluster_dict['probe_pri_sql']
+    probe_stb_sql = cluster_dict['probe_stb_sql']
+    probe_db_name = cluster_dict['probe_db_name']
+    db_user = clu_db_list[0]['db_user']
+    db_pass = db_encrypt.from_db_text(clu_db_list[0]['db_pass'])
+    probe_retry_cnt = cluster_dict.get('probe_retry_cnt', 2)
+    probe_retry_interval = cluster_dict.get('probe_retry_interval', 4)
+
+    # aready is failed, not check
+    probe_list = [pg for pg in clu_db_list if pg['state'] == node_state.NORMAL]
+    if not probe_list:
+        return []
+
+    # 每个数据库最长的探测时间是最多的探测次数*(超时时间+重试间隔)，再多给几秒的余量
+    max_probe_cnt = failure_detector.get_max_fail_cnt(probe_retry_cnt)
+    deadline_secs = max_probe_cnt * (int(probe_timeout) + int(probe_retry_interval)) + 5
+    executor = get_probe_executor()
+    future_list = []
+    for pg in probe_list:
+        if pg['is_primary']:
+            probe_sql = probe_pri_sql
+        else:
+            probe_sql = probe_stb_sql
+        with __probe_lock:
+            future = __probe_future_dict.get(pg['db_id'])
+            # 上一个周期没有结束的探测继续等待，已经结束但没有取走的结果已经过时，重新探测
+            if future is None or future.done():
+                future = executor.submit(
+                    probe_postgres_db,
+                    cluster_id, pg['db_id'], pg['host'], db_port,
+                    probe_db_name, db_user, db_pass, probe_sql,
+                    probe_timeout, probe_retry_interval, probe_retry_cnt
+                )
+                __probe_future_dict[pg['db_id']] = future
+        future_list.append(future)
+    wait(future_list, timeout=deadline_secs)
+
+    result_list = []
+    for pg, future in zip(probe_list, future_list):
+        if not future.done():
+            logging.info(f"Cluster({cluster_id}): probe of db({pg['host']}:{db_port}) not finished in {deadline_secs} seconds, "
+                         "result is unknown, wait for it in next check.")
+            continue
+        with __probe_lock:
+            if __probe_future_dict.get(pg['db_id']) is future:
+                del __probe_future_dict[pg['db_id']]
+        try:
+            ret_code, err_msg_list = future.result()
+        except Exception:
+            # 探测本身出现异常时，与之前一样不做切换
+            logging.error(f"Cluster({cluster_id}): Probe db exception: {traceback.format_exc()}")
+            continue
+        result_list.append((pg, ret_code, err_msg_list))
+    return result_list
 
-                        probe_db_name = cluster_dict['probe_db_name']
-                        db_user = clu_db_list[0]['db_user']
-                        db_pass = db_encrypt.from_db_text(clu_db_list[0]['db_pass'])
 
-                        if 'probe_retry_cnt' not in cluster_dict:
-                            probe_retry_cnt = 2
-                        else:
-                            probe_retry_cnt = cluster_dict['probe_retry_cnt']
+# 流复制的HA检查类，每个集群一个对象，由调度器定时调用check()进行检查
+class SrHaChecker:
+    def __init__(self, cluster_id):
+        self.cluster_id = cluster_id
 
-                        if 'probe_retry_interval' not in cluster_dict:
-                            probe_retry_interval = 4
-                        else:
-                            probe_retry_interval = cluster_dict['probe_retry_interval']
+    def check(self):
+        """
+        对集群做一次检查
+        :return: 返回下一次检查的间隔秒数，返回None表示集群已被删除，不再需要检查
+        """
+        probe_interval = int(config.get('sr_ha_check_interval', 10))
+        # 先获得集群的租约，防止在检查过程中对集群有其他并发操作，不再把集群状态改成CHECKING
+        token = cluster_lease.acquire(self.cluster_id, 'ha-check')
+        if token is None:
+            holder = cluster_lease.get_holder_name(self.cluster_id)
+            logging.debug(f"cluster({self.cluster_id}) is being operated by {holder}, next time to check...")
+            return probe_interval
+        try:
+            # 多台clup分摊检查时，只检查分给自己的集群，持有租约后再判断，释放集群时会等持有租约的检查结束
+            if not check_shard.is_owner(self.cluster_id):
+                return probe_interval
+            return self.check_with_lease(token, probe_interval)
+        finally:
+            cluster_lease.release(self.cluster_id, token)
+
+    def save_state(self, token, clu_state):
+        """
+        检查结束时保存集群状态，检查期间其他线程修改了集群状态时，令牌已经作废，不能再覆盖，
+        集群状态只可能是检查开始时的NORMAL或切换时改成的FAILOVER，是其他状态时说明被其他进程修改了，也不能覆盖
+        """
+        ret = dao.set_cluster_state_with_token(self.cluster_id, token, [cluster_state.NORMAL, cluster_state.FAILOVER], clu_state)
+        if ret is None:
+            logging.info(f"Cluster({self.cluster_id}): state changed by others during check, do not set it to {cluster_state.to_str(clu_state)}.")
+
+    def check_with_lease(self, token, probe_interval):
+        try:
+            cluster_dict = dao.get_cluster(self.cluster_id)
+        except Exception:
+            logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during get cluster: {traceback.format_exc()}")
+            return probe_interval
+        if cluster_dict is None:
+            logging.info(f"stop health check when cluster({self.cluster_id}) has been deleted.")
+            failover_candidate.remove_cluster(self.cluster_id)
+            return None
+
+        state = cluster_dict['state']
+        if state != cluster_state.NORMAL:  # 不是NORMAL状态，则不进行检测
+            logging.debug(f"cluster({self.cluster_id}) state is {state}, not normal, next time to check...")
+            return probe_interval
+
+        # check the database state which in the cluster
+        # 集群状态只有在发生了切换或检查失败时才需要写入数据库，正常的检查周期不再写clup_cluster表
+        clu_state = cluster_state.NORMAL
+        has_failover = False
+        try:
+            clu_db_list = dao.get_cluster_db_list(self.cluster_id)
+            if len(clu_db_list) == 0:
+                logging.debug(f"stop health check when cluster({self.cluster_id}) has been deleted")
+                failover_candidate.remove_cluster(self.cluster_id)
+                return None
 
-                        if is_primary:
-                            probe_sql = probe_pri_sql
-                        else:
-                            probe_sql = probe_stb_sql
-
-                        try:
-                            ret_code, err_msg_list = probe_postgres_db(
-                                self.cluster_id, host, db_port,
-                                probe_db_name, db_user, db_pass, probe_sql,
-                                probe_timeout, probe_retry_interval, probe_retry_cnt
-                            )
-                            if ret_code == 0:
-                                continue
-                        except Exception:
-                            logging.error(f"Cluster({self.cluster_id}): Probe db exception: {traceback.format_exc()}")
-                            continue
+            # 检查数据库是否正常
+            try:
+                db_port = cluster_dict['port']
+                probe_interval = int(cluster_dict['probe_interval'])
 
-                        try:
-                            logging.info(f"Cluster({self.cluster_id}): Find database({host}:{db_port}) failed, begin failover ...")
-                            # 如果有数据库不正常，尝试恢复，并且会更改集群状态
-                            err_code, err_msg = ha_logic.failover_sr_cluster(self.cluster_id, pg, db_port, err_msg_list)
-                            if err_code < 0:
-                                clu_state = cluster_state.FAILED
-                        except Exception:
-                            err_code = -1
+                # 并发探测集群中所有的数据库，全部探测结束后再按顺序处理故障的数据库
+                probe_result_list = probe_cluster_db_list(cluster_dict, clu_db_list)
+                for pg, ret_code, err_msg_list in probe_result_list:
+                    if ret_code == 0:
+                        continue
+                    host = pg['host']
+                    # 检查过程中集群可能已经分给了其他clup，或者状态被其他操作修改了，这时不能再做切换
+                    if not check_shard.is_owner(self.cluster_id) or not cluster_lease.is_valid(self.cluster_id, token):
+                        logging.info(f"Cluster({self.cluster_id}): no longer owned or lease invalidated, skip failover of database({host}:{db_port}).")
+                        break
+                    has_failover = True
+                    try:
+                        logging.info(f"Cluster({self.cluster_id}): Find database({host}:{db_port}) failed, begin failover ...")
+                        # 如果有数据库不正常，尝试恢复，并且会更改集群状态
+                        err_code, err_msg = ha_logic.failover_sr_cluster(self.cluster_id, pg, db_port, err_msg_list)
+                        if err_code < 0:
                             clu_state = cluster_state.FAILED
-                            logging.error(traceback.format_exc())
-                except Exception:
-                    logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check db: {traceback.format_exc()}")
+                    except Exception:
+                        err_code = -1
+                        clu_state = cluster_state.FAILED
+                        logging.error(traceback.format_exc())
+            except Exception:
+                logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check db: {traceback.format_exc()}")
 
+            # 每台主机只连接一次，收集vip、数据库是否运行等状态，后面的检查都基于这个快照
+            try:
+                snapshot = get_cluster_host_snapshot(self.cluster_id)
+            except Exception:
+                snapshot = None
+                logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during get host snapshot: {traceback.format_exc()}")
+
+            if snapshot is not None:
                 # 检查vip
                 try:
-                    sr_ha_check_vip(cluster_dict, clu_db_list)
+                    sr_ha_check_vip(cluster_dict, clu_db_list, snapshot)
                 except Exception:
                     logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check vip: {traceback.format_exc()}")
                 # 检查并删除重复只读vip
                 try:
-                    sr_check_del_read_vip(self.cluster_id)
+                    sr_check_del_read_vip(self.cluster_id, snapshot)
                 except Exception:
                     logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check and del vip: {traceback.format_exc()}")
                 # 检查并删除重复写vip
                 try:
-                    sr_check_del_write_vip(self.cluster_id)
+                    sr_check_del_write_vip(self.cluster_id, snapshot)
                 except Exception:
                     logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check and del vip: {traceback.format_exc()}")
                 # 检查只剩一个主库正常的情况
                 try:
                     # 检查只剩下一个数据库的集群并改为异步模式
-                    sr_check_count_db(self.cluster_id)
+                    sr_check_count_db(self.cluster_id, snapshot)
                     # 如果之前只剩一个数据库的集群有数据库恢复接改为同步模式
-                    sr_check_async_to_sync(self.cluster_id)
+                    sr_check_async_to_sync(self.cluster_id, snapshot)
                 except Exception:
                     logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check and del vip: {traceback.format_exc()}")
-
-                # 检查负载均衡
-                try:
-                    sr_ha_check_cstlb(cluster_dict, clu_db_list)
-                except Exception:
-                    logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check cstlb: {traceback.format_exc()}")
-
-            except Exception:
-                err_msg = traceback.format_exc()
-                logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check database: {err_msg}")
-            finally:
-                dao.set_cluster_state(self.cluster_id, clu_state)
-                time.sleep(probe_interval)
-
-
-            # check and try add the database to cluster
+                # 刷新故障切换的候选备库表，本周期发生过切换时集群的信息已经变化，等下一个周期再刷新
+                if not has_failover and failover_candidate.is_enabled():
+                    try:
+                        failover_candidate.refresh(cluster_dict, clu_db_list, snapshot)
+                    except Exception:
+                        logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during refresh failover candidate: {traceback.format_exc()}")
+
+            # 检查负载均衡
             try:
-
-                if not cluster_dict.get('auto_failback'):  # 如果集群没有设置自动加回的标志，则无需自动加回集群
-                    time.sleep(probe_interval)
-                    continue
-
-                # 先把集群设置为checking状态，防止在检查过程中对集群有其他并发操作
-                ret = dao.test_and_set_cluster_state(self.cluster_id, [cluster_state.NORMAL], cluster_state.CHECKING)
-                if ret is None:
-                    logging.debug(f"cluster({self.cluster_id}) state is not online, next time to check...")
-                    time.sleep(probe_interval)
-                    continue
+                sr_ha_check_cstlb(cluster_dict, clu_db_list)
             except Exception:
-                err_msg = traceback.format_exc()
-                logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during set cluster state to  CHECKING: {err_msg}")
-                time.sleep(probe_interval)
-                continue
+                logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check cstlb: {traceback.format_exc()}")
 
-            # check the database
-            clu_state = cluster_state.NORMAL
-            try:
-                cluster_dict = dao.get_cluster(self.cluster_id)
-                if cluster_dict is None:
-                    logging.info(f"exit health check thread when cluster({self.cluster_id}) has been deleted")
-                    break
-
-                state = cluster_dict['state']
-                clu_db_list = dao.get_cluster_db_list(self.cluster_id)
-                if len(clu_db_list) == 0:
-                    logging.debug(f"exit health check thread when cluster({self.cluster_id}) has been deleted")
-                    break
+        except Exception:
+            err_msg = traceback.format_exc()
+            logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check database: {err_msg}")
+            return probe_interval
+        finally:
+            if has_failover or clu_state != cluster_state.NORMAL:
+                self.save_state(token, clu_state)
+
+        # 如果集群设置了自动加回的标志，则检查是否有需要自动加回集群的数据库
+        if cluster_dict.get('auto_failback') and clu_state == cluster_state.NORMAL and cluster_lease.is_valid(self.cluster_id, token):
+            self.check_failback(probe_interval)
+        # 有可疑的数据库时，缩短下一次检查的间隔
+        return failure_detector.get_next_interval([pg['db_id'] for pg in clu_db_list], probe_interval)
+
+    def check_failback(self, probe_interval):
+        """
+        检查集群中故障的数据库，如果其主机已恢复，则自动加回集群
+        """
+        # check and try add the database to cluster
+        # 调用时仍持有检查的租约并且集群状态为NORMAL，不需要再把集群设置为checking状态
+        clu_state = cluster_state.NORMAL
+        try:
+            cluster_dict = dao.get_cluster(self.cluster_id)
+            if cluster_dict is None:
+                logging.info(f"stop failback check when cluster({self.cluster_id}) has been deleted")
+                return
 
-                db_port = cluster_dict['port']
-                cluster_id = cluster_dict['cluster_id']
-                for pg in clu_db_list:
-                    host = pg['host']
-                    is_primary = pg['is_primary']
+            clu_db_list = dao.get_cluster_db_list(self.cluster_id)
+            if len(clu_db_list) == 0:
+                logging.debug(f"stop failback check when cluster({self.cluster_id}) has been deleted")
+                return
 
-                    if pg['state'] == node_state.FAULT and cluster_dict.get('auto_failback') and pg['db_id'] not in FAILBACK_DB_LIST:
-                        err_code, err_msg = rpc_utils.get_rpc_connect(pg['host'])
-                        if err_code != 0:
+            cluster_id = cluster_dict['cluster_id']
+            for pg in clu_db_list:
+                if pg['state'] == node_state.FAULT and cluster_dict.get('auto_failback') and pg['db_id'] not in FAILBACK_DB_LIST:
+                    err_code, err_msg = rpc_utils.get_rpc_connect(pg['host'])
+                    if err_code != 0:
+                        continue
+                    rpc = err_msg
+                    rpc.close()
+
+                    db_id = pg['db_id']
+                    up_db_id = pg['up_db_id']
+                    if not up_db_id:
+                        primary = dao.get_primary_info(cluster_id)
+                        if primary:
+                            up_db_id = primary['db_id']
+                        else:
                             continue
-                        rpc = err_msg
-                        rpc.close()
-
-                        db_id = pg['db_id']
-                        up_db_id = pg['up_db_id']
-                        if not up_db_id:
-                            primary = dao.get_primary_info(cluster_id)
-                            if primary:
-                                up_db_id = primary['db_id']
-                            else:
-                                continue
-                        dao.set_cluster_state(cluster_id, cluster_state.REPAIRING)
-                        ha_mgr.check_auto_failback(cluster_id, db_id, up_db_id, clu_state)
-                        clu_state = None
-                        break
+                    dao.set_cluster_state(cluster_id, cluster_state.REPAIRING)
+                    ha_mgr.check_auto_failback(cluster_id, db_id, up_db_id, clu_state)
+                    clu_state = None
+                    break
+
+        except Exception as e:
+            logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check database: {str(e)}")
+
+
+# 所有集群的检查由这一个调度器来执行
+__checker_dict = {}
+__checker_lock = threading.Lock()
+__scheduler = None
+# cluster_id -> 最后一次因为agent事件触发检查的时间
+__event_trigger_time_dict = {}
+
+
+def run_cluster_check(cluster_id):
+    __checker_lock.acquire()
+    try:
+        checker = __checker_dict.get(cluster_id)
+    finally:
+        __checker_lock.release()
+    if checker is None:
+        return None
+
+    begin_time = time.time()
+    next_interval = checker.check()
+    metric_store.record(metric_store.METRIC_CHECK_DURATION, cluster_id, time.time() - begin_time)
+    if next_interval is None:
+        metric_store.remove_obj(cluster_id, [metric_store.METRIC_CHECK_DURATION, metric_store.METRIC_WAL_RATE])
+        __checker_lock.acquire()
+        try:
+            __checker_dict.pop(cluster_id, None)
+        finally:
+            __checker_lock.release()
+        logging.info(f"ha cluster({cluster_id}) check stoped")
+    return next_interval
+
+
+def get_scheduler():
+    global __scheduler
+
+    __checker_lock.acquire()
+    try:
+        if __scheduler is None:
+            worker_cnt = int(config.get('ha_check_worker_cnt', 0))
+            jitter = float(config.get('ha_check_jitter', 0.1))
+            __scheduler = check_scheduler.CheckScheduler('ha-check', run_cluster_check, worker_cnt, jitter)
+            __scheduler.start()
+        return __scheduler
+    finally:
+        __checker_lock.release()
+
+
+def add_cluster_check(cluster_id):
+    """
+    把集群加入到定时检查的调度中
+    :return: 如果集群已经在检查中，返回False
+    """
+    scheduler = get_scheduler()
+    __checker_lock.acquire()
+    try:
+        if cluster_id in __checker_dict:
+            return False
+        __checker_dict[cluster_id] = SrHaChecker(cluster_id)
+    finally:
+        __checker_lock.release()
+    scheduler.add(cluster_id, int(config.get('sr_ha_check_interval', 10)))
+    return True
+
+
+def on_agent_event(host, event_type, event_dict):
+    """
+    收到agent上报的事件后，立即检查在此主机上有数据库的集群，同一个集群1秒内最多触发一次
+    """
+    scheduler = get_scheduler()
+    cluster_id_list = dao.get_cluster_id_list_by_host(host)
+    curr_time = time.time()
+    for cluster_id in cluster_id_list:
+        __checker_lock.acquire()
+        try:
+            if cluster_id not in __checker_dict:
+                continue
+            if curr_time - __event_trigger_time_dict.get(cluster_id, 0) < 1:
+                continue
+            __event_trigger_time_dict[cluster_id] = curr_time
+        finally:
+            __checker_lock.release()
+        if scheduler.trigger(cluster_id):
+            logging.info(f"Cluster({cluster_id}): check immediately because of agent event({event_type}) from host({host}).")
 
-            except Exception as e:
-                logging.error(f"Cluster({self.cluster_id}): Unexpected error occurred during check database: {str(e)}")
-            finally:
-                if clu_state is not None:
-                    # 把集群的状态恢复
-                    dao.set_cluster_state(self.cluster_id, clu_state)
-                    time.sleep(probe_interval)
 
-        logging.info(f"ha cluster({self.cluster_id}) thread stoped")
+def get_check_stats():
+    """
+    获得健康检查调度的统计信息，包括调度延迟
+    """
+    return get_scheduler().get_stats()
 
 
 class ClusterChangeChecker(threading.Thread):
@@ -563,14 +820,11 @@ class ClusterChangeChecker(threading.Thread):
                     if cluster_id in pre_cluster_list:
                         continue
                     cluster_type = dao.get_cluster_type(cluster_id)
-                    if cluster_type == 1:
-                        db_checker = SrHaChecker(cluster_id)
-                        db_checker.start()
-                    # Leifliu Test
-                    elif cluster_type == 11:
-                        db_checker = SrHaChecker(cluster_id)
-                        db_checker.start()
-                    logging.info(f"ha cluster({cluster_id}) thread started")
+                    # Leifliu Test: cluster_type == 11
+                    if cluster_type not in (1, 11):
+                        continue
+                    if add_cluster_check(cluster_id):
+                        logging.info(f"ha cluster({cluster_id}) check started")
                 pre_cluster_list = cluster_list
             except Exception:
                 logging.error(f"Cluster: Unexpected error occurred during check database: {traceback.format_exc()}")
@@ -584,12 +838,15 @@ class ClusterChangeChecker(threading.Thread):
 def start_check():
     # host_checker = HostChecker()
     # host_checker.start()
-    # 启动一个检查是否有新增ha cluster的线程，如果发现有一个新的ha cluster，就启动一个新的线程服务这个ha cluster
+    # 启动一个检查是否有新增ha cluster的线程，如果发现有一个新的ha cluster，就把这个ha cluster加入到检查调度器中
     logging.info("Start new ha cluster checker thread...")
     cluster_changer_checker = ClusterChangeChecker()
     cluster_changer_checker.start()
     logging.info("new ha cluster checker thread started.")
 
+    # agent上报数据库进程退出等事件时，立即检查相关的集群
+    agent_event.subscribe(on_agent_event)
+
     # 基于实例的检查
     # logging.info("begin start instance checker thread...")
     # instance_checker = InstanceChecker()
@@ -22,43 +22,186 @@
 @description: 负载均衡管理的模块
 """
 
-import urllib.error
-import urllib.request
+import http.client
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import config
 
+# lb_addr -> LbConnection，每个负载均衡器保持一个长连接
+__lb_conn_dict = {}
+# lb_addr -> {'backend_set': 最后一次同步到负载均衡器上的后端, 'sync_time': 同步的时间}
+__pushed_dict = {}
+__lb_lock = threading.Lock()
 
-def add_backend(lb_addr, backend_addr):
-    token = config.get("cstlb_token")
-    url = f"http://{lb_addr}/backend/add?backend={backend_addr}&token={token}"
-    try:
-        response = urllib.request.urlopen(url)
-        http_code = response.getcode()
+
+class LbConnection:
+    """
+    到一个负载均衡器的http长连接，连接断开后下次请求时自动重连
+    """
+
+    def __init__(self, lb_addr, timeout=5):
+        self.lb_addr = lb_addr
+        self.timeout = timeout
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+    def __request_once(self, path):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.lb_addr, timeout=self.timeout)
+        self.conn.request('GET', path)
+        response = self.conn.getresponse()
         data = response.read()
+        if response.will_close:
+            self.close()
+        return response.status, data
+
+    def request(self, path):
+        """
+        :return: 返回(http_code, data)
+        """
+        with self.lock:
+            try:
+                return self.__request_once(path)
+            except (http.client.HTTPException, OSError):
+                # 长连接可能已经被对方关闭了，重连后再试一次
+                self.close()
+            try:
+                return self.__request_once(path)
+            except Exception:
+                self.close()
+                raise
+
+
+def get_lb_conn(lb_addr):
+    with __lb_lock:
+        lb_conn = __lb_conn_dict.get(lb_addr)
+        if lb_conn is None:
+            lb_conn = LbConnection(lb_addr)
+            __lb_conn_dict[lb_addr] = lb_conn
+        return lb_conn
+
+
+def __lb_request(lb_addr, path):
+    try:
+        http_code, data = get_lb_conn(lb_addr).request(path)
         if http_code != 200:
             return http_code, data
         return 0, data
-    except urllib.error.HTTPError as e:
-        return e.getcode(), str(e)
-    except urllib.error.URLError as e:
-        return -1, str(e)
     except Exception as e:
         return -1, str(e)
 
 
+def __add_backend(lb_addr, backend_addr):
+    token = config.get("cstlb_token")
+    return __lb_request(lb_addr, f"/backend/add?backend={backend_addr}&token={token}")
+
+
+def __delete_backend(lb_addr, backend_addr):
+    token = config.get("cstlb_token")
+    return __lb_request(lb_addr, f"/backend/delete?backend={backend_addr}&token={token}")
+
+
+def __invalidate(lb_addr):
+    """
+    在同步之外修改了负载均衡器上的后端，下次检查时需要重新同步
+    """
+    with __lb_lock:
+        __pushed_dict.pop(lb_addr, None)
+
+
+def add_backend(lb_addr, backend_addr):
+    __invalidate(lb_addr)
+    return __add_backend(lb_addr, backend_addr)
+
+
 def delete_backend(lb_addr, backend_addr):
+    __invalidate(lb_addr)
+    return __delete_backend(lb_addr, backend_addr)
+
+
+def list_backend(lb_addr):
+    """
+    :return: 返回(err_code, backend_list)，出错时第二个值为错误信息
+    """
     token = config.get("cstlb_token")
-    url = f"http://{lb_addr}/backend/delete?backend={backend_addr}&token={token}"
+    err_code, data = __lb_request(lb_addr, f"/backend/list?token={token}")
+    if err_code != 0:
+        return err_code, data
     try:
-        response = urllib.request.urlopen(url)
-        http_code = response.getcode()
-        data = response.read()
-        if http_code != 200:
-            return http_code, data
-        return 0, data
-    except urllib.error.HTTPError as e:
-        return e.getcode(), str(e)
-    except urllib.error.URLError as e:
-        return -1, str(e)
+        return 0, list(json.loads(data).keys())
     except Exception as e:
-        return -1, str(e)
+        return -1, f"Invalid backend list: {str(e)}"
+
+
+def __sync_lb(cluster_id, lb_addr, backend_set):
+    err_code, data = list_backend(lb_addr)
+    if err_code != 0:
+        logging.error(f"Cluster({cluster_id}): Unable to get backend list from the load balancer: {lb_addr}: \n {data}")
+        return False
+
+    lb_backend_set = set(data)
+    cstlb_del = lb_backend_set - backend_set
+    cstlb_add = backend_set - lb_backend_set
+    is_ok = True
+    if cstlb_del:
+        logging.info(f'need delete {sorted(cstlb_del)} from {lb_addr}')
+    for backend_addr in cstlb_del:
+        status, data = __delete_backend(lb_addr, backend_addr)
+        if status != 0:
+            is_ok = False
+            logging.error(data)
+    if cstlb_add:
+        logging.info(f'need add {sorted(cstlb_add)} to {lb_addr}')
+    for backend_addr in cstlb_add:
+        status, data = __add_backend(lb_addr, backend_addr)
+        if status != 0:
+            is_ok = False
+            logging.error(data)
+    return is_ok
+
+
+def sync_backends(cluster_id, lb_addr_list, backend_set):
+    """
+    把负载均衡器上的后端同步为backend_set，只有后端有变化，或到了定期重新同步的时间(cstlb_resync_interval)，
+    才会去访问负载均衡器，多个负载均衡器并发同步
+    """
+
+    resync_interval = int(config.get('cstlb_resync_interval', 300))
+    backend_set = set(backend_set)
+    now = time.time()
+    need_sync_list = []
+    with __lb_lock:
+        for lb_addr in lb_addr_list:
+            pushed = __pushed_dict.get(lb_addr)
+            if pushed and pushed['backend_set'] == backend_set and now - pushed['sync_time'] < resync_interval:
+                continue
+            need_sync_list.append(lb_addr)
+    if not need_sync_list:
+        return
+
+    with ThreadPoolExecutor(len(need_sync_list), thread_name_prefix=f"cstlb-sync-{cluster_id}") as executor:
+        future_list = [executor.submit(__sync_lb, cluster_id, lb_addr, backend_set) for lb_addr in need_sync_list]
+    for lb_addr, future in zip(need_sync_list, future_list):
+        try:
+            is_ok = future.result()
+        except Exception as e:
+            logging.error(f"Cluster({cluster_id}): Unexpected error occurred during sync cstlb({lb_addr}): {repr(e)}")
+            is_ok = False
+        with __lb_lock:
+            if is_ok:
+                __pushed_dict[lb_addr] = {'backend_set': backend_set, 'sync_time': now}
+            else:
+                # 同步失败时下次检查再重新同步
+                __pushed_dict.pop(lb_addr, None)
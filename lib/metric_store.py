@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 内存中的时序指标存储，记录探测延迟、复制延迟、WAL产生速度、检查耗时等指标的历史，供界面画图使用
+每个指标在内存中按1秒、1分钟、1小时三种精度各保存一个定长的环形缓冲区(array)，写入时同时累加到三种精度的桶中，
+分钟和小时精度的桶可以批量持久化到clup数据库的clup_metric_bucket表中
+"""
+
+import logging
+import threading
+import time
+import traceback
+from array import array
+
+import config
+import csuapp
+import dbapi
+
+# 各个健康检查模块记录的指标，obj_id为db_id的指标和obj_id为cluster_id的指标
+METRIC_PROBE_LATENCY = 'probe_latency'       # 探测数据库的耗时(秒)，obj_id为db_id
+METRIC_REPL_DELAY = 'repl_replay_delay'      # 备库的回放延迟(字节)，obj_id为db_id
+METRIC_WAL_RATE = 'wal_rate'                 # 主库每秒产生的WAL(字节)，obj_id为cluster_id
+METRIC_CHECK_DURATION = 'ha_check_duration'  # 一次集群健康检查的耗时(秒)，obj_id为cluster_id
+
+METRIC_NAME_LIST = [METRIC_PROBE_LATENCY, METRIC_REPL_DELAY, METRIC_WAL_RATE, METRIC_CHECK_DURATION]
+
+# (每个桶的秒数, 桶的个数)：1秒精度保留10分钟，1分钟精度保留1天，1小时精度保留30天
+RESOLUTION_LIST = [(1, 600), (60, 1440), (3600, 720)]
+
+# 只持久化大于等于此精度的桶
+PERSIST_MIN_STEP = 60
+
+# (metric_name, obj_id) -> MetricSeries
+__series_dict = {}
+__series_lock = threading.Lock()
+__persist_thread = None
+
+
+class RingBuckets:
+    """
+    一种精度的环形缓冲区，时间t落在编号为t//step的桶中，桶放在编号对size取模的槽位上，
+    槽位上原来的桶编号不一致时说明是已经过期的旧桶，直接覆盖
+    """
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.bucket = array('q', [-1]) * size
+        self.cnt = array('L', [0]) * size
+        self.sum = array('d', [0.0]) * size
+        self.min = array('d', [0.0]) * size
+        self.max = array('d', [0.0]) * size
+        # 已经持久化到数据库中的最后一个桶的编号
+        self.persisted_bucket = -1
+
+    def add(self, ts, value):
+        b = int(ts // self.step)
+        slot = b % self.size
+        if self.bucket[slot] != b:
+            self.bucket[slot] = b
+            self.cnt[slot] = 1
+            self.sum[slot] = value
+            self.min[slot] = value
+            self.max[slot] = value
+            return
+        self.cnt[slot] += 1
+        self.sum[slot] += value
+        if value < self.min[slot]:
+            self.min[slot] = value
+        if value > self.max[slot]:
+            self.max[slot] = value
+
+    def retention(self):
+        return self.step * self.size
+
+    def query(self, begin_time, end_time):
+        """
+        :return: 返回[[桶的开始时间, 平均值, 最小值, 最大值], ...]
+        """
+        begin_b = int(begin_time // self.step)
+        end_b = int(end_time // self.step)
+        begin_b = max(begin_b, end_b - self.size + 1)
+        rows = []
+        for b in range(begin_b, end_b + 1):
+            slot = b % self.size
+            if self.bucket[slot] != b or self.cnt[slot] == 0:
+                continue
+            rows.append([b * self.step, self.sum[slot] / self.cnt[slot], self.min[slot], self.max[slot]])
+        return rows
+
+    def get_unpersisted(self, now):
+        """
+        获得已经结束但还没有持久化的桶，写入数据库成功后再调用set_persisted
+        :return: 返回(rows, persisted_bucket)，rows为[(桶的开始时间, 平均值, 最小值, 最大值, 样本数), ...]
+        """
+        curr_b = int(now // self.step)
+        begin_b = max(self.persisted_bucket + 1, curr_b - self.size + 1)
+        rows = []
+        for b in range(begin_b, curr_b):
+            slot = b % self.size
+            if self.bucket[slot] != b or self.cnt[slot] == 0:
+                continue
+            rows.append((b * self.step, self.sum[slot] / self.cnt[slot], self.min[slot], self.max[slot], self.cnt[slot]))
+        return rows, curr_b - 1
+
+    def set_persisted(self, persisted_bucket):
+        self.persisted_bucket = max(self.persisted_bucket, persisted_bucket)
+
+
+class MetricSeries:
+    def __init__(self, metric_name, obj_id):
+        self.metric_name = metric_name
+        self.obj_id = obj_id
+        self.level_list = [RingBuckets(step, size) for step, size in RESOLUTION_LIST]
+        self.lock = threading.Lock()
+
+    def add(self, ts, value):
+        with self.lock:
+            for level in self.level_list:
+                level.add(ts, value)
+
+    def choose_level(self, begin_time, end_time, now, max_points):
+        """
+        选择能覆盖开始时间并且点数不超过max_points的最细的精度，都不满足时用最粗的精度
+        """
+        for level in self.level_list:
+            if now - begin_time > level.retention():
+                continue
+            if (end_time - begin_time) / level.step > max_points:
+                continue
+            return level
+        return self.level_list[-1]
+
+    def query(self, level, begin_time, end_time):
+        with self.lock:
+            return level.query(begin_time, end_time)
+
+    def get_unpersisted(self, now):
+        """
+        :return: 返回(rows, mark_list)，mark_list在写入数据库成功后传给set_persisted
+        """
+        ret = []
+        mark_list = []
+        with self.lock:
+            for level in self.level_list:
+                if level.step < PERSIST_MIN_STEP:
+                    continue
+                rows, persisted_bucket = level.get_unpersisted(now)
+                mark_list.append((level, persisted_bucket))
+                for row in rows:
+                    ret.append((level.step, ) + row)
+        return ret, mark_list
+
+    def set_persisted(self, mark_list):
+        with self.lock:
+            for level, persisted_bucket in mark_list:
+                level.set_persisted(persisted_bucket)
+
+
+def get_series(metric_name, obj_id, create=True):
+    key = (metric_name, obj_id)
+    with __series_lock:
+        series = __series_dict.get(key)
+        if series is None and create:
+            series = MetricSeries(metric_name, obj_id)
+            __series_dict[key] = series
+        return series
+
+
+def record(metric_name, obj_id, value, ts=None):
+    """
+    记录一个指标的样本
+    """
+    if value is None:
+        return
+    if ts is None:
+        ts = time.time()
+    get_series(metric_name, obj_id).add(ts, float(value))
+
+
+def remove_obj(obj_id, metric_name_list=None):
+    """
+    数据库或集群删除后，删除其内存中的指标
+    """
+    with __series_lock:
+        for key in list(__series_dict.keys()):
+            if key[1] != obj_id:
+                continue
+            if metric_name_list is not None and key[0] not in metric_name_list:
+                continue
+            del __series_dict[key]
+
+
+def list_series():
+    with __series_lock:
+        return sorted(__series_dict.keys(), key=lambda k: (k[0], str(k[1])))
+
+
+def is_persist_enabled():
+    return int(config.get('metric_persist_interval', 0)) > 0
+
+
+def query_persisted(metric_name, obj_id, step, begin_time, end_time):
+    """
+    从clup数据库中查询已经持久化的桶，用f_pivot_time_bucket按step重新分桶
+    """
+    sql = "SELECT extract(epoch FROM f_pivot_time_bucket(%s * interval '1 second', bucket_time))::bigint AS tm, " \
+          " sum(avg_val * sample_cnt) / sum(sample_cnt) AS avg_val, min(min_val) AS min_val, max(max_val) AS max_val " \
+          " FROM clup_metric_bucket " \
+          " WHERE metric_name = %s AND obj_id = %s AND bucket_secs = %s " \
+          "   AND bucket_time >= to_timestamp(%s) AND bucket_time < to_timestamp(%s) " \
+          " GROUP BY 1 ORDER BY 1"
+    bucket_secs = RESOLUTION_LIST[-1][0] if step >= RESOLUTION_LIST[-1][0] else PERSIST_MIN_STEP
+    rows = dbapi.query(sql, (step, metric_name, obj_id, bucket_secs, begin_time, end_time))
+    return [[row['tm'], row['avg_val'], row['min_val'], row['max_val']] for row in rows]
+
+
+def query_range(metric_name, obj_id, begin_time=None, end_time=None, max_points=720):
+    """
+    查询一段时间内的指标，不会访问被监控的数据库
+    :return: 返回(step, rows)，rows为[[时间, 平均值, 最小值, 最大值], ...]
+    """
+    now = time.time()
+    if end_time is None:
+        end_time = now
+    if begin_time is None:
+        begin_time = end_time - 3600
+    max_points = max(int(max_points), 1)
+
+    series = get_series(metric_name, obj_id, create=False)
+    if series is None:
+        series = MetricSeries(metric_name, obj_id)
+    level = series.choose_level(begin_time, end_time, now, max_points)
+    rows = series.query(level, begin_time, end_time)
+
+    # 超出内存保留时间的部分从数据库中补齐
+    mem_begin_time = now - level.retention()
+    if begin_time < mem_begin_time and is_persist_enabled():
+        try:
+            old_rows = query_persisted(metric_name, obj_id, level.step, begin_time, min(end_time, mem_begin_time))
+            if rows:
+                old_rows = [row for row in old_rows if row[0] < rows[0][0]]
+            rows = old_rows + rows
+        except Exception:
+            logging.error(f"Can not query persisted metric {metric_name}({obj_id}): {traceback.format_exc()}")
+    return level.step, rows
+
+
+def persist():
+    """
+    把已经结束的分钟和小时精度的桶批量写入数据库，一次写入所有指标
+    """
+    now = time.time()
+    with __series_lock:
+        series_list = list(__series_dict.values())
+
+    name_list, obj_list, step_list, time_list = [], [], [], []
+    avg_list, min_list, max_list, cnt_list = [], [], [], []
+    series_mark_list = []
+    for series in series_list:
+        rows, mark_list = series.get_unpersisted(now)
+        series_mark_list.append((series, mark_list))
+        for step, tm, avg_val, min_val, max_val, cnt in rows:
+            name_list.append(series.metric_name)
+            obj_list.append(series.obj_id)
+            step_list.append(step)
+            time_list.append(tm)
+            avg_list.append(avg_val)
+            min_list.append(min_val)
+            max_list.append(max_val)
+            cnt_list.append(cnt)
+    if name_list:
+        sql = "INSERT INTO clup_metric_bucket(metric_name, obj_id, bucket_secs, bucket_time, avg_val, min_val, max_val, sample_cnt) " \
+              " SELECT m, o, s, to_timestamp(t), a, mi, ma, c " \
+              " FROM unnest(%s::text[], %s::int[], %s::int[], %s::float8[], %s::float8[], %s::float8[], %s::float8[], %s::int[]) " \
+              "   AS x(m, o, s, t, a, mi, ma, c) " \
+              " ON CONFLICT (metric_name, obj_id, bucket_secs, bucket_time) DO UPDATE SET " \
+              " avg_val = EXCLUDED.avg_val, min_val = EXCLUDED.min_val, max_val = EXCLUDED.max_val, sample_cnt = EXCLUDED.sample_cnt"
+        # 写入失败时抛出异常，桶不标记为已持久化，下次再写
+        dbapi.execute(sql, (name_list, obj_list, step_list, time_list, avg_list, min_list, max_list, cnt_list))
+    for series, mark_list in series_mark_list:
+        series.set_persisted(mark_list)
+    return len(name_list)
+
+
+def purge_persisted():
+    keep_days = int(config.get('metric_persist_days', 30))
+    sql = "DELETE FROM clup_metric_bucket WHERE bucket_time < now() - %s * interval '1 day'"
+    dbapi.execute(sql, (keep_days, ))
+
+
+def persist_loop():
+    last_purge_time = 0
+    while not csuapp.is_exit():
+        interval = int(config.get('metric_persist_interval', 0))
+        if interval <= 0:
+            time.sleep(5)
+            continue
+        begin_time = time.time()
+        try:
+            cnt = persist()
+            logging.debug(f"{cnt} metric buckets persisted.")
+            if begin_time - last_purge_time > 3600:
+                purge_persisted()
+                last_purge_time = begin_time
+        except Exception:
+            logging.error(f"Can not persist metric buckets: {traceback.format_exc()}")
+        sleep_secs = interval - (time.time() - begin_time)
+        while sleep_secs > 0 and not csuapp.is_exit():
+            time.sleep(min(sleep_secs, 1))
+            sleep_secs -= 1
+
+
+def start():
+    global __persist_thread
+    if __persist_thread is not None:
+        return
+    __persist_thread = threading.Thread(target=persist_loop, name="metric-persist", daemon=True)
+    __persist_thread.start()
@@ -1468,22 +1468,29 @@ def get_max_lsn_db(db_list):
     @param db_list:
     @return:
     """
-    curr_lsn = ''
-    new_pri_pg = None
+    db_id_list = []
+    lsn_req_list = []
     for db in db_list:
         db_id = db['db_id']
         db = dao.get_db_info(db_id)
         if not db:
             logging.error(f"Failed to obtain database(db_id={db_id}) information.")
             continue
-        err_code, lsn, _ = probe_db.get_last_lsn(db[0]['host'], db[0]['port'], db[0]['repl_user'], db_encrypt.from_db_text(db[0]['repl_pass']))
+        db_id_list.append(db_id)
+        lsn_req_list.append((db[0]['host'], db[0]['port'], db[0]['repl_user'], db_encrypt.from_db_text(db[0]['repl_pass'])))
+
+    # 并发获得所有数据库的lsn，选择lsn最大的数据库，lsn相同时选择排在前面的
+    curr_rank = None
+    new_pri_pg = None
+    for idx, err_code, lsn, _ in probe_db.get_last_lsn_of_list(lsn_req_list):
+        db_id = db_id_list[idx]
         if err_code != 0:
             logging.error(f"Failed to obtain database(db_id={db_id}) lsn information. error: {lsn}")
             continue
-        if lsn > curr_lsn and not new_pri_pg:
-            curr_lsn = lsn
+        rank = (-pg_db_lib.lsn_to_int(lsn), idx)
+        if curr_rank is None or rank < curr_rank:
+            curr_rank = rank
             new_pri_pg = db_id
-            continue
     return new_pri_pg
 
 
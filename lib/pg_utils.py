@@ -53,42 +53,62 @@ def get_stream_status(pri_db_host, pri_db_port, db_user, db_pass, standby_name):
     return msg[0][0]
 
 
-def get_repl_delay(pri_db_host, pri_db_port, db_user, db_pass, cur_wal):
-    # 先判断是否是10以上的版本：
-    sql = """select count(*) as cnt from pg_proc p, pg_namespace n where p.pronamespace=n.oid and n.nspname='pg_catalog' and p.proname = 'pg_current_wal_lsn'"""
-    conn = psycopg2.connect(database='template1', user=db_user, password=db_pass, host=pri_db_host, port=pri_db_port)
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+def get_current_wal_lsn(conn):
+    """
+    获得数据库当前的wal位置，10版本及以上用wal的函数，9版本用xlog的函数
+    """
+    if conn.server_version >= 100000:
+        sql = "SELECT pg_current_wal_lsn() AS cur_wal"
+    else:
+        sql = "SELECT pg_current_xlog_location() AS cur_wal"
+    cur = conn.cursor()
     cur.execute(sql)
     rows = cur.fetchall()
-    if rows[0]['cnt'] > 0:
+    cur.close()
+    return rows[0][0]
+
+
+def query_repl_delay(conn, cur_wal):
+    """
+    在已经建立的连接上查询各个备库相对于cur_wal的延迟，根据连接上的版本号选择wal或xlog的函数，不用再查询pg_proc
+    """
+    if conn.server_version >= 100000:
         sql = "select application_name as repl_name, \n"\
-              f"    '{cur_wal}' as current_lsn,\n"\
-              f"    pg_wal_lsn_diff('{cur_wal}', sent_lsn) as sent_delay,\n"\
-              f"    pg_wal_lsn_diff('{cur_wal}', write_lsn) as write_delay,\n"\
-              f"    pg_wal_lsn_diff('{cur_wal}', flush_lsn) as flush_delay,\n"\
-              f"    pg_wal_lsn_diff('{cur_wal}', replay_lsn) as replay_delay,\n" \
+              "    %(cur_wal)s as current_lsn,\n"\
+              "    pg_wal_lsn_diff(%(cur_wal)s, sent_lsn) as sent_delay,\n"\
+              "    pg_wal_lsn_diff(%(cur_wal)s, write_lsn) as write_delay,\n"\
+              "    pg_wal_lsn_diff(%(cur_wal)s, flush_lsn) as flush_delay,\n"\
+              "    pg_wal_lsn_diff(%(cur_wal)s, replay_lsn) as replay_delay,\n" \
               "    state,\n" \
               "    sync_state as is_sync\n"\
               " from pg_stat_replication;"
     else:
         sql = "select application_name as repl_name, \n"\
-              f"    '{cur_wal}' as current_lsn,\n"\
-              f"    pg_xlog_location_diff('{cur_wal}', sent_location) as sent_delay,\n"\
-              f"    pg_xlog_location_diff('{cur_wal}', write_location) as write_delay,\n"\
-              f"    pg_xlog_location_diff('{cur_wal}', flush_location) as flush_delay,\n"\
-              f"    pg_xlog_location_diff('{cur_wal}', replay_location) as replay_delay,\n" \
+              "    %(cur_wal)s as current_lsn,\n"\
+              "    pg_xlog_location_diff(%(cur_wal)s, sent_location) as sent_delay,\n"\
+              "    pg_xlog_location_diff(%(cur_wal)s, write_location) as write_delay,\n"\
+              "    pg_xlog_location_diff(%(cur_wal)s, flush_location) as flush_delay,\n"\
+              "    pg_xlog_location_diff(%(cur_wal)s, replay_location) as replay_delay,\n" \
               "    state,\n" \
               "    sync_state as is_sync\n"\
               " from pg_stat_replication;"
 
-    cur.execute(sql)
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(sql, {'cur_wal': cur_wal})
     msg = cur.fetchall()
     conn.commit()
     cur.close()
-    conn.close()
     return msg
 
 
+def get_repl_delay(pri_db_host, pri_db_port, db_user, db_pass, cur_wal):
+    conn = psycopg2.connect(database='template1', user=db_user, password=db_pass, host=pri_db_host, port=pri_db_port)
+    try:
+        return query_repl_delay(conn, cur_wal)
+    finally:
+        conn.close()
+
+
 def get_last_lsn(host, port, user, password):
     """
     获得数据库的最后LSN(log sequence number)
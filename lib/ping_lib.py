@@ -27,6 +27,7 @@ import os
 import select
 import socket
 import struct
+import threading
 import time
 
 # From /usr/include/linux/icmp.h; your milage may vary.
@@ -164,5 +165,111 @@ def ping_ip(dest_addr, timeout=2, count=100):
         else:
             return 0
 
+__ping_id_seq = 0
+__ping_id_lock = threading.Lock()
+
+
+def __get_ping_id():
+    """
+    多个线程同时ping时，每次调用使用不同的ID，这样各自只接收自己的回包
+    """
+    global __ping_id_seq
+    with __ping_id_lock:
+        __ping_id_seq += 1
+        return (os.getpid() + __ping_id_seq) & 0xFFFF
+
+
+def __make_ping_packet(ID, seq):
+    header = struct.pack("bbHHh", ICMP_ECHO_REQUEST, 0, 0, ID, seq)
+    bytesInDouble = struct.calcsize("d")
+    data = (192 - bytesInDouble) * "Q"
+    data = struct.pack("d", time.time()) + bytes(data, 'utf-8')
+    my_checksum = __checksum(header + data)
+    header = struct.pack("bbHHh", ICMP_ECHO_REQUEST, 0, socket.htons(my_checksum), ID, seq)
+    return header + data
+
+
+def ping_ip_list(ip_list, timeout=2, count=1, stop_on_first=False):
+    """
+    用一个raw socket同时ping多个IP，所有IP共用一个超时时间，
+    在超时时间内均匀的发送count轮，每轮只发给还没有收到回包的IP
+    :param stop_on_first: 为True时，收到任何一个IP的回包就立即返回，用于判断自己是否是孤岛
+    :return: 字典，key为ip，value为往返时间(秒)，没有收到回包的IP的值为None
+    """
+
+    result_dict = {ip: None for ip in ip_list}
+    if not ip_list:
+        return result_dict
+
+    # 发送的包中的序号是IP在列表中的下标，收到回包时用序号和源地址找到对应的IP
+    addr_list = []
+    for ip in ip_list:
+        try:
+            addr_list.append(socket.gethostbyname(ip))
+        except socket.gaierror as e:
+            logging.error(f"ping {ip} failed. (socket error: '{str(e)}')")
+            addr_list.append(None)
+
+    icmp = socket.getprotobyname("icmp")
+    try:
+        my_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp)
+    except PermissionError as e:
+        logging.error(f"{str(e)} - Note that ICMP messages can only be sent from processes running as root.")
+        return result_dict
+
+    try:
+        my_ID = __get_ping_id()
+        poller = select.poll()
+        poller.register(my_socket, select.POLLIN)
+        begin_time = time.time()
+        deadline = begin_time + timeout
+        round_interval = timeout / max(1, count)
+        next_send_time = begin_time
+        send_cnt = 0
+        while True:
+            now = time.time()
+            if now >= deadline:
+                break
+            if send_cnt < count and now >= next_send_time:
+                for seq, addr in enumerate(addr_list):
+                    if addr is None or result_dict[ip_list[seq]] is not None:
+                        continue
+                    my_socket.sendto(__make_ping_packet(my_ID, seq), (addr, 1))
+                send_cnt += 1
+                next_send_time = begin_time + send_cnt * round_interval
+
+            wait_until = deadline if send_cnt >= count else min(deadline, next_send_time)
+            event_list = poller.poll(max(0, int((wait_until - time.time()) * 1000)))
+            if not event_list:
+                continue
+
+            timeReceived = time.time()
+            recPacket, addr = my_socket.recvfrom(1024)
+            icmpHeader = recPacket[20:28]
+            type, code, checksum, packetID, seq = struct.unpack("bbHHh", icmpHeader)
+            if type != 0 or packetID != my_ID or seq < 0 or seq >= len(addr_list) or addr[0] != addr_list[seq]:
+                continue
+            bytesInDouble = struct.calcsize("d")
+            timeSent = struct.unpack("d", recPacket[28:28 + bytesInDouble])[0]
+            ip = ip_list[seq]
+            if result_dict[ip] is None:
+                result_dict[ip] = timeReceived - timeSent
+            if stop_on_first:
+                break
+            if all(result_dict[ip] is not None for ip, addr in zip(ip_list, addr_list) if addr is not None):
+                break
+    finally:
+        my_socket.close()
+    return result_dict
+
+
+def is_any_ip_reachable(ip_list, timeout=2, count=1):
+    """
+    判断是否有任何一个IP能ping通
+    """
+    result_dict = ping_ip_list(ip_list, timeout, count, stop_on_first=True)
+    return any(rtt is not None for rtt in result_dict.values())
+
+
 # if __name__ == '__main__':
 #     ping_ip("192.168.1.10",2,1)
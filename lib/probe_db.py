@@ -25,15 +25,20 @@
 import os
 import json
 import queue
+import collections
 import time
 import uuid
 import ctypes
+import select
 import logging
 import threading
 import traceback
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 
 import config
@@ -45,6 +50,17 @@ g_q_reply = None     # 进程间接收已完成的命令的队列
 
 g_cmd_dict = {}
 g_cmd_dict_lock = threading.Lock()
+# cmd_id -> threading.Event，命令的结果返回时置位
+g_cmd_event_dict = {}
+
+# 分发命令结果的线程
+g_reply_dispatcher = None
+g_reply_dispatcher_lock = threading.Lock()
+
+# 并发获取多个数据库lsn的线程池，web工作进程是fork出来的，不能使用主进程中的线程池
+g_lsn_executor = None
+g_lsn_executor_pid = None
+g_lsn_executor_lock = threading.Lock()
 
 
 
@@ -78,6 +94,7 @@ def get_cmd_result(cmd_id):
         cmd_dict = g_cmd_dict[cmd_id]
         if cmd_dict['run_is_over']:
             del g_cmd_dict[cmd_id]
+            g_cmd_event_dict.pop(cmd_id, None)
             return True, cmd_dict['err_code'], cmd_dict['err_msg']
         else:
             return False, 0, ''
@@ -86,10 +103,25 @@ def get_cmd_result(cmd_id):
 
 
 def save_cmd_dict(cmd_dict):
+    """
+    保存命令，同时返回一个事件，命令的结果返回时此事件会被置位
+    """
     g_cmd_dict_lock.acquire()
     try:
         cmd_id = cmd_dict['id']
         g_cmd_dict[cmd_id] = cmd_dict
+        event = threading.Event()
+        g_cmd_event_dict[cmd_id] = event
+        return event
+    finally:
+        g_cmd_dict_lock.release()
+
+
+def remove_cmd_dict(cmd_id):
+    g_cmd_dict_lock.acquire()
+    try:
+        g_cmd_dict.pop(cmd_id, None)
+        g_cmd_event_dict.pop(cmd_id, None)
     finally:
         g_cmd_dict_lock.release()
 
@@ -103,10 +135,50 @@ def update_cmd_data(new_cmd_dict):
             return
         cmd_dict = g_cmd_dict[cmd_id]
         cmd_dict.update(new_cmd_dict)
+        event = g_cmd_event_dict.get(cmd_id)
+        if event is not None and cmd_dict['run_is_over']:
+            event.set()
     finally:
         g_cmd_dict_lock.release()
 
 
+def reply_dispatcher():
+    """
+    从g_q_reply中取命令的结果，唤醒等待这个命令结果的线程，整个进程中只有这一个线程读g_q_reply
+    """
+    while True:
+        try:
+            reply = g_q_reply.get(timeout=1)
+        except queue.Empty:
+            continue
+        except Exception:
+            err_msg = traceback.format_exc()
+            logging.error(f"probe reply dispatcher get reply failed: {err_msg}")
+            time.sleep(1)
+            continue
+        try:
+            update_cmd_data(reply)
+        except Exception:
+            err_msg = traceback.format_exc()
+            logging.error(f"probe reply dispatcher unexpected error: {err_msg}")
+
+
+def start_reply_dispatcher():
+    """
+    启动分发命令结果的线程，需要在fork出探测服务进程之后才能启动，所以在第一次执行命令时启动
+    """
+    global g_reply_dispatcher
+
+    if g_reply_dispatcher is not None:
+        return
+    with g_reply_dispatcher_lock:
+        if g_reply_dispatcher is not None:
+            return
+        t = threading.Thread(target=reply_dispatcher, name="probe-reply-dispatcher", daemon=True)
+        t.start()
+        g_reply_dispatcher = t
+
+
 def __probe_pg_db(sql, host, port, db, user, password):
     conn = psycopg2.connect(database=db, user=user, password=password, host=host, port=port)
     conn.autocommit = True
@@ -168,19 +240,30 @@ def __get_last_wal_file(host, port, user, password):
         return -1, traceback.format_exc()
 
 
-def probe_child_process(request_queue, target_func, cmd_dict):
+# 各命令类型对应的执行函数
+g_cmd_func_dict = {
+    CMD_TYPE_PROBE_PG: __probe_pg_db,
+    CMD_TYPE_EXEC_SQL: __pg_exec_sql,
+    CMD_TYPE_RUN_SQL: __pg_run_sql,
+    CMD_TYPE_GET_LAST_LSN: __get_last_lsn,
+    CMD_TYPE_GET_LAST_WAL_FILE: __get_last_wal_file,
+}
+
+
+def run_probe_cmd(result_queue, cmd_dict):
     """
-    :return: 返回错误码和错误信息，如果错误码为0，表示成功，否则表示失败
+    执行一个命令，把结果放到result_queue中
     """
 
     try:
+        target_func = g_cmd_func_dict[cmd_dict['type']]
         target_args = cmd_dict['args']
         err_code, err_msg = target_func(*target_args)
         cmd_dict['req_action'] = REQ_RECV_CMD_RESULT
         cmd_dict['run_is_over'] = True
         cmd_dict['err_code'] = err_code
         cmd_dict['err_msg'] = err_msg
-        request_queue.put(cmd_dict)
+        result_queue.put(cmd_dict)
     except Exception as e:
         err_msg = traceback.format_exc()
         logging.error(f"run probe cmd({cmd_dict['id']}) failed: {err_msg}")
@@ -188,51 +271,170 @@ def probe_child_process(request_queue, target_func, cmd_dict):
         cmd_dict['err_code'] = -1
         cmd_dict['err_msg'] = str(e)
         cmd_dict['req_action'] = REQ_RECV_CMD_RESULT
-        request_queue.put(cmd_dict)
+        result_queue.put(cmd_dict)
 
 
-def clean_expired_cmd(reply_queue):
-    """清除过期的命令
+def probe_worker(worker_queue, result_queue):
+    """
+    常驻的探测工作进程，从worker_queue中取命令执行，执行结果放到result_queue中
     """
-    try:
-        need_clean_dict = {}
-        for cmd_id in g_cmd_dict:
-            cmd_dict = g_cmd_dict[cmd_id]
-            curr_time = time.time()
-            if curr_time - cmd_dict['start_time'] > cmd_dict['survival_secs']:
-                need_clean_dict[cmd_id] = cmd_dict
 
-        for cmd_id in need_clean_dict:
-            cmd_dict = g_cmd_dict[cmd_id]
-            del g_cmd_dict[cmd_id]
-            cmd_dict['req_action'] = REQ_RECV_CMD_RESULT
-            cmd_dict['err_code'] = -1
-            cmd_dict['err_msg'] = 'timeout'
-            _cmd_type = cmd_dict['type']
-            _target_args = cmd_dict['args']
-
-            desensitized_args = get_desensitized_args(cmd_dict)
-            if 'process' in cmd_dict:
-                p = cmd_dict['process']
-                del cmd_dict['process']
-                pid = p.pid
-                try:
-                    os.kill(pid, 9)
-                except OSError:
-                    pass
-            logging.info(f"clean probe cmd({cmd_id}): {desensitized_args}")
-            cmd_dict['run_end_time'] = time.time()
-            cmd_dict['run_is_over'] = True
-            reply_queue.put(cmd_dict)
-    except Exception:
-        err_msg = traceback.format_exc()
-        logging.error(f"clean expired probe cmd unexpected error: {err_msg}")
+    # 当探测服务进程结束时，本进程也自动结束
+    libc = ctypes.CDLL('libc.so.6')
+    PR_SET_PDEATHSIG = 1
+    libc.prctl(PR_SET_PDEATHSIG, 9)
+
+    while True:
+        cmd_dict = worker_queue.get()
+        if cmd_dict is None:
+            break
+        run_probe_cmd(result_queue, cmd_dict)
 
 
-# 在系统开始时，就马上启动一个服务进程，这个服务进程接受后续的执行外部命令的请求，收到请求后启动一个新的进程来执行外部命令，这样可以保证fork时没有其他线程，从而保证线程安全
-def probe_service(request_queue, reply_queue):
-    global g_cmd_dict
+class ProbeWorkerPool:
+    """
+    探测工作进程池，在探测服务进程中使用。
+    命令先放到等待队列中，有空闲的工作进程时再分配给它；命令超时时只杀掉执行这个命令的工作进程，再启动一个新的工作进程替换它
+    """
+
+    def __init__(self, worker_cnt, result_queue):
+        self.worker_cnt = worker_cnt
+        self.result_queue = result_queue
+        self.worker_seq = 0
+        # worker_id -> {'process': 进程对象, 'queue': 发送命令的队列, 'cmd_id': 正在执行的命令ID}
+        self.worker_dict = {}
+        # 等待分配工作进程的命令ID
+        self.pending_cmd_list = collections.deque()
+
+    def start(self):
+        for _i in range(self.worker_cnt):
+            self.__start_worker()
+
+    def __start_worker(self):
+        self.worker_seq += 1
+        worker_id = self.worker_seq
+        worker_queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=probe_worker, args=(worker_queue, self.result_queue),
+                                    name=f"probe-worker-{worker_id}")
+        p.daemon = True
+        p.start()
+        self.worker_dict[worker_id] = {'process': p, 'queue': worker_queue, 'cmd_id': None}
+        return worker_id
+
+    def __kill_worker(self, worker_id):
+        worker = self.worker_dict.pop(worker_id)
+        p = worker['process']
+        try:
+            os.kill(p.pid, 9)
+        except OSError:
+            pass
+        try:
+            p.join(1)
+        except Exception:
+            pass
+        worker['queue'].close()
+        # 启动一个新的工作进程替换被杀掉的进程
+        self.__start_worker()
+
+    def __dispatch(self):
+        """
+        把等待中的命令分配给空闲的工作进程
+        """
+        for worker_id, worker in self.worker_dict.items():
+            if not self.pending_cmd_list:
+                return
+            if worker['cmd_id'] is not None:
+                continue
+            while self.pending_cmd_list:
+                cmd_id = self.pending_cmd_list.popleft()
+                if cmd_id not in g_cmd_dict:  # 在等待中就已经超时被清理掉了
+                    continue
+                cmd_dict = g_cmd_dict[cmd_id]
+                cmd_dict['worker_id'] = worker_id
+                # 命令的超时时间从分配给工作进程时开始计算，在等待队列中的时间不算
+                cmd_dict['start_time'] = time.time()
+                worker['cmd_id'] = cmd_id
+                worker['queue'].put(cmd_dict)
+                break
 
+    def submit(self, cmd_dict):
+        cmd_id = cmd_dict['id']
+        cmd_dict['queue_time'] = time.time()
+        cmd_dict['start_time'] = None
+        g_cmd_dict[cmd_id] = cmd_dict
+        self.pending_cmd_list.append(cmd_id)
+        self.__dispatch()
+
+    def complete(self, q_cmd_dict):
+        """
+        收到工作进程发来的命令结果
+        :return: 返回完整的cmd_dict，如果此命令已经被清理掉了，返回None
+        """
+        worker_id = q_cmd_dict.get('worker_id')
+        worker = self.worker_dict.get(worker_id)
+        cmd_id = q_cmd_dict['id']
+        if worker and worker['cmd_id'] == cmd_id:
+            worker['cmd_id'] = None
+
+        cmd_dict = g_cmd_dict.pop(cmd_id, None)
+        self.__dispatch()
+        if cmd_dict is None:  # 可能是过期的任务又执行结束了，这个任务已经被清理掉了
+            return None
+        cmd_dict.update(q_cmd_dict)
+        return cmd_dict
+
+    def __reply_error(self, reply_queue, cmd_id, err_msg):
+        cmd_dict = g_cmd_dict.pop(cmd_id)
+        cmd_dict['req_action'] = REQ_RECV_CMD_RESULT
+        cmd_dict['err_code'] = -1
+        cmd_dict['err_msg'] = err_msg
+        desensitized_args = get_desensitized_args(cmd_dict)
+        logging.info(f"clean probe cmd({cmd_id}): {err_msg}: {desensitized_args}")
+        cmd_dict['run_end_time'] = time.time()
+        cmd_dict['run_is_over'] = True
+        reply_queue.put(cmd_dict)
+
+    def clean(self, reply_queue):
+        """
+        清除过期的命令，并检查工作进程是否异常退出
+        """
+        try:
+            curr_time = time.time()
+            expired_cmd_set = set()
+            # 在等待队列中就超时的命令，没有工作进程在执行，直接回复超时，不用杀工作进程
+            queue_expired_cmd_set = set()
+            for cmd_id, cmd_dict in g_cmd_dict.items():
+                if cmd_dict['start_time'] is None:
+                    if curr_time - cmd_dict['queue_time'] > cmd_dict['survival_secs']:
+                        queue_expired_cmd_set.add(cmd_id)
+                elif curr_time - cmd_dict['start_time'] > cmd_dict['survival_secs']:
+                    expired_cmd_set.add(cmd_id)
+
+            for worker_id in list(self.worker_dict.keys()):
+                worker = self.worker_dict[worker_id]
+                cmd_id = worker['cmd_id']
+                if cmd_id in expired_cmd_set:
+                    logging.info(f"kill probe worker(pid={worker['process'].pid}) which running timeout cmd({cmd_id}).")
+                    self.__kill_worker(worker_id)
+                elif not worker['process'].is_alive():
+                    logging.error(f"probe worker(pid={worker['process'].pid}) exited unexpectedly, restart it.")
+                    self.__kill_worker(worker_id)
+                    if cmd_id is not None and cmd_id in g_cmd_dict:
+                        self.__reply_error(reply_queue, cmd_id, 'probe worker exited unexpectedly')
+
+            for cmd_id in expired_cmd_set:
+                self.__reply_error(reply_queue, cmd_id, 'timeout')
+            for cmd_id in queue_expired_cmd_set:
+                self.__reply_error(reply_queue, cmd_id, 'timeout while waiting for an idle probe worker')
+            self.__dispatch()
+        except Exception:
+            err_msg = traceback.format_exc()
+            logging.error(f"clean expired probe cmd unexpected error: {err_msg}")
+
+
+# 在系统开始时，就马上启动一个服务进程，这个服务进程接受后续的执行外部命令的请求，
+# 服务进程启动时先fork出一组常驻的工作进程，收到请求后交给空闲的工作进程执行，这样可以保证fork时没有其他线程，从而保证线程安全
+def probe_service(request_queue, reply_queue, worker_cnt):
     try:
         log_file = os.path.join(config.get_log_path(), 'clup_probe.log')
         logger.reinit(logging.INFO, log_file)
@@ -246,12 +448,16 @@ def probe_service(request_queue, reply_queue):
         # 设置PR_SET_PDEATHSIG，就是让父进程死亡时，子进程会退出
         libc.prctl(PR_SET_PDEATHSIG, 9)
 
+        # 工作进程执行完的结果也发到request_queue中
+        worker_pool = ProbeWorkerPool(worker_cnt, request_queue)
+        worker_pool.start()
+        logging.info(f"probe service started with {worker_cnt} workers.")
         last_clean_time = time.time()
 
         while True:
             curr_time = time.time()
-            if curr_time - last_clean_time > 2:
-                clean_expired_cmd(reply_queue)
+            if curr_time - last_clean_time > 0.2:
+                worker_pool.clean(reply_queue)
                 last_clean_time = time.time()
 
             try:
@@ -261,23 +467,12 @@ def probe_service(request_queue, reply_queue):
 
             req_action = cmd_dict['req_action']
             if req_action == REQ_RUN_CMD:
-                # 收到执行命令的请求后，启动一个新的进程，然后执行
                 cmd_id = cmd_dict['id']
                 cmd_type = cmd_dict['type']
                 desensitized_args = get_desensitized_args(cmd_dict)
                 logging.info(f"recv probe cmd({cmd_id}): {desensitized_args}")
 
-                if cmd_type == CMD_TYPE_PROBE_PG:
-                    p = multiprocessing.Process(target=probe_child_process, args=(request_queue, __probe_pg_db, cmd_dict))
-                elif cmd_type == CMD_TYPE_EXEC_SQL:
-                    p = multiprocessing.Process(target=probe_child_process, args=(request_queue, __pg_exec_sql, cmd_dict))
-                elif cmd_type == CMD_TYPE_RUN_SQL:
-                    p = multiprocessing.Process(target=probe_child_process, args=(request_queue, __pg_run_sql, cmd_dict))
-                elif cmd_type == CMD_TYPE_GET_LAST_LSN:
-                    p = multiprocessing.Process(target=probe_child_process, args=(request_queue, __get_last_lsn, cmd_dict))
-                elif cmd_type == CMD_TYPE_GET_LAST_WAL_FILE:
-                    p = multiprocessing.Process(target=probe_child_process, args=(request_queue, __get_last_wal_file, cmd_dict))
-                else:
+                if cmd_type not in g_cmd_func_dict:
                     cmd_dict['run_is_over'] = True
                     cmd_dict['err_code'] = -1
                     cmd_dict['err_msg'] = f'unknown cmd type: {cmd_type}'
@@ -285,32 +480,13 @@ def probe_service(request_queue, reply_queue):
                     logging.info(f"probe cmd({cmd_id}) start failed, reply: {desensitized_args}")
                     reply_queue.put(cmd_dict)
                     continue
-
-                p.start()
-                cmd_dict['process'] = p
-                cmd_dict['start_time'] = time.time()
-                g_cmd_dict[cmd_id] = cmd_dict
+                worker_pool.submit(cmd_dict)
 
             if req_action == REQ_RECV_CMD_RESULT:
-                # cmd_dict是从另一个进程发过来的，所以还没有 process对象，先暂存到q_cmd_dict
-                q_cmd_dict = cmd_dict
-                cmd_id = cmd_dict['id']
-                if cmd_id not in g_cmd_dict:  # 可能是过期的任务又执行结束了，这个任务已经被清理掉了
+                cmd_dict = worker_pool.complete(cmd_dict)
+                if cmd_dict is None:
                     continue
-                # 把cmd_dict换成g_cmd_dict中的，同时把另一个进程发过来的信息更新进来
-                cmd_dict = g_cmd_dict[cmd_id]
-                del g_cmd_dict[cmd_id]
-                cmd_dict.update(q_cmd_dict)
-
-                # 跨进程传递数据时，把process对象给删除掉
-                p = cmd_dict['process']
-                del cmd_dict['process']
-                try:
-                    p.join()
-                except ChildProcessError:
-                    pass
-                _target_args = cmd_dict['args']
-                cmd_type = cmd_dict['type']
+                cmd_id = cmd_dict['id']
                 desensitized_args = get_desensitized_args(cmd_dict)
                 cmd_dict['msg_time'] = time.time()
                 logging.info(f"reply probe cmd({cmd_id}): {desensitized_args}  ......")
@@ -323,7 +499,7 @@ def probe_service(request_queue, reply_queue):
     logging.info("probe service normal exit.")
 
 
-def start_service():
+def start_service(worker_cnt=None):
     global g_q_request
     global g_q_reply
 
@@ -331,7 +507,11 @@ def start_service():
     g_q_request = multiprocessing.Queue(1000)
     g_q_reply = multiprocessing.Queue(1000)
 
-    p = multiprocessing.Process(target=probe_service, args=(g_q_request, g_q_reply))
+    if worker_cnt is None:
+        worker_cnt = int(config.get('probe_worker_cnt', 8))
+    if worker_cnt < 1:
+        worker_cnt = 1
+    p = multiprocessing.Process(target=probe_service, args=(g_q_request, g_q_reply, worker_cnt))
     p.daemon = False
     p.start()
 
@@ -381,40 +561,160 @@ def run_with_timeout(cmd_type, target_args, time_out=10):
     cmd_dict['type'] = cmd_type
     cmd_dict['args'] = target_args
     desensitized_args = get_desensitized_args(cmd_dict)
+    start_reply_dispatcher()
     # 保存到g_cmd_dict全局变量中
-    save_cmd_dict(cmd_dict)
+    event = save_cmd_dict(cmd_dict)
 
     g_q_request.put(cmd_dict)
     logging.debug(f"run probe cmd({cmd_dict['id']}) {desensitized_args} ...")
 
+    # 探测服务在命令超时后会返回超时的结果，这里多等一会，如果还没有收到结果，说明探测服务出了问题，直接返回超时
     begin_time = time.time()
-    last_warn_time = 0
-    while True:
+    if not event.wait(timeout=float(time_out) + 5):
         curr_time = time.time()
-        if int(curr_time - begin_time) > time_out and curr_time - last_warn_time > 30:
-            logging.warning(f"cmd({cmd_dict['id']}) {desensitized_args} wait time {int(curr_time - begin_time)} seconds more than timeout({time_out})!")
-            last_warn_time = curr_time
+        logging.warning(f"cmd({cmd_dict['id']}) {desensitized_args} wait time {int(curr_time - begin_time)} seconds more than timeout({time_out})!")
+        remove_cmd_dict(cmd_id)
+        return -1, 'timeout'
+
+    run_is_over, err_code, err_msg = get_cmd_result(cmd_id)  # 如果命令已经运行结束，则会从全局变量g_cmd_dict移除
+    logging.debug(f"probe cmd({cmd_id}) result: err_code={err_code}, err_msg={err_msg} ")
+    return err_code, err_msg
+
+
+class ProbeConn:
+    """
+    探测数据库用的长连接，使用libpq的异步接口，所有的网络等待都用select加超时，保证探测不会超过指定的时间。
+    连接建立后一直保持，只有在探测失败时才关闭，下次探测时再重新连接。
+    """
 
+    def __init__(self, host, port, db, user, password, time_out):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.user = user
+        self.password = password
+        self.time_out = time_out
+        self.conn = None
+        self.last_used_time = time.time()
+
+    def __wait(self, deadline):
+        fd = self.conn.fileno()
+        while True:
+            state = self.conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            remain_secs = deadline - time.time()
+            if remain_secs <= 0:
+                raise TimeoutError('timeout')
+            if state == psycopg2.extensions.POLL_READ:
+                select.select([fd], [], [], remain_secs)
+            elif state == psycopg2.extensions.POLL_WRITE:
+                select.select([], [fd], [], remain_secs)
+            else:
+                raise psycopg2.OperationalError(f"bad state from poll: {state}")
+
+    def connect(self, deadline):
+        # statement_timeout让数据库端也能在超时后结束SQL，keepalives让连接断开后能尽快被发现
+        self.conn = psycopg2.connect(
+            database=self.db, user=self.user, password=self.password, host=self.host, port=self.port,
+            application_name='clup_probe',
+            options=f"-c statement_timeout={int(self.time_out * 1000)}",
+            keepalives=1, keepalives_idle=5, keepalives_interval=2, keepalives_count=3,
+            async_=1)
+        self.__wait(deadline)
+
+    def probe(self, sql):
+        deadline = time.time() + self.time_out
         try:
-            reply = g_q_reply.get_nowait()
-            # 收到的reply，可能是别的线程中发的命令，没有关系，更新到g_cmd_dict中
-            logging.debug(f"probe cmd({cmd_id}) get a reply({reply['id']})")
-            update_cmd_data(reply)
-            logging.debug(f"probe cmd({cmd_id}), save reply({reply['id']}) to g_cmd_dict.")
-        except queue.Empty:
-            pass
-        run_is_over, err_code, err_msg = get_cmd_result(cmd_id)  # 如果命令已经运行结束，则会从全局变量g_cmd_dict移除
-        # logging.debug(f"probe cmd({cmd_id}), get_cmd_result return: {run_is_over}.")
-        if not run_is_over:
-            time.sleep(0.1)
-            continue
-        logging.debug(f"probe cmd({cmd_id}) result: err_code={err_code}, err_msg={err_msg} ")
-        return err_code, err_msg
+            if self.conn is None or self.conn.closed:
+                self.connect(deadline)
+            cur = self.conn.cursor()
+            try:
+                cur.execute(sql)
+                self.__wait(deadline)
+            finally:
+                cur.close()
+        except Exception:
+            self.close()
+            raise
+        finally:
+            self.last_used_time = time.time()
+        return 0, '0'
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+
+# 探测用的长连接池: (host, port, db, user, password, time_out) -> 空闲的ProbeConn列表
+g_probe_conn_dict = {}
+g_probe_conn_lock = threading.Lock()
+
+
+def __get_probe_conn(host, port, db, user, password, time_out):
+    key = (host, port, db, user, password, time_out)
+    curr_time = time.time()
+    idle_conn = None
+    expired_conn_list = []
+    g_probe_conn_lock.acquire()
+    try:
+        conn_list = g_probe_conn_dict.get(key)
+        if conn_list:
+            idle_conn = conn_list.pop()
+        # 关闭长时间不用的连接，如数据库已从集群中删除，或集群的探测参数改变了
+        for k in list(g_probe_conn_dict.keys()):
+            conn_list = g_probe_conn_dict[k]
+            expired_conn_list.extend([c for c in conn_list if curr_time - c.last_used_time > 600])
+            conn_list[:] = [c for c in conn_list if curr_time - c.last_used_time <= 600]
+            if not conn_list:
+                del g_probe_conn_dict[k]
+    finally:
+        g_probe_conn_lock.release()
+
+    for probe_conn in expired_conn_list:
+        probe_conn.close()
+    if idle_conn:
+        return idle_conn
+    return ProbeConn(host, port, db, user, password, time_out)
+
+
+def __put_probe_conn(probe_conn):
+    key = (probe_conn.host, probe_conn.port, probe_conn.db, probe_conn.user, probe_conn.password, probe_conn.time_out)
+    g_probe_conn_lock.acquire()
+    try:
+        g_probe_conn_dict.setdefault(key, []).append(probe_conn)
+    finally:
+        g_probe_conn_lock.release()
+
+
+def probe_postgres_keep_conn(host, port, db, user, password, sql, time_out=10):
+    """
+    使用长连接探测数据库，不需要每次都fork进程和重新连接数据库
+    :return: 返回错误码和错误信息，如果错误码为0，表示成功，否则表示失败
+    """
+
+    time_out = float(time_out)
+    probe_conn = __get_probe_conn(host, port, db, user, password, time_out)
+    try:
+        return probe_conn.probe(sql)
+    except TimeoutError:
+        return -1, 'timeout'
+    except Exception as e:
+        return -1, str(e)
+    finally:
+        __put_probe_conn(probe_conn)
 
 
 def probe_postgres(host, port, db, user, password, sql, time_out=10):
     """
     """
+    if int(config.get('probe_keep_conn', 1)):
+        return probe_postgres_keep_conn(host, port, db, user, password, sql, time_out)
+
     cmd_type = CMD_TYPE_PROBE_PG
     target_args = (sql, host, port, db, user, password)
     err_code, err_msg = run_with_timeout(cmd_type, target_args, time_out)
@@ -441,6 +741,52 @@ def get_last_lsn(host, port, user, password, time_out=10):
     return err_code, err_msg, ''
 
 
+def get_lsn_executor():
+    global g_lsn_executor
+    global g_lsn_executor_pid
+
+    with g_lsn_executor_lock:
+        if g_lsn_executor is None or g_lsn_executor_pid != os.getpid():
+            worker_cnt = int(config.get('get_lsn_thread_cnt', 32))
+            g_lsn_executor = ThreadPoolExecutor(worker_cnt, thread_name_prefix="get-last-lsn")
+            g_lsn_executor_pid = os.getpid()
+        return g_lsn_executor
+
+
+def get_last_lsn_of_list(db_list, time_out=10):
+    """
+    并发获得多个数据库的最后的LSN，所有数据库共用一个截止时间，超过截止时间还没有返回的数据库按失败处理
+    :param db_list: 列表，元素为(host, port, user, password)
+    :return: 生成器，按结果返回的先后顺序产生(idx, err_code, lsn, time_line)，idx为在db_list中的下标，
+             err_code不为0时，lsn为错误信息
+    """
+
+    if not db_list:
+        return
+    executor = get_lsn_executor()
+    future_dict = {}
+    for idx, (host, port, user, password) in enumerate(db_list):
+        future = executor.submit(get_last_lsn, host, port, user, password, time_out)
+        future_dict[future] = idx
+
+    done_set = set()
+    try:
+        for future in as_completed(future_dict, timeout=float(time_out) + 5):
+            done_set.add(future)
+            idx = future_dict[future]
+            try:
+                err_code, lsn, time_line = future.result()
+            except Exception as e:
+                err_code, lsn, time_line = -1, str(e), ''
+            yield idx, err_code, lsn, time_line
+    except FutureTimeoutError:
+        for future, idx in future_dict.items():
+            if future not in done_set:
+                # 还在排队的不再执行
+                future.cancel()
+                yield idx, -1, 'timeout', ''
+
+
 def get_last_wal_file(host, port, user, password, time_out=10):
     """
     获得一个数据库的最后的LSN(log sequence number)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 流复制延迟的后台采样，定期获取所有集群的复制延迟和各个数据库的LSN，界面和接口直接使用最新的采样结果
+"""
+
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import check_shard
+import config
+import csuapp
+import dao
+import ha_mgr
+import metric_store
+import pg_db_lib
+
+# cluster_id -> {'repl_delay': (sample_time, data), 'last_lsn': (sample_time, data)}
+__sample_dict = {}
+__sample_lock = threading.Lock()
+# cluster_id -> (采样时间, 主库的lsn)，用于计算WAL的产生速度
+__last_wal_dict = {}
+__sampler_thread = None
+
+
+def get_sample_interval():
+    return int(config.get('repl_sample_interval', 10))
+
+
+def save_sample(cluster_id, sample_type, data):
+    with __sample_lock:
+        __sample_dict.setdefault(cluster_id, {})[sample_type] = (time.time(), data)
+
+
+def get_sample_item(cluster_id, sample_type):
+    """
+    获得最新的采样结果和采样时间，超过三个采样周期没有更新的结果认为已经过期
+    :param sample_type: 'repl_delay' 或 'last_lsn'
+    :return: 返回(sample_time, data)，没有采样结果或已经过期时返回None
+    """
+    interval = get_sample_interval()
+    if interval <= 0:
+        return None
+    with __sample_lock:
+        item = __sample_dict.get(cluster_id, {}).get(sample_type)
+    if item is None:
+        return None
+    if time.time() - item[0] > interval * 3:
+        return None
+    return item
+
+
+def get_sample(cluster_id, sample_type):
+    """
+    获得最新的采样结果
+    :return: 没有采样结果或已经过期时返回None
+    """
+    item = get_sample_item(cluster_id, sample_type)
+    if item is None:
+        return None
+    return item[1]
+
+
+def remove_cluster(cluster_id):
+    with __sample_lock:
+        __sample_dict.pop(cluster_id, None)
+
+
+def record_repl_delay_metric(data):
+    for row in data:
+        if row['is_primary'] or not isinstance(row['replay_delay'], int):
+            continue
+        metric_store.record(metric_store.METRIC_REPL_DELAY, row['db_id'], row['replay_delay'])
+
+
+def record_wal_rate_metric(cluster_id, data, sample_time):
+    for db_id, _host, is_primary, _timeline, lsn in data:
+        if not is_primary or not isinstance(lsn, str) or '/' not in lsn:
+            continue
+        lsn = pg_db_lib.lsn_to_int(lsn)
+        with __sample_lock:
+            last = __last_wal_dict.get(cluster_id)
+            __last_wal_dict[cluster_id] = (sample_time, lsn)
+        # 切换后主库的lsn可能变小，这时不计算速度
+        if last is not None and sample_time > last[0] and lsn >= last[1]:
+            metric_store.record(metric_store.METRIC_WAL_RATE, cluster_id, (lsn - last[1]) / (sample_time - last[0]), sample_time)
+        return
+
+
+def sample_cluster(cluster_id):
+    try:
+        err_code, data = ha_mgr.collect_repl_delay(cluster_id)
+        if err_code == 0:
+            save_sample(cluster_id, 'repl_delay', data)
+            record_repl_delay_metric(data)
+        sample_time = time.time()
+        err_code, data = ha_mgr.collect_last_lsn(cluster_id)
+        if err_code == 0:
+            save_sample(cluster_id, 'last_lsn', data)
+            record_wal_rate_metric(cluster_id, data, sample_time)
+    except Exception:
+        logging.error(f"Cluster({cluster_id}): Unexpected error occurred during sample replication delay: {traceback.format_exc()}")
+
+
+def sample_loop():
+    worker_cnt = int(config.get('repl_sample_worker_cnt', 4))
+    with ThreadPoolExecutor(worker_cnt, thread_name_prefix="repl-sampler") as executor:
+        while not csuapp.is_exit():
+            interval = get_sample_interval()
+            if interval <= 0:
+                time.sleep(1)
+                continue
+            begin_time = time.time()
+            try:
+                # 多台clup分摊检查时，只采样分给自己的集群，其他集群查看时再实时获取
+                cluster_id_list = [cluster_id for cluster_id in dao.get_cluster_id_list_by_type((1, 11))
+                                   if check_shard.is_owner(cluster_id)]
+                # 已经删除的集群不再保留采样结果
+                with __sample_lock:
+                    for cluster_id in list(__sample_dict.keys()):
+                        if cluster_id not in cluster_id_list:
+                            del __sample_dict[cluster_id]
+                            __last_wal_dict.pop(cluster_id, None)
+                # 一个集群采样完之前不会开始下一轮，所以同一个集群同时只会有一个采样在进行
+                list(executor.map(sample_cluster, cluster_id_list))
+            except Exception:
+                logging.debug(f"Can not sample replication delay, try again later: {traceback.format_exc()}")
+            sleep_secs = interval - (time.time() - begin_time)
+            while sleep_secs > 0 and not csuapp.is_exit():
+                time.sleep(min(sleep_secs, 1))
+                sleep_secs -= 1
+
+
+def start():
+    global __sampler_thread
+    if __sampler_thread is not None:
+        return
+    __sampler_thread = threading.Thread(target=sample_loop, name="repl-sampler-main", daemon=True)
+    __sampler_thread.start()
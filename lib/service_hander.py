@@ -26,6 +26,8 @@ import copy
 import logging
 import threading
 
+import agent_event
+import agent_tracker
 import cluster_state
 import config
 import csuapp
@@ -33,6 +35,7 @@ import dao
 import dbapi
 import general_task_mgr
 import ha_mgr
+import metric_store
 import pg_db_lib
 import pg_helpers
 import task_type_def
@@ -66,6 +69,23 @@ class ServiceHandle:
         }
         return 0, ret_dict
 
+    @staticmethod
+    def report_agent_event(ip, event_type, event_dict=None):
+        """
+        clup-agent上报事件，如数据库进程退出、磁盘满、vip丢失等，收到事件后健康检查会立即检查相关的集群
+        :param ip: agent所在主机的IP
+        :param event_type: 事件类型，见agent_event.EVENT_TYPE_LIST
+        :param event_dict: 事件的详细信息，如pgdata、vip等
+        :return:
+        """
+        if event_type not in agent_event.EVENT_TYPE_LIST:
+            return -1, f"unknown event type: {event_type}"
+        if event_dict is None:
+            event_dict = {}
+        logging.info(f"Receive agent event({event_type}) from host({ip}): {event_dict}")
+        agent_event.publish(ip, event_type, event_dict)
+        return 0, ''
+
     @staticmethod
     def get_all_cluster():
         cluster_list = dao.get_all_cluster()
@@ -120,6 +140,20 @@ class ServiceHandle:
         return ha_mgr.get_repl_delay(cluster_id)
 
 
+    @staticmethod
+    def get_metric_series(metric_name, obj_id, begin_time, end_time, max_points):
+        """
+        web工作进程通过此接口获得主进程内存中的时序指标
+        """
+        return metric_store.query_range(metric_name, obj_id, begin_time, end_time, max_points)
+
+    @staticmethod
+    def get_agent_state_dict():
+        """
+        web工作进程通过此接口获得主进程中记录的各台主机上agent的状态
+        """
+        return agent_tracker.get_state_dict()
+
     @staticmethod
     def online(cluster_id):
         err_code, err_list = ha_mgr.online(cluster_id)
@@ -215,8 +249,11 @@ class ServiceHandle:
         if state != cluster_state.OFFLINE and state != cluster_state.FAILED:
             return -1, f"Can not delete cluster that state is {cluster_state.to_str(state)}!"
         with dbapi.DBProcess() as dbp:
+            rows = dbp.query("SELECT db_id FROM clup_db WHERE cluster_id=%s", (cluster_id,))
             dbp.execute("delete from clup_db WHERE cluster_id=%s", (cluster_id,))
             dbp.execute("delete from clup_cluster WHERE cluster_id=%s", (cluster_id,))
+        for row in rows:
+            metric_store.remove_obj(row['db_id'], [metric_store.METRIC_PROBE_LATENCY, metric_store.METRIC_REPL_DELAY])
         return 0, ''
 
     @staticmethod
@@ -24,17 +24,55 @@
 
 import base64
 import hashlib
+import logging
 import os
 import threading
 import time
+import traceback
 
 import config
+import dbapi
 
 # 字典的格式为{"xxxxxxxxxx":{""}}
 __session_dict = {}
 __lock = threading.RLock()
 
 
+def __use_db():
+    """
+    用多个进程提供web服务时，session保存在clup数据库中，各个web工作进程共享
+    """
+    return int(config.get('http_worker_process_cnt', 0)) > 0
+
+
+def __db_get_session_row(session_id):
+    """
+    :return: 返回(错误信息, session)，session不存在或已过期时返回错误信息
+    """
+    rows = dbapi.query("SELECT user_name, status, expired_time FROM clup_session WHERE session_id = %s", (session_id, ))
+    if not rows:
+        return "session expired!", None
+    row = rows[0]
+    if time.time() > row['expired_time']:
+        dbapi.execute("DELETE FROM clup_session WHERE session_id = %s", (session_id, ))
+        return "session expired!", None
+    return '', row
+
+
+def __db_touch_session(session_id, row, status=None):
+    """
+    延长session的过期时间，剩余时间还多时不更新，避免每个请求都写一次数据库
+    """
+    session_expired_secs = config.getint('session_expired_secs')
+    now = time.time()
+    if status is None and row['expired_time'] - now > session_expired_secs - 60:
+        return
+    if status is None:
+        status = row['status']
+    dbapi.execute("UPDATE clup_session SET status = %s, expired_time = %s WHERE session_id = %s",
+                  (status, now + session_expired_secs, session_id))
+
+
 def get_session(user_name):
     """
     :param user_name:
@@ -42,6 +80,20 @@ def get_session(user_name):
     """
 
     session_id = ""
+    if __use_db():
+        try:
+            now = time.time()
+            dbapi.execute("DELETE FROM clup_session WHERE expired_time < %s", (now, ))
+            session_id = base64.b64encode(os.urandom(32)).decode()
+            session_expired_secs = config.getint('session_expired_secs')
+            dbapi.execute("INSERT INTO clup_session(session_id, user_name, status, expired_time) VALUES (%s, %s, 0, %s)",
+                          (session_id, user_name, now + session_expired_secs))
+        except Exception:
+            # session没有写入数据库时其它工作进程认证不了，返回空让登录失败
+            logging.error(f"Can not save session of user {user_name}: {traceback.format_exc()}")
+            session_id = ""
+        return session_id
+
     __lock.acquire()
     try:
         now = time.time()
@@ -83,6 +135,15 @@ def login(user_name, session_id, client_hash_value):
     hash256.update(hash_key.encode())
     server_hash_value = hash256.hexdigest()
 
+    if __use_db():
+        err_msg, row = __db_get_session_row(session_id)
+        if row is None:
+            return False, err_msg
+        if client_hash_value != server_hash_value:
+            return False, "用户名或密码错误!"
+        __db_touch_session(session_id, row, status=1)
+        return True, "OK"
+
     __lock.acquire()
     try:
         now = time.time()
@@ -129,6 +190,15 @@ def check_session(session_id, _func_name):
     if not config.getint('http_auth'):
         return 0, session_data
 
+    if __use_db():
+        err_msg, row = __db_get_session_row(session_id)
+        if row is None:
+            return -1, err_msg
+        if not row['status']:
+            return -1, "session not login!"
+        __db_touch_session(session_id, row)
+        return 0, session_data
+
     __lock.acquire()
     try:
         now = time.time()
@@ -150,6 +220,13 @@ def check_session(session_id, _func_name):
 def session_is_valid(session_id):
     if not config.getint('http_auth'):
         return True, "OK"
+    if __use_db():
+        err_msg, row = __db_get_session_row(session_id)
+        if row is None:
+            return False, err_msg
+        if not row['status']:
+            return False, "session not login!"
+        return True, "OK"
     __lock.acquire()
     try:
         if session_id not in __session_dict:
@@ -167,6 +244,12 @@ def session_is_valid(session_id):
 
 def logout(session_id):
 
+    if __use_db():
+        rows = dbapi.query("DELETE FROM clup_session WHERE session_id = %s RETURNING session_id", (session_id, ))
+        if not rows:
+            return False, "session not exists!"
+        return True, "OK"
+
     __lock.acquire()
     try:
         if session_id not in __session_dict:
@@ -30,6 +30,7 @@ import math
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import agent_logger
+import check_shard
 import config
 import csu_http
 import dbapi
@@ -77,6 +78,27 @@ def get_clup_host_list(req):
         'clup': clup,
         'primary': True
     })
+
+    # 多台clup分摊检查时，把其他心跳正常的clup也列出来，并给出各自负责检查的集群数
+    # 信息从clup数据库中获取，在web工作进程中也能得到
+    if check_shard.is_enabled():
+        my_server_id = check_shard.get_server_id()
+        ret[0]['server_id'] = my_server_id
+        ret[0]['cluster_cnt'] = 0
+        for member in check_shard.get_member_list():
+            if member['server_id'] == my_server_id:
+                ret[0]['cluster_cnt'] = member['cluster_cnt']
+                continue
+            ret.append({
+                'host': member['host'],
+                'port': member['rpc_port'],
+                'csumdb': True,
+                'url': None,
+                'clup': True,
+                'primary': False,
+                'server_id': member['server_id'],
+                'cluster_cnt': member['cluster_cnt']
+            })
     return 200, json.dumps(ret)
 
 
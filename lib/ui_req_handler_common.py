@@ -25,6 +25,8 @@
 import hashlib
 import json
 
+import agent_fanout
+import agent_tracker
 import cluster_state
 import config
 import csu_http
@@ -76,6 +78,15 @@ def get_dict_list(req):
     return 200, raw_data
 
 
+def __host_is_reachable(ip):
+    err_code, err_msg = rpc_utils.get_rpc_connect(ip, conn_timeout=2)
+    if err_code != 0:
+        return False
+    rpc = err_msg
+    rpc.close()
+    return True
+
+
 def get_dashboard(req):
     cluster_stats = {}
     clu_state_mapping = cluster_state.get_dict()
@@ -111,11 +122,18 @@ def get_dashboard(req):
         cluster_stats[str_state] = row['cnt']
 
     host_stats = {'normal': 0, 'abnormal': 0}
+    # 优先使用后台检查agent的结果，没有结果的主机再并发连接agent
+    is_ok_list = []
+    unknown_ip_list = []
     for row in h_rows:
-        err_code, err_msg = rpc_utils.get_rpc_connect(row['ip'], conn_timeout=2)
-        if err_code == 0:
-            rpc = err_msg
-            rpc.close()
+        state = agent_tracker.get_host_state(row['ip'])
+        if state is None:
+            unknown_ip_list.append((row['ip'],))
+        else:
+            is_ok_list.append(state['is_ok'])
+    is_ok_list.extend(agent_fanout.run_all(__host_is_reachable, unknown_ip_list, False))
+    for is_ok in is_ok_list:
+        if is_ok:
             host_stats['normal'] += 1
         else:
             host_stats['abnormal'] += 1
@@ -28,6 +28,8 @@ import json
 import logging
 import re
 
+import agent_fanout
+import agent_tracker
 import cluster_state
 import config
 import csu_http
@@ -36,6 +38,7 @@ import database_state
 import db_encrypt
 import dbapi
 import helpers
+import metric_store
 import pg_db_lib
 import pg_helpers
 import polar_helpers
@@ -310,6 +313,7 @@ def delete_db(req):
 
     sql = "DELETE FROM clup_db WHERE db_id=%(db_id)s"
     dbapi.execute(sql, pdict)
+    metric_store.remove_obj(db_id, [metric_store.METRIC_PROBE_LATENCY, metric_store.METRIC_REPL_DELAY])
 
     return 200, 'OK'
 
@@ -448,6 +452,38 @@ def pg_reload(req):
     return 200, 'OK'
 
 
+def __get_host_db_run_state(host, pgdata_state_list):
+    """
+    检查一台主机上的各个数据库是否在运行
+    :param pgdata_state_list: 每个元素是(pgdata, db_state)
+    :return: 返回新的db_state的列表
+    """
+    err_code, err_msg = rpc_utils.get_rpc_connect(host, 3)
+    if err_code != 0:
+        return [database_state.FAULT] * len(pgdata_state_list)
+    rpc = err_msg
+    state_list = []
+    try:
+        for pgdata, db_state in pgdata_state_list:
+            if err_code != 0:
+                # agent出错后这台主机上的其他数据库就不检测了,避免重复检查造成接口太慢
+                state_list.append(database_state.FAULT)
+                continue
+            err_code, is_run = pg_db_lib.is_running(rpc, pgdata)
+            if err_code != 0:
+                state_list.append(database_state.FAULT)
+            elif is_run:
+                state_list.append(database_state.RUNNING)
+            # 如果状态不是处于创建中或修复中,直接显示数据库状态为停止
+            elif db_state not in (database_state.CREATING, database_state.REPAIRING, database_state.CREATE_FAILD):
+                state_list.append(database_state.STOP)
+            else:
+                state_list.append(db_state)
+    finally:
+        rpc.close()
+    return state_list
+
+
 def get_all_db_list(req):
     params = {'page_num': 0,
               'page_size': 0,
@@ -504,7 +540,7 @@ def get_all_db_list(req):
         if len(host_data) > 0:
             host_data_dict = {i['ip']: i['hid'] for i in host_data}
     # 获取数据库对应的集群信息
-    err_host_set = set()
+    host_row_dict = {}
     for row in ret_rows:
         # 兼容旧版本,旧版本没有os_user这一列
         if not row['os_user']:
@@ -524,27 +560,23 @@ def get_all_db_list(req):
 
         if row['db_state'] == database_state.CREATING:
             continue
-        if row['host'] in err_host_set:
-            # agent连接超时的数据库状态就不检测了
+        if agent_tracker.is_host_down(row['host']):
+            # agent连接不上的主机上的数据库状态就不检测了
             row['db_state'] = database_state.FAULT
-            continue
-        code, is_run = pg_db_lib.is_running(row['host'], row['pgdata'])
-        if code == 0:
-            if is_run:
-                row['db_state'] = database_state.RUNNING
-            else:
-                # 如果状态不是处于创建中或修复中,直接显示数据库状态为停止
-                # if row['db_state'] not in database_state.get_dict() or row['db_state'] == -1:
-                if row['db_state'] not in (database_state.CREATING, database_state.REPAIRING, database_state.CREATE_FAILD):
-                    row['db_state'] = database_state.STOP
         else:
-            # agent连接超时加到set集合中,避免重复检查造成接口太慢
-            err_host_set.add(row['host'])
-            row['db_state'] = database_state.FAULT
+            host_row_dict.setdefault(row['host'], []).append(row)
         # 20230130增加hid返回
         if host_data_dict:
             row['hid'] = host_data_dict.get(row['host'])
 
+    # 每台主机一个任务，各主机并发检查，超时的主机上的数据库都显示为故障
+    host_list = list(host_row_dict.keys())
+    arg_list = [(host, [(row['pgdata'], row['db_state']) for row in host_row_dict[host]]) for host in host_list]
+    state_list_list = agent_fanout.run_all(__get_host_db_run_state, arg_list, None)
+    for host, state_list in zip(host_list, state_list_list):
+        for i, row in enumerate(host_row_dict[host]):
+            row['db_state'] = state_list[i] if state_list else database_state.FAULT
+
     ret_data = {"total": row_cnt, "page_size": pdict['page_size'], "rows": ret_rows}
     raw_data = json.dumps(ret_data)
     return 200, raw_data
@@ -28,6 +28,8 @@ import logging
 import os
 import traceback
 
+import agent_fanout
+import agent_tracker
 import cluster_state
 import csu_http
 import dao
@@ -37,12 +39,14 @@ import general_task_mgr
 import ha_mgr
 import helpers
 import long_term_task
+import metric_store
 import node_state
 import pg_db_lib
 import pg_helpers
 import polar_lib
 import rpc_utils
 import task_type_def
+import web_worker
 
 
 def get_cluster_list(req):
@@ -164,6 +168,28 @@ def get_cluster_detail(req):
     return 200, raw_data
 
 
+def __get_db_run_state(host, pgdata, db_state):
+    """
+    :return: 根据数据库是否在运行返回新的db_state
+    """
+    err_code, err_msg = rpc_utils.get_rpc_connect(host, 2)
+    if err_code != 0:
+        return database_state.FAULT
+    rpc = err_msg
+    try:
+        err_code, is_run = pg_db_lib.is_running(rpc, pgdata)
+    finally:
+        rpc.close()
+    if err_code != 0:
+        return database_state.FAULT
+    if is_run:
+        return database_state.RUNNING
+    # 如果状态不是处于创建中或修复中,直接显示数据库状态为停止
+    if db_state not in (database_state.CREATING, database_state.REPAIRING, database_state.CREATE_FAILD):
+        return database_state.STOP
+    return db_state
+
+
 def get_cluster_db_list(req):
     params = {
         'page_num': csu_http.MANDATORY | csu_http.INT,
@@ -201,6 +227,7 @@ def get_cluster_db_list(req):
         host_data_dict = {i['ip']: i['hid'] for i in host_data}
 
     # 获得各个数据库的运行状态
+    check_list = []
     for db_dict in rows:
         if host_data_dict:
             db_dict['hid'] = host_data_dict[db_dict['host']]
@@ -213,31 +240,24 @@ def get_cluster_db_list(req):
             db_dict.update(ret)
         else:
             db_dict['room_name'] = '默认机房'
-        if db_dict == database_state.CREATING or db_state == database_state.REPAIRING:
+        if db_state == database_state.CREATING or db_state == database_state.REPAIRING:
             continue
-        err_code, err_msg = rpc_utils.get_rpc_connect(db_dict['host'], 2)
-        if err_code != 0:
+        if agent_tracker.is_host_down(db_dict['host']):
             db_dict['db_state'] = database_state.FAULT
             dao.update_db_state(db_dict['db_id'], database_state.FAULT)
             continue
-        rpc = err_msg
-
-        try:
-            err_code, is_run = pg_db_lib.is_running(rpc, db_dict['pgdata'])
-            if err_code != 0:
-                db_state = database_state.FAULT
-            else:
-                if is_run:
-                    db_state = database_state.RUNNING
-                else:
-                    # 如果状态不是处于创建中或修复中,直接显示数据库状态为停止
-                    if db_state not in (database_state.CREATING, database_state.REPAIRING, database_state.CREATE_FAILD):
-                        db_state = database_state.STOP
-
-            db_dict['db_state'] = db_state
-            dao.update_db_state(db_dict['db_id'], db_dict['db_state'])
-        finally:
-            rpc.close()
+        check_list.append(db_dict)
+
+    # 并发到各台主机上检查数据库是否在运行
+    state_list = agent_fanout.run_all(
+        __get_db_run_state, [(db_dict['host'], db_dict['pgdata'], db_dict['db_state']) for db_dict in check_list], None)
+    for db_dict, db_state in zip(check_list, state_list):
+        if db_state is None:
+            # 在规定的时间内没有检查完，只在界面上显示为故障，不修改数据库中的状态
+            db_dict['db_state'] = database_state.FAULT
+            continue
+        db_dict['db_state'] = db_state
+        dao.update_db_state(db_dict['db_id'], db_state)
     ret_data = {"total": total, "page_size": pdict['page_size'], "rows": rows}
     raw_data = json.dumps(ret_data)
     return 200, raw_data
@@ -827,6 +847,40 @@ def get_repl_delay(req):
     return 200, raw_data
 
 
+def get_metric_series(req):
+    """
+    获得一个指标在一段时间内的历史数据，数据来自内存中的时序指标存储，不会连接被监控的数据库
+    """
+    params = {
+        'metric_name': csu_http.MANDATORY,
+        'obj_id': csu_http.MANDATORY | csu_http.INT,
+        'begin_time': csu_http.INT,
+        'end_time': csu_http.INT,
+        'max_points': csu_http.INT,
+    }
+
+    # 检查参数的合法性,如果成功,把参数放到一个字典中
+    err_code, pdict = csu_http.parse_parms(params, req)
+    if err_code != 0:
+        return 400, pdict
+    metric_name = pdict['metric_name']
+    if metric_name not in metric_store.METRIC_NAME_LIST:
+        return 400, f"Unknown metric: {metric_name}"
+
+    args = (metric_name, pdict['obj_id'], pdict.get('begin_time'), pdict.get('end_time'), pdict.get('max_points', 720))
+    if web_worker.is_worker_process():
+        # 指标只保存在主进程的内存中
+        try:
+            step, rows = web_worker.call_main('get_metric_series', *args)
+        except Exception as e:
+            return 400, f"Can not get metric from clup main process: {repr(e)}"
+    else:
+        step, rows = metric_store.query_range(*args)
+    ret_data = {"metric_name": metric_name, "obj_id": pdict['obj_id'], "step": step, "total": len(rows), "rows": rows}
+    raw_data = json.dumps(ret_data)
+    return 200, raw_data
+
+
 def online_cluster(req):
     params = {
         'cluster_id': csu_http.MANDATORY | csu_http.INT,
@@ -25,11 +25,30 @@
 import json
 import logging
 
+import agent_fanout
+import agent_tracker
 import csu_http
 import dbapi
 import rpc_utils
 
 
+def __get_agent_state(ip):
+    """
+    :return: 返回(state, agent_version)，state为1表示agent正常，-1表示连接不上
+    """
+    err_code, err_msg = rpc_utils.get_rpc_connect(ip, conn_timeout=2)
+    if err_code != 0:
+        return -1, ''
+    rpc = err_msg
+    try:
+        return 1, rpc.get_agent_version()
+    except Exception as e:
+        logging.info(f'Failed to retrieve version: {repr(e)}')
+        return 1, ''
+    finally:
+        rpc.close()
+
+
 def get_host_list(req):
     params = {'page_num': csu_http.MANDATORY | csu_http.INT,
               'page_size': csu_http.MANDATORY | csu_http.INT,
@@ -76,22 +95,24 @@ def get_host_list(req):
 
     # leifliu 添加机器状态查询，只查询Down掉的机器
     down_rows = []
+    # 优先使用后台检查agent的结果，没有结果的主机再并发连接agent
+    unknown_row_list = []
     for row in ret_rows:
-        err_code, err_msg = rpc_utils.get_rpc_connect(row['ip'], conn_timeout=2)
-        if err_code == 0:
-            rpc = err_msg
-            try:
-                row['version'] = rpc.get_agent_version()
-            except Exception as e:
-                logging.info(f'Failed to retrieve version: {repr(e)}')
-                row['version'] = ''
-            finally:
-                rpc.close()
-            row['state'] = 1
+        agent_state = agent_tracker.get_host_state(row['ip'])
+        if agent_state is None:
+            unknown_row_list.append(row)
         else:
-            row['state'] = -1
-            if "state" in pdict:
-                down_rows.append(row)
+            row['agent_state'] = (1 if agent_state['is_ok'] else -1, agent_state['version'])
+    state_list = agent_fanout.run_all(__get_agent_state, [(row['ip'],) for row in unknown_row_list], (-1, ''))
+    for row, agent_state in zip(unknown_row_list, state_list):
+        row['agent_state'] = agent_state
+    for row in ret_rows:
+        state, agent_version = row.pop('agent_state')
+        row['state'] = state
+        if state == 1:
+            row['version'] = agent_version
+        elif "state" in pdict:
+            down_rows.append(row)
     if "state" in pdict:
         ret_rows = down_rows
     ret_data = {"total": row_cnt, "page_size": pdict['page_size'], "rows": ret_rows}
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 用多个进程提供web服务，使界面和API的处理不与健康检查争用同一个进程的GIL
+主进程在启动任何线程之前fork出一个web管理进程，web管理进程等主进程完成升级等初始化后，再fork出多个web工作进程，
+各个工作进程用SO_REUSEPORT监听同一个端口，工作进程异常退出后由web管理进程重新拉起。
+健康检查等后台线程只在主进程中运行，session保存在clup数据库中，各个进程共享
+"""
+
+import ctypes
+import logging
+import os
+import signal
+import time
+import traceback
+
+import config
+import csu_web_server
+import csuapp
+import probe_db
+import rpc_utils
+import sessions
+
+# 是否是web工作进程
+__is_worker = False
+# 主进程通知web管理进程初始化已完成的管道
+__ready_fd = None
+
+
+def get_worker_process_cnt():
+    return int(config.get('http_worker_process_cnt', 0))
+
+
+def is_enabled():
+    return get_worker_process_cnt() > 0
+
+
+def is_worker_process():
+    return __is_worker
+
+
+def __set_pdeathsig():
+    # 父进程退出时，本进程收到SIGTERM
+    libc = ctypes.CDLL('libc.so.6')
+    PR_SET_PDEATHSIG = 1
+    libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+
+
+def worker_main(worker_idx, web_root, listen_addr, ui_api_dict):
+    global __is_worker
+
+    __is_worker = True
+    __set_pdeathsig()
+    logging.info(f"web worker({worker_idx}) started, pid={os.getpid()}.")
+    try:
+        config.load_setting()
+        # 工作进程中的界面操作也会用到探测服务，每个工作进程使用自己的探测服务，不和主进程共用结果队列
+        probe_db.start_service(int(config.get('http_worker_probe_cnt', 2)))
+        csu_web_server.start(web_root, listen_addr, ui_api_dict, sessions, csuapp.is_exit,
+                             int(config.get('http_backlog', 128)),
+                             int(config.get('http_worker_cnt', 32)),
+                             int(config.get('http_idle_timeout', 60)),
+                             reuse_port=True,
+                             gzip_min_size=int(config.get('http_gzip_min_size', 1024)),
+                             gzip_level=int(config.get('http_gzip_level', 1)),
+                             request_timeout=int(config.get('http_request_timeout', 60)))
+        while not csuapp.is_exit():
+            time.sleep(1)
+    except Exception:
+        logging.error(f"web worker({worker_idx}) unexpected error: {traceback.format_exc()}")
+    # 不能调用csuapp.cleanup()，否则会删除主进程的pid文件
+    os._exit(0)
+
+
+def __fork_worker(worker_idx, web_root, listen_addr, ui_api_dict):
+    pid = os.fork()
+    if pid == 0:
+        worker_main(worker_idx, web_root, listen_addr, ui_api_dict)
+    return pid
+
+
+def master_main(ready_fd, web_root, listen_addr, ui_api_dict):
+    """
+    web管理进程，只有一个线程，可以安全的fork和重新拉起web工作进程
+    """
+    __set_pdeathsig()
+    # 等待主进程完成升级、装载配置等初始化，主进程退出时读到EOF
+    if os.read(ready_fd, 1) != b'1':
+        os._exit(0)
+    os.close(ready_fd)
+
+    worker_cnt = get_worker_process_cnt()
+    pid_dict = {}
+    for worker_idx in range(worker_cnt):
+        pid_dict[__fork_worker(worker_idx, web_root, listen_addr, ui_api_dict)] = worker_idx
+    logging.info(f"web master started {worker_cnt} workers: {list(pid_dict.keys())}.")
+
+    while not csuapp.is_exit():
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid == 0:
+            time.sleep(1)
+            continue
+        worker_idx = pid_dict.pop(pid, None)
+        if worker_idx is None:
+            continue
+        logging.error(f"web worker({worker_idx}, pid={pid}) exited with status {status}, restart it.")
+        time.sleep(1)
+        if not csuapp.is_exit():
+            pid_dict[__fork_worker(worker_idx, web_root, listen_addr, ui_api_dict)] = worker_idx
+
+    for pid in pid_dict:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + 10
+    while pid_dict and time.time() < deadline:
+        try:
+            pid, _status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        pid_dict.pop(pid, None)
+    os._exit(0)
+
+
+def start_master(web_root, listen_addr, ui_api_dict):
+    """
+    在主进程中调用，必须在启动任何线程和建立数据库连接之前调用
+    """
+    global __ready_fd
+
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(ready_w)
+        master_main(ready_r, web_root, listen_addr, ui_api_dict)
+    os.close(ready_r)
+    __ready_fd = ready_w
+    logging.info(f"web master process started, pid={pid}.")
+
+
+def notify_ready():
+    """
+    主进程完成初始化后，通知web管理进程启动工作进程
+    """
+    global __ready_fd
+
+    if __ready_fd is None:
+        return
+    os.write(__ready_fd, b'1')
+    os.close(__ready_fd)
+    __ready_fd = None
+
+
+def call_main(func_name, *args):
+    """
+    在web工作进程中调用主进程的RPC服务，获取只保存在主进程内存中的数据，如时序指标
+    连接不上主进程时抛出异常，调用者需要自己捕获
+    """
+    err_code, rpc = rpc_utils.get_server_connect()
+    if err_code != 0:
+        raise Exception(rpc)
+    try:
+        return getattr(rpc, func_name)(*args)
+    finally:
+        rpc.close()
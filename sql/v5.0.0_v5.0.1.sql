@@ -0,0 +1,57 @@
+CREATE TABLE IF NOT EXISTS clup_metric_bucket(
+    metric_name varchar(64),
+    obj_id      int,
+    bucket_secs int,
+    bucket_time timestamptz,
+    avg_val     float8,
+    min_val     float8,
+    max_val     float8,
+    sample_cnt  int,
+    PRIMARY KEY (metric_name, obj_id, bucket_secs, bucket_time)
+);
+COMMENT ON TABLE clup_metric_bucket is '时序指标按分钟和小时汇总后的数据';
+COMMENT ON COLUMN clup_metric_bucket.obj_id is '指标所属的对象，根据指标的不同为db_id或cluster_id';
+COMMENT ON COLUMN clup_metric_bucket.bucket_secs is '汇总的精度，单位为秒，60或3600';
+COMMENT ON COLUMN clup_metric_bucket.bucket_time is '汇总时间段的开始时间';
+
+CREATE INDEX IF NOT EXISTS idx_clup_metric_bucket_time ON clup_metric_bucket(bucket_time);
+
+
+INSERT INTO csu_right (right_id, right_name, right_type, rw_type, right_data)
+VALUES (
+    'get_metric_series', '获得指标的历史数据', 1, 0,
+    '{"desc_cn": "获得探测延迟、复制延迟等指标的历史数据", "desc_en": "Retrieve the history of metrics such as probe latency and replication delay."}'
+    )
+ON CONFLICT DO NOTHING;
+
+
+CREATE TABLE IF NOT EXISTS clup_server_member(
+    server_id      text PRIMARY KEY,
+    host           text,
+    rpc_port       int,
+    http_port      int,
+    start_time     timestamptz,
+    heartbeat_time timestamptz
+);
+COMMENT ON TABLE clup_server_member is '共享此数据库的各台clup，分摊集群检查时使用';
+COMMENT ON COLUMN clup_server_member.heartbeat_time is '最后一次心跳的时间，心跳超时的clup不再分配集群';
+
+CREATE TABLE IF NOT EXISTS clup_cluster_owner(
+    cluster_id   int PRIMARY KEY,
+    server_id    text,
+    lease_expire timestamptz,
+    epoch        bigint
+);
+COMMENT ON TABLE clup_cluster_owner is '集群检查的租约，同一时刻一个集群只由租约的持有者检查';
+COMMENT ON COLUMN clup_cluster_owner.epoch is '集群换一次属主加1';
+
+
+CREATE TABLE IF NOT EXISTS clup_session(
+    session_id   text PRIMARY KEY,
+    user_name    text,
+    status       int,
+    expired_time float8
+);
+COMMENT ON TABLE clup_session is '用多个进程提供web服务时，各个进程共享的session';
+COMMENT ON COLUMN clup_session.status is '0-未登录，1-已登录';
+COMMENT ON COLUMN clup_session.expired_time is '过期时间，从1970-01-01开始的秒数';